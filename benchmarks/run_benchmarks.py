@@ -0,0 +1,273 @@
+#! /usr/bin/env python
+"""
+Timed, memory-tracked Phasr benchmarks on simulated amplicons.
+
+Each scenario runs in its own process so its peak resident set size can
+be reported alongside the wall-clock times:
+
+    phasr_run           Phasr end to end on the simulated reads
+    create_feature      one Max Divergent Feature per seed
+    get_good_consensus  the iterative consensus of all the reads
+
+By default blasr is the local stand-in in benchmarks/bin, so only
+pbcore and pbdagcon need to be installed; --real_blasr uses the blasr on
+the PATH instead.  Results are written as JSON, and --baseline compares
+them against an earlier results file, exiting non-zero when a scenario
+got slower or larger by more than --tolerance.
+"""
+import os
+import sys
+import json
+import Queue
+import time
+import shutil
+import socket
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+BENCH_DIR = os.path.dirname( os.path.abspath(__file__) )
+SRC_DIR = os.path.join( BENCH_DIR, os.pardir, 'src', 'pbphase' )
+sys.path.insert( 0, SRC_DIR )
+
+from simulate import AmpliconSimulator, ERROR_PROFILES
+
+SCENARIOS = ['phasr_run', 'create_feature', 'get_good_consensus']
+SCHEMA_VERSION = 1
+
+def median( values ):
+    values = sorted( values )
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle-1] + values[middle]) / 2.0
+
+def peak_rss_kb():
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+def package_version():
+    # Read the same way setup.py does, so no dependency has to be importable
+    globals = {}
+    execfile( os.path.join(SRC_DIR, '__init__.py'), globals )
+    return globals['__VERSION__']
+
+def git_commit():
+    try:
+        return subprocess.check_output( "git rev-parse HEAD", shell=True, cwd=BENCH_DIR,
+                                        stderr=open(os.devnull, 'w') ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def read_fasta( fasta_fn ):
+    from readstore import ReadStore
+    with ReadStore( fasta_fn ) as store:
+        return list( store.records() )
+
+def haplotype_recovery( haplotypes_fn, consensus_fn ):
+    """
+    Best global percent identity of each true haplotype to an output
+    consensus, or 0.0 where nothing was output
+    """
+    from aligner import align_pair
+    if not os.path.isfile( consensus_fn ):
+        return []
+    outputs = [ seq for name, seq in read_fasta( consensus_fn ) ]
+    identities = []
+    for name, truth in read_fasta( haplotypes_fn ):
+        best = 0.0
+        for seq in outputs:
+            alignment = align_pair( truth, seq, mode='global' )
+            if alignment is not None:
+                best = max( best, alignment.pctsimilarity )
+        identities.append( round(best, 3) )
+    return identities
+
+def align_reads( dataset, work_dir ):
+    """
+    Orient the reads against the reference and return their alignments
+    in the form create_feature and get_good_consensus take
+    """
+    from myPhasrUtils import normalize_fasta, get_aln_array
+    from blasrio import stream_blasr
+    reads_fn = os.path.join( work_dir, "normalized.fasta" )
+    normalize_fasta( dataset['reads'], dataset['ref'], reads_fn )
+    alns = get_aln_array( stream_blasr(reads_fn, dataset['ref'], 5, strip_query_names=False), max_num_reads=9999 )
+    backboneSeq = read_fasta( dataset['ref'] )[0][1]
+    return alns, backboneSeq, reads_fn
+
+def bench_phasr_run( dataset, work_dir, args ):
+    output_fn = os.path.join( work_dir, "h_consensus.fasta" )
+    command = [ sys.executable, os.path.join(SRC_DIR, 'myPhasr.py'), dataset['reads'],
+                '--ref_fn', dataset['ref'], '--output', output_fn,
+                '--max_num_proc', str(args.nproc), '--sample_number', str(args.sample_number),
+                '--min_read_length', '0' ] + args.phasr_args
+    times = []
+    rss = 0
+    for i in range( args.repeats ):
+        start = time.time()
+        with open( os.path.join(work_dir, "phasr.log"), 'w' ) as log:
+            process = subprocess.Popen( command, stdout=log, stderr=subprocess.STDOUT, cwd=work_dir )
+            pid, status, usage = os.wait4( process.pid, 0 )
+        times.append( time.time() - start )
+        if status != 0:
+            with open( log.name ) as handle:
+                tail = handle.read().strip().split('\n')[-1]
+            raise RuntimeError( "Phasr exited with status %s: %s" % (status >> 8, tail) )
+        rss = max( rss, usage.ru_maxrss )
+    return { 'wall_seconds': times,
+             'peak_rss_kb': rss,
+             'haplotype_identity': haplotype_recovery( dataset['haplotypes'], output_fn ) }
+
+def bench_create_feature( dataset, work_dir, args ):
+    from myPhasr import create_feature
+    alns, backboneSeq, reads_fn = align_reads( dataset, work_dir )
+    times = []
+    features = 0
+    for seed in range( 1, args.repeats + 1 ):
+        random.seed( seed )
+        start = time.time()
+        result = create_feature( alns, backboneSeq, args.sample_size, len(backboneSeq), 0.0,
+                                 work_dir, reads_fn, 2, seed = seed )
+        times.append( time.time() - start )
+        features += result is not None
+    return { 'wall_seconds': times, 'peak_rss_kb': peak_rss_kb(), 'features': features }
+
+def bench_get_good_consensus( dataset, work_dir, args ):
+    from myPhasrUtils import get_good_consensus
+    alns, backboneSeq, reads_fn = align_reads( dataset, work_dir )
+    times = []
+    for i in range( args.repeats ):
+        start = time.time()
+        consensus = get_good_consensus( alns, backboneSeq, reads_fn, min_iteration = 2, nproc = args.nproc )
+        times.append( time.time() - start )
+    return { 'wall_seconds': times, 'peak_rss_kb': peak_rss_kb(), 'consensus_length': len(consensus) }
+
+BENCHMARKS = {'phasr_run': bench_phasr_run,
+              'create_feature': bench_create_feature,
+              'get_good_consensus': bench_get_good_consensus}
+
+def _run_child( name, dataset, work_dir, args, queue ):
+    try:
+        queue.put( (BENCHMARKS[name]( dataset, work_dir, args ), None) )
+    except Exception as e:
+        queue.put( (None, "%s: %s" % (e.__class__.__name__, e)) )
+
+def run_scenario( name, dataset, args ):
+    """
+    Run one scenario in a fresh process and return its measurements
+    """
+    work_dir = tempfile.mkdtemp( prefix="bench_%s_" % name )
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process( target=_run_child, args=(name, dataset, work_dir, args, queue) )
+    child.start()
+    while True:
+        try:
+            result, error = queue.get( True, 1.0 )
+            break
+        except Queue.Empty:
+            if child.is_alive():
+                continue
+            # the child may have posted its result just before exiting
+            try:
+                result, error = queue.get( True, 1.0 )
+            except Queue.Empty:
+                result, error = None, "scenario process exited with code %s" % child.exitcode
+            break
+    child.join()
+    if not args.keep:
+        shutil.rmtree( work_dir, ignore_errors=True )
+    if error is not None:
+        return { 'error': error }
+    result['median_seconds'] = median( result['wall_seconds'] )
+    return result
+
+def compare( results, baseline, tolerance ):
+    """
+    Return a description of every scenario whose median time or peak
+    memory grew by more than 'tolerance' (a fraction) over the baseline
+    """
+    regressions = []
+    for name, current in sorted( results['scenarios'].items() ):
+        previous = baseline.get( 'scenarios', {} ).get( name )
+        if not previous or 'error' in current or 'error' in previous:
+            continue
+        for metric in ['median_seconds', 'peak_rss_kb']:
+            if not previous.get( metric ):
+                continue
+            ratio = current[metric] / float(previous[metric])
+            if ratio > 1 + tolerance:
+                regressions.append( "%s %s: %s -> %s (x%.2f)" % (name, metric, previous[metric], current[metric], ratio) )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark Phasr on simulated amplicons.")
+    add = parser.add_argument
+    add('--output', default='bench_results.json', help='JSON results file')
+    add('--baseline', default=None, help='earlier results file to compare against')
+    add('--tolerance', default=0.2, type=float, help='allowed fractional slowdown or growth before a regression is reported')
+    add('--scenarios', default=','.join(SCENARIOS), help='comma separated list of scenarios to run')
+    add('--repeats', default=3, type=int, help='timed repetitions per scenario')
+    add('--length', default=1500, type=int, help='amplicon length')
+    add('--haplotypes', default=2, type=int, help='number of haplotypes')
+    add('--divergence', default=0.01, type=float, help='divergence of each haplotype from the reference')
+    add('--coverage', default=50, type=int, help='reads per haplotype')
+    add('--errors', default='clr', choices=sorted(ERROR_PROFILES), help='sequencing error profile')
+    add('--seed', default=0, type=int, help='simulation seed')
+    add('--nproc', default=4, type=int, help='--max_num_proc for Phasr, and realignment processes for get_good_consensus')
+    add('--sample_number', default=6, type=int, help='--sample_number for Phasr')
+    add('--sample_size', default=6, type=int, help='reads per feature sample')
+    add('--real_blasr', action='store_true', help='use the blasr on the PATH instead of the stand-in')
+    add('--keep', action='store_true', help='keep the scenario working directories')
+    add('--phasr_args', default='', help='extra arguments passed to Phasr, as one string')
+    args = parser.parse_args()
+    args.phasr_args = args.phasr_args.split()
+
+    if not args.real_blasr:
+        os.environ['PATH'] = os.path.join( BENCH_DIR, 'bin' ) + os.pathsep + os.environ.get('PATH', '')
+
+    data_dir = tempfile.mkdtemp( prefix="bench_data_" )
+    simulation = dict( length=args.length, haplotypes=args.haplotypes, divergence=args.divergence,
+                       coverage=args.coverage, seed=args.seed )
+    dataset = AmpliconSimulator( errors=ERROR_PROFILES[args.errors], **simulation ).write( data_dir )
+    simulation['errors'] = args.errors
+
+    results = { 'schema': SCHEMA_VERSION,
+                'version': package_version(),
+                'commit': git_commit(),
+                'host': socket.gethostname(),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'cpus': multiprocessing.cpu_count(),
+                'timestamp': time.strftime( "%Y-%m-%dT%H:%M:%S" ),
+                'blasr': 'real' if args.real_blasr else 'standin',
+                'repeats': args.repeats,
+                'simulation': simulation,
+                'scenarios': {} }
+    for name in args.scenarios.split(','):
+        if name not in BENCHMARKS:
+            parser.error( 'Unknown scenario "%s"' % name )
+        print "Running %s..." % name
+        results['scenarios'][name] = run_scenario( name, dataset, args )
+        print "    %s" % json.dumps( results['scenarios'][name], sort_keys=True )
+    shutil.rmtree( data_dir, ignore_errors=True )
+
+    with open( args.output, 'w' ) as output:
+        json.dump( results, output, indent=2, sort_keys=True )
+    print "Results written to %s" % args.output
+
+    failed = [ name for name, result in results['scenarios'].items() if 'error' in result ]
+    if args.baseline:
+        with open( args.baseline ) as handle:
+            regressions = compare( results, json.load(handle), args.tolerance )
+        for regression in regressions:
+            print "REGRESSION %s" % regression
+        if regressions:
+            return 1
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
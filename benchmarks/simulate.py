@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+"""
+Synthetic amplicon data for the Phasr benchmarks.
+
+A random reference is mutated into a number of haplotypes, and reads are
+sampled from the haplotypes with a PacBio-like error profile.  Read names
+carry the zmw, the template span and the haplotype of origin, so results
+can be scored against the truth, with an 'fp' prefix on the reads that
+span the whole amplicon.  Names contain no '/', since Phasr strips
+everything after one.
+"""
+import os
+import sys
+import random
+import argparse
+
+from collections import namedtuple
+
+BASES = "ACGT"
+COMPLEMENT = dict(zip("ACGTN-", "TGCAN-"))
+
+ErrorProfile = namedtuple('ErrorProfile', 'substitution, insertion, deletion')
+
+# Roughly a CLR read: insertion dominated, ~13% total error
+CLR_ERRORS = ErrorProfile( 0.015, 0.09, 0.03 )
+# Roughly a CCS read
+CCS_ERRORS = ErrorProfile( 0.002, 0.004, 0.003 )
+ERROR_PROFILES = {'clr': CLR_ERRORS, 'ccs': CCS_ERRORS}
+
+def reverse_complement( seq ):
+    return ''.join( COMPLEMENT[c] for c in reversed(seq) )
+
+def random_sequence( length, rng ):
+    return ''.join( rng.choice(BASES) for i in xrange(length) )
+
+def mutate( seq, divergence, rng ):
+    """
+    Copy a sequence with substitutions and short indels at the given
+    per-base rate (80% substitutions, 10% insertions, 10% deletions)
+    """
+    output = []
+    for base in seq:
+        if rng.random() >= divergence:
+            output.append( base )
+            continue
+        kind = rng.random()
+        if kind < 0.8:
+            output.append( rng.choice( BASES.replace(base, '') ) )
+        elif kind < 0.9:
+            output.append( base + rng.choice(BASES) )
+    return ''.join( output )
+
+def add_errors( seq, profile, rng ):
+    """
+    Apply sequencing errors to a template sequence
+    """
+    output = []
+    for base in seq:
+        while rng.random() < profile.insertion:
+            output.append( rng.choice(BASES) )
+        draw = rng.random()
+        if draw < profile.deletion:
+            continue
+        if draw < profile.deletion + profile.substitution:
+            output.append( rng.choice( BASES.replace(base, '') ) )
+        else:
+            output.append( base )
+    return ''.join( output )
+
+class AmpliconSimulator(object):
+    """
+    Generate a reference, its haplotypes and a read set over them
+    """
+
+    def __init__(self, length=1500,
+                       haplotypes=2,
+                       divergence=0.01,
+                       coverage=50,
+                       errors=CLR_ERRORS,
+                       full_pass_fraction=0.7,
+                       reverse_fraction=0.5,
+                       seed=0):
+        self.length = length
+        self.n_haplotypes = haplotypes
+        self.divergence = divergence
+        self.coverage = coverage
+        self.errors = errors
+        self.full_pass_fraction = full_pass_fraction
+        self.reverse_fraction = reverse_fraction
+        self.rng = random.Random( seed )
+        self.reference = random_sequence( length, self.rng )
+        self.haplotypes = [ mutate(self.reference, divergence, self.rng) for i in range(haplotypes) ]
+
+    def reads(self):
+        """
+        Yield (name, sequence, haplotype index) for every simulated read
+        """
+        zmw = 0
+        for index, haplotype in enumerate( self.haplotypes ):
+            for i in xrange( self.coverage ):
+                zmw += 1
+                if self.rng.random() < self.full_pass_fraction:
+                    start, end = 0, len(haplotype)
+                    prefix = 'fp'
+                else:
+                    start = self.rng.randint( 0, len(haplotype) / 4 )
+                    end = self.rng.randint( 3 * len(haplotype) / 4, len(haplotype) )
+                    prefix = ''
+                seq = add_errors( haplotype[start:end], self.errors, self.rng )
+                if self.rng.random() < self.reverse_fraction:
+                    seq = reverse_complement( seq )
+                name = "%ssim_%d_%d_%d_h%d" % (prefix, zmw, start, end, index)
+                yield name, seq, index
+
+    def write(self, output_dir, prefix="sim"):
+        """
+        Write <prefix>_reads.fasta, <prefix>_ref.fasta and
+        <prefix>_haplotypes.fasta and return their paths
+        """
+        paths = {}
+        for kind in ['reads', 'ref', 'haplotypes']:
+            paths[kind] = os.path.join( output_dir, "%s_%s.fasta" % (prefix, kind) )
+        with open( paths['ref'], 'w' ) as output:
+            print >>output, ">reference"
+            print >>output, self.reference
+        with open( paths['haplotypes'], 'w' ) as output:
+            for index, haplotype in enumerate( self.haplotypes ):
+                print >>output, ">haplotype_%d" % index
+                print >>output, haplotype
+        with open( paths['reads'], 'w' ) as output:
+            for name, seq, index in self.reads():
+                print >>output, ">" + name
+                print >>output, seq
+        return paths
+
+def main():
+    parser = argparse.ArgumentParser(description = "Simulate amplicon reads from synthetic haplotypes.")
+    add = parser.add_argument
+    add('output_dir', help='directory for the simulated Fasta files')
+    add('--prefix', default='sim', help='prefix of the output file names')
+    add('--length', default=1500, type=int, help='amplicon length')
+    add('--haplotypes', default=2, type=int, help='number of haplotypes')
+    add('--divergence', default=0.01, type=float, help='per-base divergence of each haplotype from the reference')
+    add('--coverage', default=50, type=int, help='reads per haplotype')
+    add('--errors', default='clr', choices=sorted(ERROR_PROFILES), help='sequencing error profile')
+    add('--seed', default=0, type=int, help='random seed')
+    args = parser.parse_args()
+    simulator = AmpliconSimulator( length=args.length, haplotypes=args.haplotypes,
+                                   divergence=args.divergence, coverage=args.coverage,
+                                   errors=ERROR_PROFILES[args.errors], seed=args.seed )
+    for kind, path in sorted( simulator.write( args.output_dir, args.prefix ).items() ):
+        print "%s\t%s" % (kind, path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+import numpy as np
+
+from collections import namedtuple
+
+# Default scoring scheme, mirrors the blasr edit costs (match -5,
+# mismatch 6, insertion/deletion 5) expressed as scores to maximize
+MATCH = 5
+MISMATCH = -6
+GAP = -5
+BAND_WIDTH = 64
+SEED_SIZE = 12
+
+NEG_INF = -(1 << 40)
+DIAG, UP, LEFT, STOP = 0, 1, 2, 3
+
+PairwiseAlignment = namedtuple('PairwiseAlignment',
+                               'score, pctsimilarity, nmatch, nmis, nins, ndel, '
+                               'mismatch, insertion, deletion, aln_length, '
+                               'qstart, qend, tstart, tend, qseq, matchvector, tseq')
+
+def encode( seq ):
+    """
+    Convert a DNA string into a NumPy array of byte codes
+    """
+    return np.frombuffer( seq.upper().encode('ascii'), dtype=np.uint8 )
+
+def estimate_diagonal( query, target, seed_size=SEED_SIZE ):
+    """
+    Estimate the dominant diagonal (target pos - query pos) between
+    two sequences by voting over exact k-mer seed matches
+    """
+    if len(query) < seed_size or len(target) < seed_size:
+        return len(target) - len(query)
+    target_index = {}
+    for i in xrange(len(target) - seed_size + 1):
+        target_index.setdefault( target[i:i+seed_size], i )
+    votes = {}
+    for i in xrange(0, len(query) - seed_size + 1, max(1, seed_size/2)):
+        j = target_index.get( query[i:i+seed_size] )
+        if j is None:
+            continue
+        votes[j - i] = votes.get(j - i, 0) + 1
+    if not votes:
+        return 0
+    return max(votes.iteritems(), key=lambda x: (x[1], -abs(x[0])))[0]
+
+def align_pair( query, target,
+                mode='semiglobal',
+                band_width=BAND_WIDTH,
+                diagonal=None,
+                match=MATCH,
+                mismatch=MISMATCH,
+                gap=GAP ):
+    """
+    Banded pairwise alignment of two sequences held in memory.
+
+    In 'global' mode both sequences are aligned end-to-end.  In
+    'semiglobal' mode leading and trailing overhangs on either sequence
+    are free, so the alignment only covers the overlapping portion.  The
+    band follows the diagonal between the sequence starts (or the supplied
+    'diagonal') and is widened to cover any difference in length.
+    """
+    if mode not in ('global', 'semiglobal'):
+        raise ValueError('Unknown alignment mode "%s"' % mode)
+    query = query.upper()
+    target = target.upper()
+    n, m = len(query), len(target)
+    if n == 0 or m == 0:
+        return None
+    free_ends = (mode == 'semiglobal')
+
+    # Limits of the band, as diagonals d = j - i
+    if diagonal is None:
+        if free_ends:
+            diagonal = estimate_diagonal( query, target )
+        else:
+            diagonal = 0
+    d_lo = min(0, m - n, diagonal) - band_width
+    d_hi = max(0, m - n, diagonal) + band_width
+    if free_ends:
+        d_lo = max(d_lo, -n)
+        d_hi = min(d_hi, m)
+    width = d_hi - d_lo + 1
+
+    q = encode( query )
+    # Pad the target so every band cell can index it without bounds checks
+    t = np.zeros( m + width + 2, dtype=np.uint8 )
+    t[1:m+1] = encode( target )
+    offsets = np.arange( width, dtype=np.int64 )
+    gap_ramp = offsets * gap
+
+    trace = np.empty( (n+1, width), dtype=np.int8 )
+    prev = np.empty( width + 1, dtype=np.int64 )
+
+    # First row, j = d_lo + k
+    cols = d_lo + offsets
+    valid = (cols >= 0) & (cols <= m)
+    row = np.where( valid, 0 if free_ends else cols * gap, NEG_INF )
+    trace[0, :] = np.where( cols == 0, STOP, LEFT )
+    if free_ends:
+        trace[0, :] = STOP
+
+    best = (NEG_INF, 0, 0)
+    if free_ends and 0 <= m - d_lo < width:
+        best = (row[m - d_lo], 0, m)
+
+    for i in xrange(1, n+1):
+        prev[:width] = row
+        prev[width] = NEG_INF
+        cols = i + d_lo + offsets
+        valid = (cols >= 0) & (cols <= m)
+        target_bases = t[np.clip(cols, 0, m + width + 1)]
+        subs = np.where( target_bases == q[i-1], match, mismatch )
+        diag = prev[:width] + subs
+        up = prev[1:] + gap
+        cell = np.maximum( diag, up )
+        direction = np.where( diag >= up, DIAG, UP ).astype( np.int8 )
+        # Column zero of each row starts a new alignment / pays the leading gap
+        is_first_col = (cols == 0)
+        if is_first_col.any():
+            cell[is_first_col] = 0 if free_ends else i * gap
+            direction[is_first_col] = STOP if free_ends else UP
+        cell[~valid] = NEG_INF
+        # Horizontal gaps: H[k] = max(A[k], H[k-1] + gap), via a running max
+        running = np.maximum.accumulate( cell - gap_ramp ) + gap_ramp
+        use_left = running > cell
+        direction[use_left] = LEFT
+        row = np.where( valid, running, NEG_INF )
+        trace[i, :] = direction
+        if free_ends and 0 <= m - i - d_lo < width:
+            k = m - i - d_lo
+            if row[k] > best[0]:
+                best = (row[k], i, m)
+
+    if free_ends:
+        k_lo = max(0, -n - d_lo)
+        k_hi = min(width - 1, m - n - d_lo)
+        if k_lo <= k_hi:
+            k = k_lo + int(np.argmax( row[k_lo:k_hi+1] ))
+            if row[k] > best[0]:
+                best = (row[k], n, n + d_lo + k)
+        score, i, j = best
+    else:
+        i, j = n, m
+        score = row[m - n - d_lo]
+    if score <= NEG_INF / 2:
+        return None
+
+    # Traceback
+    qend, tend = i, j
+    q_aln, t_aln, mv = [], [], []
+    nmatch = nmis = nins = ndel = 0
+    while i > 0 or j > 0:
+        if i == 0:
+            if free_ends:
+                break
+            direction = LEFT
+        elif j == 0:
+            if free_ends:
+                break
+            direction = UP
+        else:
+            direction = trace[i, j - i - d_lo]
+        if direction == STOP:
+            break
+        if direction == DIAG:
+            qb, tb = query[i-1], target[j-1]
+            q_aln.append(qb); t_aln.append(tb)
+            if qb == tb:
+                mv.append('|'); nmatch += 1
+            else:
+                mv.append('*'); nmis += 1
+            i -= 1; j -= 1
+        elif direction == UP:
+            q_aln.append(query[i-1]); t_aln.append('-'); mv.append('*')
+            nins += 1
+            i -= 1
+        else:
+            q_aln.append('-'); t_aln.append(target[j-1]); mv.append('*')
+            ndel += 1
+            j -= 1
+    qstart, tstart = i, j
+
+    aln_length = len(mv)
+    if aln_length == 0:
+        return None
+    aln_length_f = float(aln_length)
+    return PairwiseAlignment._make([ int(score),
+                                     100.0 * nmatch / aln_length_f,
+                                     nmatch, nmis, nins, ndel,
+                                     nmis / aln_length_f,
+                                     nins / aln_length_f,
+                                     ndel / aln_length_f,
+                                     aln_length,
+                                     qstart, qend, tstart, tend,
+                                     ''.join(reversed(q_aln)),
+                                     ''.join(reversed(mv)),
+                                     ''.join(reversed(t_aln)) ])
+
+def pct_similarity( query, target, **kwargs ):
+    """
+    Return the percent similarity of the best alignment of two sequences
+    """
+    alignment = align_pair( query, target, **kwargs )
+    if alignment is None:
+        return None
+    return alignment.pctsimilarity
+
+def overlap_sequences( alignment ):
+    """
+    Return the ungapped query and target sequences trimmed down to the
+    overlapping portion covered by an alignment
+    """
+    return alignment.qseq.replace('-', ''), alignment.tseq.replace('-', '')
@@ -0,0 +1,189 @@
+import os
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = 'PBALNTB1'
+HEADER = struct.Struct('<8sqqq')
+COLUMNS = [ ('read_id', np.int32), ('qstart', np.int32), ('qend', np.int32),
+            ('tstart', np.int32), ('tend', np.int32), ('offset', np.int64),
+            ('length', np.int32) ]
+
+def _align( position ):
+    return (position + 7) & ~7
+
+class AlignmentTable(object):
+    """
+    Alignments from get_aln_array stored as columns.
+
+    Read names are interned to integer ids, coordinates are int32 arrays
+    and the aligned query and target strings are concatenated into one
+    buffer each, addressed by offset and length.  Indexing returns the
+    usual ((qs, qe, q_aln), (ts, te, t_aln), read_name) tuple, so a table
+    can be passed anywhere a list of alignments was.
+
+    share() writes the table to a file and returns a read-only copy that
+    is memory-mapped from it.  Pickling a mapped table only records its
+    path, so worker processes map the same pages instead of receiving a
+    copy of the alignments.
+    """
+
+    def __init__(self, names, columns, query, target, path=None, mapping=None):
+        self.names = names
+        self.query = query
+        self.target = target
+        self.path = path
+        self._mapping = mapping
+        for name, dtype in COLUMNS:
+            setattr( self, name, columns[name] )
+        self._name_ids = None
+
+    @classmethod
+    def from_alns(cls, alns):
+        names, name_ids = [], {}
+        n = len(alns)
+        columns = dict( (name, np.zeros(n, dtype=dtype)) for name, dtype in COLUMNS )
+        query, target = [], []
+        offset = 0
+        for i, ((qs, qe, q_aln), (ts, te, t_aln), rid) in enumerate( alns ):
+            if len(q_aln) != len(t_aln):
+                raise ValueError( "Aligned query and target of %s differ in length" % rid )
+            if rid not in name_ids:
+                name_ids[rid] = len(names)
+                names.append( rid )
+            columns['read_id'][i] = name_ids[rid]
+            columns['qstart'][i] = qs; columns['qend'][i] = qe
+            columns['tstart'][i] = ts; columns['tend'][i] = te
+            columns['offset'][i] = offset
+            columns['length'][i] = len(q_aln)
+            offset += len(q_aln)
+            query.append( q_aln ); target.append( t_aln )
+        return cls( names, columns, ''.join(query), ''.join(target) )
+
+    @classmethod
+    def open(cls, path):
+        """
+        Map a table written by share() read-only
+        """
+        with open( path, 'rb' ) as handle:
+            mapping = mmap.mmap( handle.fileno(), 0, access=mmap.ACCESS_READ )
+        magic, n, names_bytes, seq_bytes = HEADER.unpack_from( mapping, 0 )
+        if magic != MAGIC:
+            mapping.close()
+            raise ValueError( "%s is not an alignment table" % path )
+        position = HEADER.size
+        columns = {}
+        for name, dtype in COLUMNS:
+            position = _align( position )
+            columns[name] = np.frombuffer( mapping, dtype=dtype, count=n, offset=position ) if n else np.zeros(0, dtype=dtype)
+            position += n * np.dtype(dtype).itemsize
+        names = mapping[position:position+names_bytes].split('\n') if names_bytes else []
+        position += names_bytes
+        query = buffer( mapping, position, seq_bytes )
+        target = buffer( mapping, position + seq_bytes, seq_bytes )
+        return cls( names, columns, query, target, path=os.path.abspath(path), mapping=mapping )
+
+    def share(self, path):
+        """
+        Write the table to 'path' and return it memory-mapped from there
+        """
+        names = '\n'.join( self.names )
+        with open( path, 'wb' ) as output:
+            output.write( HEADER.pack( MAGIC, len(self), len(names), len(self.query) ) )
+            for name, dtype in COLUMNS:
+                output.write( '\0' * (_align(output.tell()) - output.tell()) )
+                output.write( np.ascontiguousarray( getattr(self, name), dtype=dtype ).tostring() )
+            output.write( names )
+            output.write( self.query )
+            output.write( self.target )
+        return AlignmentTable.open( path )
+
+    def close(self):
+        if self._mapping is not None:
+            ### drop the views into the map before closing it
+            for name, dtype in COLUMNS:
+                setattr( self, name, np.array( getattr(self, name) ) )
+            self.query = str(self.query); self.target = str(self.target)
+            self._mapping.close()
+            self._mapping = None
+
+    def __reduce__(self):
+        if self.path is not None:
+            return (open_table, (self.path,))
+        columns = dict( (name, getattr(self, name)) for name, dtype in COLUMNS )
+        return (AlignmentTable, (self.names, columns, str(self.query), str(self.target)))
+
+    def __len__(self):
+        return len(self.read_id)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in xrange(*i.indices(len(self))) ]
+        if i < 0:
+            i += len(self)
+        start = int(self.offset[i])
+        end = start + int(self.length[i])
+        return ( (int(self.qstart[i]), int(self.qend[i]), self.query[start:end]),
+                 (int(self.tstart[i]), int(self.tend[i]), self.target[start:end]),
+                 self.names[self.read_id[i]] )
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def read_name(self, i):
+        return self.names[self.read_id[i]]
+
+    def name_id(self, name):
+        if self._name_ids is None:
+            self._name_ids = dict( (n, i) for i, n in enumerate(self.names) )
+        return self._name_ids.get( name )
+
+    def mask(self, indices):
+        """
+        Bitmap over the alignments with the given indices set
+        """
+        selected = np.zeros( len(self), dtype=bool )
+        selected[np.asarray(indices, dtype=np.int64)] = True
+        return selected
+
+    def subset(self, selection):
+        """
+        View of the alignments picked by an index array (kept in its
+        order) or a boolean mask
+        """
+        selection = np.asarray( selection )
+        if selection.dtype == bool:
+            selection = np.flatnonzero( selection )
+        return AlignmentSubset( self, selection.astype(np.int64) )
+
+class AlignmentSubset(object):
+    """
+    A subset of an AlignmentTable held as an index array
+    """
+
+    def __init__(self, table, indices):
+        self.table = table
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return AlignmentSubset( self.table, self.indices[i] )
+        return self.table[ int(self.indices[i]) ]
+
+    def __iter__(self):
+        for i in self.indices:
+            yield self.table[int(i)]
+
+    def mask(self):
+        return self.table.mask( self.indices )
+
+    def read_names(self):
+        return [ self.table.read_name(i) for i in self.indices ]
+
+def open_table( path ):
+    return AlignmentTable.open( path )
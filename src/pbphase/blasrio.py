@@ -0,0 +1,226 @@
+import array
+import subprocess
+
+import numpy as np
+
+def _number( value ):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+class BlasrRecord(object):
+    """
+    Base class of the typed blasr records.  Subclasses list their columns
+    in __slots__ and the matching converters in _types; fields keep the
+    names parse_blasr always used.
+    """
+    __slots__ = ()
+    _types = ()
+
+    def __init__(self, tokens):
+        if len(tokens) != len(self.__slots__):
+            raise ValueError( "Expected %s columns for %s, found %s" % (len(self.__slots__), self.__class__.__name__, len(tokens)) )
+        for field, convert, token in zip( self.__slots__, self._types, tokens ):
+            setattr( self, field, convert(token) )
+
+    @property
+    def _fields(self):
+        return self.__slots__
+
+    def __iter__(self):
+        return ( getattr(self, field) for field in self.__slots__ )
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ getattr(self, field) for field in self.__slots__[i] ]
+        return getattr( self, self.__slots__[i] )
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%s)" % ( self.__class__.__name__,
+                            ", ".join( "%s=%r" % (f, getattr(self, f)) for f in self.__slots__ ) )
+
+    def __getstate__(self):
+        return tuple(self)
+
+    def __setstate__(self, state):
+        for field, value in zip( self.__slots__, state ):
+            setattr( self, field, value )
+
+class M1Record(BlasrRecord):
+    __slots__ = ('qname', 'tname', 'qstrand', 'tstrand', 'score', 'pctsimilarity',
+                 'tstart', 'tend', 'tlength', 'qstart', 'qend', 'qlength', 'ncells')
+    _types = (str, str, int, int, _number, float,
+              int, int, int, int, int, int, _number)
+
+class M4Record(BlasrRecord):
+    __slots__ = ('qname', 'tname', 'score', 'pctsimilarity', 'qstrand', 'qstart', 'qend',
+                 'qseqlength', 'tstrand', 'tstart', 'tend', 'tseqlength', 'mapqv', 'ncells',
+                 'clusterScore', 'probscore', 'numSigClusters')
+    _types = (str, str, _number, float, int, int, int,
+              int, int, int, int, int, _number, _number,
+              float, float, _number)
+
+class M5Record(BlasrRecord):
+    __slots__ = ('qname', 'qlength', 'z1', 'qalength', 'qstrand', 'tname', 'tlength',
+                 'z2', 'talength', 'tstrand', 'score', 'nmatch', 'nmis', 'nins', 'ndel',
+                 'zscore', 'qseq', 'matchvector', 'tseq')
+    _types = (str, int, int, int, str, str, int,
+              int, int, str, _number, int, int, int, int,
+              _number, str, str, str)
+
+    @property
+    def pctsimilarity(self):
+        aligned = self.nmatch + self.nmis + self.nins + self.ndel
+        return 100.0 * self.nmatch / max( aligned, 1 )
+
+RECORD_TYPES = {1: M1Record, 4: M4Record, 5: M5Record}
+
+def _lines( source ):
+    if isinstance(source, basestring):
+        with open( source ) as handle:
+            for line in handle:
+                yield line
+    else:
+        for line in source:
+            yield line
+
+def iter_blasr( source, mode, strip_query_names = True ):
+    """
+    Yield typed records from blasr -m 1, 4 or 5 output, one line at a
+    time.  'source' is a filename or any iterable of lines, such as an
+    open file or a pipe.
+    """
+    try:
+        record_type = RECORD_TYPES[mode]
+    except KeyError:
+        raise ValueError( "Unsupported blasr output mode %s" % mode )
+    for line in _lines( source ):
+        tokens = line.split()
+        if not tokens:
+            continue
+        if strip_query_names:
+            tokens[0] = tokens[0].split("/")[0]
+        yield record_type( tokens )
+
+def blasr_lines( query_fn, target_fn, mode, options = "" ):
+    """
+    Run blasr and yield the lines of its output as they are written to
+    the pipe, raising CalledProcessError if blasr fails
+    """
+    command = "blasr %s %s -m %s %s" % (query_fn, target_fn, mode, options)
+    process = subprocess.Popen( command, shell=True, stdout=subprocess.PIPE )
+    try:
+        for line in iter( process.stdout.readline, '' ):
+            yield line
+    finally:
+        process.stdout.close()
+        status = process.wait()
+    if status != 0:
+        raise subprocess.CalledProcessError( status, command )
+
+def stream_blasr( query_fn, target_fn, mode, options = "", strip_query_names = True ):
+    """
+    Run blasr and yield its records as they are written to the pipe
+    """
+    return iter_blasr( blasr_lines( query_fn, target_fn, mode, options ), mode, strip_query_names )
+
+def parse_blasr( output, mode, strip_query_names = True ):
+    """
+    Parse blasr output already held in a string into a list of records
+    """
+    return list( iter_blasr( output.splitlines(), mode, strip_query_names ) )
+
+M5_NUMERIC = [ ('qlength', 'l'), ('qstart', 'l'), ('qend', 'l'), ('tlength', 'l'),
+               ('tstart', 'l'), ('tend', 'l'), ('score', 'd'), ('nmatch', 'l'),
+               ('nmis', 'l'), ('nins', 'l'), ('ndel', 'l'), ('mapqv', 'd') ]
+M5_NUMERIC_COLUMNS = [1, 2, 3, 6, 7, 8, 10, 11, 12, 13, 14, 15]
+
+def _column( buffer, dtype ):
+    ### view the array.array the column was accumulated in, without a copy
+    if not len(buffer):
+        return np.zeros( 0, dtype=dtype )
+    return np.frombuffer( buffer, dtype=dtype )
+
+class M5Columns(object):
+    """
+    A whole m5 file as NumPy columns.  Numeric fields become int64 or
+    float64 arrays, strands are booleans (True for '-'), and read and
+    target names are stored once each with an int32 code per alignment.
+    The aligned sequences are only kept when asked for.
+    """
+
+    def __init__(self, source, strip_query_names = True, sequences = False):
+        buffers = [ array.array(code) for name, code in M5_NUMERIC ]
+        qstrand, tstrand = array.array('b'), array.array('b')
+        qcodes, tcodes = array.array('i'), array.array('i')
+        qnames, tnames = {}, {}
+        self.qseq, self.matchvector, self.tseq = [], [], []
+        for line in _lines( source ):
+            tokens = line.split()
+            if not tokens:
+                continue
+            qname = tokens[0].split("/")[0] if strip_query_names else tokens[0]
+            qcodes.append( qnames.setdefault( qname, len(qnames) ) )
+            tcodes.append( tnames.setdefault( tokens[5], len(tnames) ) )
+            for buffer, column in zip( buffers, M5_NUMERIC_COLUMNS ):
+                buffer.append( _number( tokens[column] ) )
+            qstrand.append( tokens[4] == '-' )
+            tstrand.append( tokens[9] == '-' )
+            if sequences:
+                self.qseq.append( tokens[16] ); self.matchvector.append( tokens[17] ); self.tseq.append( tokens[18] )
+        for (name, code), buffer in zip( M5_NUMERIC, buffers ):
+            setattr( self, name, _column( buffer, np.int64 if code == 'l' else np.float64 ) )
+        self.qstrand = _column( qstrand, np.int8 ).astype(bool)
+        self.tstrand = _column( tstrand, np.int8 ).astype(bool)
+        self.qname_index = _column( qcodes, np.int32 )
+        self.tname_index = _column( tcodes, np.int32 )
+        self.qnames = sorted( qnames, key=qnames.get )
+        self.tnames = sorted( tnames, key=tnames.get )
+
+    def __len__(self):
+        return len(self.qname_index)
+
+    def qname(self, i):
+        return self.qnames[ self.qname_index[i] ]
+
+    def tname(self, i):
+        return self.tnames[ self.tname_index[i] ]
+
+    @property
+    def pctsimilarity(self):
+        aligned = self.nmatch + self.nmis + self.nins + self.ndel
+        return 100.0 * self.nmatch / np.maximum( aligned, 1 )
+
+    def rows(self, tname = None):
+        """
+        Yield the alignments, or those to one target, as m5 rows in file
+        order, in the form simple_align_hit_iterator yields them, so they
+        can be handed to get_aln_array.  Needs the aligned sequences.
+        """
+        if len(self) and not self.qseq:
+            raise ValueError( "m5 columns were loaded without the aligned sequences" )
+        if tname is None:
+            indices = np.arange( len(self) )
+        elif tname in self.tnames:
+            indices = np.flatnonzero( self.tname_index == self.tnames.index(tname) )
+        else:
+            indices = []
+        for i in indices:
+            yield [ self.qname(i), int(self.qlength[i]), int(self.qstart[i]), int(self.qend[i]),
+                    '-+'[not self.qstrand[i]], self.tname(i), int(self.tlength[i]),
+                    int(self.tstart[i]), int(self.tend[i]), '-+'[not self.tstrand[i]],
+                    float(self.score[i]), int(self.nmatch[i]), int(self.nmis[i]), int(self.nins[i]),
+                    int(self.ndel[i]), float(self.mapqv[i]), self.qseq[i], self.matchvector[i], self.tseq[i] ]
+
+def load_m5( source, strip_query_names = True, sequences = False ):
+    return M5Columns( source, strip_query_names, sequences )
@@ -0,0 +1,139 @@
+import os
+import errno
+import fcntl
+import hashlib
+import logging
+import tempfile
+
+from seqio import read_fasta
+
+log = logging.getLogger()
+
+# Default size cap of the cache, in bytes
+CACHE_SIZE = 512 * 1024 * 1024
+LOCK_FILE = ".lock"
+ENTRY_SUFFIX = ".cns"
+
+def consensus_key( records, backboneSeq, **params ):
+    """
+    Digest identifying a consensus computation: the sorted read names and
+    sequences, the backbone and the consensus parameters
+    """
+    digest = hashlib.sha1()
+    for name, sequence in sorted( records ):
+        digest.update( name )
+        digest.update( '\t' )
+        digest.update( sequence.upper() )
+        digest.update( '\n' )
+    digest.update( '>' )
+    digest.update( backboneSeq.upper() )
+    for param, value in sorted( params.iteritems() ):
+        digest.update( '\n%s=%r' % (param, value) )
+    return digest.hexdigest()
+
+def fasta_consensus_key( read_fn, backboneSeq, **params ):
+    """
+    Digest identifying the consensus of the reads in a Fasta file
+    """
+    records = [ (r.name, r.sequence) for r in read_fasta( read_fn ) ]
+    return consensus_key( records, backboneSeq, **params )
+
+class ConsensusCache(object):
+    """
+    Content-addressed on-disk store of consensus sequences.
+
+    Entries are written to a temporary file and renamed into place, so
+    readers never see a partial entry, and eviction is serialized with a
+    lock file, so several Phasr processes on one machine can share a cache
+    directory.  Reads refresh an entry's modification time, and eviction
+    removes the least recently used entries once the total size exceeds
+    the cap.
+    """
+
+    def __init__(self, cache_dir, max_bytes=CACHE_SIZE):
+        self.cache_dir = os.path.abspath( cache_dir )
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs( self.cache_dir )
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._lock_fn = os.path.join( self.cache_dir, LOCK_FILE )
+
+    def _path(self, key):
+        return os.path.join( self.cache_dir, key[:2], key + ENTRY_SUFFIX )
+
+    def get(self, key):
+        """
+        Return the cached consensus for a key, or None on a miss
+        """
+        path = self._path( key )
+        try:
+            with open( path ) as handle:
+                consensus = handle.read()
+            os.utime( path, None )
+        except (IOError, OSError):
+            return None
+        return consensus
+
+    def put(self, key, consensus):
+        path = self._path( key )
+        directory = os.path.dirname( path )
+        try:
+            os.makedirs( directory )
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        handle, tmp_fn = tempfile.mkstemp( dir=directory, suffix='.tmp' )
+        with os.fdopen( handle, 'w' ) as output:
+            output.write( consensus )
+        os.rename( tmp_fn, path )
+        self.evict()
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached consensus for a key, computing and storing it
+        with compute() on a miss
+        """
+        consensus = self.get( key )
+        if consensus is not None:
+            log.info("Consensus cache hit for %s" % key)
+            return consensus
+        consensus = compute()
+        self.put( key, consensus )
+        return consensus
+
+    def _entries(self):
+        for shard in os.listdir( self.cache_dir ):
+            shard_dir = os.path.join( self.cache_dir, shard )
+            if not os.path.isdir( shard_dir ):
+                continue
+            for entry in os.listdir( shard_dir ):
+                if not entry.endswith( ENTRY_SUFFIX ):
+                    continue
+                path = os.path.join( shard_dir, entry )
+                try:
+                    stat = os.stat( path )
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits its cap
+        """
+        with open( self._lock_fn, 'a' ) as lock:
+            fcntl.flock( lock, fcntl.LOCK_EX )
+            try:
+                entries = sorted( self._entries() )
+                total = sum( size for mtime, size, path in entries )
+                for mtime, size, path in entries:
+                    if total <= self.max_bytes:
+                        break
+                    try:
+                        os.remove( path )
+                    except OSError:
+                        pass
+                    total -= size
+            finally:
+                fcntl.flock( lock, fcntl.LOCK_UN )
@@ -1,10 +1,12 @@
 #! /usr/bin/env python
 
 import os, sys, glob, logging
+import multiprocessing
 import pkg_resources
 from math import log as log10
 
 import numpy as np
+from collections import namedtuple
 from pbcore.io import FastaReader
 from pbtools.pbdagcon.c_aligngraph import *
 from pbtools.pbdagcon.c_utils import construct_aln_graph_from_fasta
@@ -14,12 +16,16 @@ from pbtools.pbdagcon.vis_utils import dump_sorted_node_data
 from pbtools.pbdagcon.c_utils import best_template_by_blasr
 from pbtools.pbdagcon.c_utils import clustering_read
 from pbtools.pbdagcon.c_utils import get_subset_reads
-from pbtools.pbdagcon.c_utils import read_node_vector
 from pbtools.pbdagcon.c_utils import detect_missing
 
 from utils import (count_fasta,
                    read_fasta_names,
                    write_fasta)
+from readstore import ReadStore
+from scratch import ScratchSpace
+from workers import TreePool
+from seqio import plain_fasta, read_fasta
+from zmw import collapse_zmws, write_units, ZMW_MODES
 
 # Default values
 MIN_GROUP = 25
@@ -30,6 +36,31 @@ PREFIX = 'Unknown'
 
 log = logging.getLogger()
 
+# Codes of the read-by-site matrix
+SITE_BASE = 1
+SITE_DELETION = -1
+SITE_UNCOVERED = 0
+
+# Reads of an alignment graph at its high-entropy sites: read ids in row
+# order, the int8 read-by-site matrix, and per site the (node, backbone
+# position, entropy) tuple, backbone positions and entropies
+ReadSites = namedtuple('ReadSites', 'read_ids, matrix, nodes, positions, entropies')
+
+# Candidate split sites scored per pair of matrix products
+SCORE_BLOCK = 256
+# Cap on the reassignment passes refining each split
+REGROUP_ITERATIONS = 20
+# Consensus iterations of a partition tree node, seeded from its parent
+SEEDED_ITERATIONS = 2
+
+# One final group to finalize: its number, plain Fasta of its reads, the
+# partition consensus, and the settings of the alignment graph
+GroupTask = namedtuple('GroupTask', 'group_id, read_file, seq, output_dir, prefix, max_coverage, nproc')
+
+# A node of the partition tree: positions of its reads in the read table,
+# the consensus of its parent, and its depth
+PartitionNode = namedtuple('PartitionNode', 'indices, consensus, depth')
+
 def calculate_entropy( threshold ):
     return -1 * threshold * log10(threshold) - (1-threshold) * log10(1-threshold)
 
@@ -83,15 +114,41 @@ def get_consensus(read_fn, init_ref, consensus_fn, consens_seq_name,
             print >>f, s
     return g, s
 
+def write_scores(score_fn, seq, c_data):
+    with open(score_fn,"w") as f:
+        for i in range(len(seq)):
+            print >>f, i, seq[i], " ".join([str(c) for c in c_data[i]]), 1.0*c_data[i][0]/(c_data[i][3]+1)
+
+def finalize_group(task):
+    """
+    Realign the reads of one final group to its partition consensus and
+    write its consensus and per-position score files; returns the group
+    number
+    """
+    cns = os.path.join( task.output_dir, "group_%02d_cns.fa" % task.group_id )
+    with open(cns,"w") as f:
+        print >>f, ">group_%02d_cns" % task.group_id
+        print >>f, task.seq
+
+    aln_g = construct_aln_graph_from_fasta(task.read_file,
+                                           cns,
+                                           max_num_reads = task.max_coverage,
+                                           max_cov = task.max_coverage,
+                                           remove_in_del = False,
+                                           nproc = task.nproc,
+                                           use_read_id = False)
+    seq, c_data = aln_g.generate_consensus(min_cov=0, compute_qv_data= True)
+
+    with open(cns,"w") as f:
+        print >>f, ">%s_group_%02d_cns" % (task.prefix, task.group_id)
+        print >>f, seq
+
+    write_scores( os.path.join( task.output_dir, "group_%02d.score" % task.group_id ), seq, c_data )
+    return task.group_id
+
 def fetch_read(in_file, out_file, id_set):
-    in_f = FastaReader(in_file)
-    with open(out_file,"w") as out_f:
-        for r in in_f:
-            if r.name not in id_set:
-                continue
-            print >> out_f, ">"+r.name
-            print >> out_f, r.sequence
-    in_f.file.close()
+    with ReadStore(in_file) as store:
+        store.write_subset(id_set, out_file)
 
 def get_hp_run_counts(n):
     rtn = [0, 0]
@@ -122,41 +179,50 @@ def is_hp_node(n):
     else:
         return False
 
-def read_node_vector(g, ENTROPY_TH, entropy_th = 0.65):
-    
+def read_site_matrix(g, ENTROPY_TH, entropy_th = 0.65):
+    """
+    Encode every read of an alignment graph at its high-entropy, non
+    homopolymer nodes as one row of an int8 matrix: SITE_BASE where the
+    read passes through the node, SITE_DELETION where the node lies in
+    the read's range but the read does not pass through it, and
+    SITE_UNCOVERED elsewhere.  Rows are ordered by their first site,
+    bases first.
+    """
     ne, hne = g.get_high_entropy_nodes(coverage_th = 0, entropy_th = ENTROPY_TH)
-    node_to_entropy = dict( [ (v[1],v[2]) for v in ne ] ) 
-    read_ids = set()
-    
-    for n in g.get_nodes().values():
-        for r in n.get_info():
-            read_ids.add(r[0]) #r[0]: read id, r[1]: read base
-    
-    backbone_node_to_reads = {}
+    node_to_entropy = dict( [ (v[1],v[2]) for v in ne ] )
+
+    read_ids = []
+    read_index = {}
     for n in g.get_nodes().values():
-        bn = n.get_backbone_node()
-        backbone_node_to_reads.setdefault(bn, set() )
         for r_id, r_pos in n.get_info():
-            backbone_node_to_reads[bn].add( r_id )
-    
+            if r_id not in read_index:
+                read_index[r_id] = len(read_ids)
+                read_ids.append( r_id )
+
     backbone_node_to_pos = g.get_backbone_node_to_pos()
     sn = g.get_sorted_nodes()
     high_entropy_nodes = [ (n, backbone_node_to_pos[n.get_backbone_node()], node_to_entropy[n]) \
                             for n in sn if n in node_to_entropy and node_to_entropy[n] > entropy_th]
-    high_entropy_nodes = [ n for n in high_entropy_nodes if not is_hp_node(n[0]) ] 
-
-    read_to_nodes = {}
-    for r_id in read_ids:
-        read_to_nodes[r_id] = [" "] * len(high_entropy_nodes)
-        for i,n in enumerate(high_entropy_nodes):
-            if r_id in [x[0] for x in n[0].get_info()]:
-                read_to_nodes[r_id][i] = n[0].get_base()
-            else:
-                bs,be = g.get_read_range()[r_id]
-                bp = backbone_node_to_pos[n[0].get_backbone_node()]
-                if bp >= bs and bp < be:
-                    read_to_nodes[r_id][i] = "*"
-    return read_to_nodes, high_entropy_nodes
+    high_entropy_nodes = [ n for n in high_entropy_nodes if not is_hp_node(n[0]) ]
+    positions = np.array( [ n[1] for n in high_entropy_nodes ], dtype=np.int64 )
+
+    # Reads covering a site are deletions there unless they pass through it
+    read_range = g.get_read_range()
+    starts = np.array( [ read_range[r_id][0] for r_id in read_ids ], dtype=np.int64 )
+    ends = np.array( [ read_range[r_id][1] for r_id in read_ids ], dtype=np.int64 )
+    covered = (positions[None, :] >= starts[:, None]) & (positions[None, :] < ends[:, None])
+    matrix = np.where( covered, SITE_DELETION, SITE_UNCOVERED ).astype(np.int8)
+    for i, (n, bp, entropy) in enumerate( high_entropy_nodes ):
+        rows = [ read_index[r_id] for r_id, r_pos in n.get_info() ]
+        matrix[rows, i] = SITE_BASE
+
+    if high_entropy_nodes:
+        rank = np.choose( matrix[:, 0] + 1, [1, 0, 2] )
+        order = np.argsort( -rank, kind='mergesort' )
+        matrix = matrix[order]
+        read_ids = [ read_ids[i] for i in order ]
+    return ReadSites( read_ids, matrix, high_entropy_nodes, positions,
+                      np.array( [ n[2] for n in high_entropy_nodes ], dtype=float ) )
 
 def partition_score(m, pos, index):
     m0 = m[m[:,pos] == 1 ,:]
@@ -165,6 +231,25 @@ def partition_score(m, pos, index):
     m1 = m1[:,index]
     return np.sum(np.sum(m0,0) *  np.sum(m1,0))
 
+def score_partitions(m, candidates, index, block = SCORE_BLOCK):
+    """
+    partition_score of every candidate site at once.  For a block of
+    candidates, the column sums of the reads with a base and of the reads
+    with a deletion at each candidate are the rows of two float32 matrix
+    products; being integers below 2**24 they are exact, and their
+    products are summed in float64, so the scores equal partition_score.
+    Memory is linear in the number of reads and sites.
+    """
+    sub = m[:, index].astype(np.float32)
+    candidates = np.asarray(candidates, dtype=np.int64)
+    scores = np.zeros(len(candidates))
+    for start in xrange(0, len(candidates), block):
+        cols = m[:, candidates[start:start+block]]
+        base = np.dot((cols == SITE_BASE).T.astype(np.float32), sub).astype(np.float64)
+        deletion = np.dot((cols == SITE_DELETION).T.astype(np.float32), sub).astype(np.float64)
+        scores[start:start+block] = np.einsum('ij,ij->i', base, deletion)
+    return scores
+
 def col_entropy(m):
     sp = np.sum(m == 1,0) + 1
     sn = np.sum(m == -1, 0) + 1
@@ -177,44 +262,34 @@ def col_entropy(m):
     #return -p1 * np.log(p1) - p2 * np.log(p2) - p3 * log(p3)
     return -p1 * np.log(p1) - p2 * np.log(p2)
 
-def regroup(g1, g2, index):
-    smap = {"A":1,"C":1,"G":1,"T":1,"*":-1," ":0}
-    read_vector = g1 + g2
-    m = {}
-    m1 = np.zeros( (len(g1), len(index) ) )
-    m2 = np.zeros( (len(g2), len(index) ) )
-    g1_id = [x[0] for x in g1] 
-    g2_id = [x[0] for x in g2] 
-    all_IDs = g1_id + g2_id
-    i1 = 0
-    i2 = 0
-
-    for ID, node in read_vector:
-        vec = 1.0 * np.array([smap[c] for c in node])
-        vec = vec[:, index]
-        m[ID] = vec
-        if ID in g1_id:
-            m1[i1][:] = vec
-            i1 += 1
-        if ID in g2_id:
-            m2[i2][:] = vec
-            i2 += 1
-        
-
-    g1_mean = np.mean(m1, 0)
-    g2_mean = np.mean(m2, 0)
-    group1 = []
-    group2 = []
-    for ID, vec in read_vector:
-        if ID not in m:
-            continue
-        s1 = np.sum( np.array(m[ID]) * g1_mean)
-        s2 = np.sum( np.array(m[ID]) * g2_mean)
-        if s1 > s2:
-            group1.append( (ID, vec) )
-        else:
-            group2.append( (ID, vec) )
-    return group1, group2 
+def regroup(m, labels, index, k = None, max_iterations = REGROUP_ITERATIONS):
+    """
+    Refine a grouping of the rows of a read-by-site matrix.  Each pass
+    scores every read against the mean row (centroid) of every group over
+    the sites in 'index', as one matrix product, and moves it to the group
+    it agrees with most, the later group winning ties.  Passes repeat
+    until no read moves or max_iterations is reached.  'labels' holds a
+    group number in 0..k-1 for each row; the refined labels are returned.
+    """
+    x = m[:, index].astype(np.float64)
+    labels = np.asarray(labels, dtype=np.int64)
+    if k is None:
+        k = max(int(labels.max()) + 1 if len(labels) else 0, 2)
+    for iteration in xrange(max_iterations):
+        members = np.zeros((len(labels), k))
+        members[np.arange(len(labels)), labels] = 1.0
+        sizes = members.sum(0)
+        # Dividing the integer dot products by the group sizes only at the
+        # end keeps exactly tied scores equal
+        scores = np.dot(x, np.dot(members.T, x).T) / np.maximum(sizes, 1)
+        # An empty group attracts no reads
+        scores[:, sizes == 0] = -np.inf
+        # argmax keeps the first maximum, so search the groups in reverse
+        updated = k - 1 - np.argmax(scores[:, ::-1], axis=1)
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+    return labels 
 
 class Clusense( object ):
     
@@ -226,7 +301,11 @@ class Clusense( object ):
                        nproc=NPROC,
                        prefix=PREFIX, 
                        min_group=MIN_GROUP,
-                       max_coverage=MAX_COVERAGE):
+                       max_coverage=MAX_COVERAGE,
+                       scratch_dir=None,
+                       compress_intermediates=False,
+                       collapse_zmws='none',
+                       partition_tree=False):
         log.info('Initializing Clusense')
         self.read_file = read_file
         self.ref_file = ref_file
@@ -237,9 +316,18 @@ class Clusense( object ):
         self.prefix = prefix 
         self.min_group = min_group
         self.max_coverage = max_coverage
+        self.compress_intermediates = compress_intermediates
+        self.collapse_zmws = collapse_zmws
+        self.partition_tree = partition_tree
+        self.read_weights = {}
         # Validate and run
         self._validate_args()
-        self.run()
+        # Intermediate files go to a scratch space, removed even on SIGINT
+        self.scratch = ScratchSpace( scratch_dir, prefix='clusense_' )
+        try:
+            self.run()
+        finally:
+            self.scratch.cleanup()
 
     def _validate_args(self):
         # Check the output directory, and create it if needed
@@ -266,7 +354,17 @@ class Clusense( object ):
         log.debug('\tMin Size: %s' % self.min_group)
 
     def run(self):
-        tmp_cns = os.path.join( self.output_dir, "tmp_cns.fa")
+        # The reads and reference may be compressed, but blasr and the
+        # alignment graph only read plain Fasta
+        self.read_file = plain_fasta( self.read_file, self.scratch.path( "reads.fa", os.path.getsize(self.read_file) ) )
+        self.ref_file = plain_fasta( self.ref_file, self.scratch.path( "reference.fa", os.path.getsize(self.ref_file) ) )
+        if self.collapse_zmws != 'none':
+            # Separate one unit per ZMW, weighted by its number of subreads
+            units_file = self.scratch.path( "zmw_units.fa" )
+            self.read_weights = write_units( collapse_zmws( read_fasta(self.read_file), self.collapse_zmws ), units_file )
+            log.info("Collapsed %s subreads into %s ZMW units" % (sum(self.read_weights.values()), len(self.read_weights)))
+            self.read_file = units_file
+        tmp_cns = self.scratch.slot( "tmp_cns.fa" )
 
         log.info("Generating initial consensus")
         get_consensus( self.read_file, 
@@ -299,62 +397,173 @@ class Clusense( object ):
         cns = os.path.join( self.output_dir, "group_root_cns.fa")
         write_fasta( cns, "group_root_cns", seq )
             
-        score = os.path.join( self.output_dir, "group_root.score")
-        with open(score,"w") as f:
-            for i in range(len(seq)):
-                print >>f, i, seq[i], " ".join([str(c) for c in c_data[i]]), 1.0*c_data[i][0]/(c_data[i][3]+1)
+        write_scores( os.path.join( self.output_dir, "group_root.score"), seq, c_data )
 
-        r_ids = read_fasta_names( self.read_file )
-            
-        level2_group = self.level2_partition(r_ids, self.read_file, self.ref_file)
+        if self.partition_tree:
+            with ReadStore( self.read_file ) as store:
+                level2_group = self.partition_tree_leaves( store, seq )
+        else:
+            r_ids = read_fasta_names( self.read_file )
+            level2_group = self.level2_partition(r_ids, self.read_file, self.ref_file)
         log.info("-------------------")
-        s = 0
-        group_id = 1
 
+        # Write every group's reads in one pass over the input; the
+        # alignment graph needs plain Fasta, so compressed groups also get
+        # a plain copy in scratch
+        outputs, read_files = [], []
+        for group_id in range(1, len(level2_group)+1):
+            out_read_file = os.path.join( self.output_dir, "group_%02d.fa" % group_id )
+            if self.compress_intermediates:
+                plain_file = self.scratch.path( "group_%02d.fa" % group_id )
+                outputs.append( [out_read_file + ".gz", plain_file] )
+                read_files.append( plain_file )
+            else:
+                outputs.append( [out_read_file] )
+                read_files.append( out_read_file )
+        with ReadStore( self.read_file ) as store:
+            store.demultiplex( [ group[0] for group in level2_group ], outputs )
+
+        sizes = [ self.read_count(id_set) for id_set, seq, c_data, status in level2_group ]
+        workers = max( 1, min( self.nproc, len(level2_group) ) )
+        tasks = [ GroupTask( group_id, read_files[group_id-1], seq, self.output_dir, self.prefix,
+                             self.max_coverage, max(1, self.nproc // workers) )
+                  for group_id, (id_set, seq, c_data, status) in enumerate( level2_group, 1 ) ]
+
+        # Groups are finalized in parallel; each summary line is written as
+        # soon as its group and every group before it are complete
         summary_f = open(os.path.join( self.output_dir, "summary.txt" ), "w")
+        complete = set()
+        next_group = 1
+        for group_id in self.finalize_groups( tasks, workers ):
+            complete.add( group_id )
+            while next_group in complete:
+                print >> summary_f, "group_%02d" % next_group, sizes[next_group-1]
+                summary_f.flush()
+                next_group += 1
+        print >> summary_f, "total", sum(sizes)
+        summary_f.close()
 
-        for id_set, seq, c_data, status in level2_group:
-            out_read_file =  os.path.join( self.output_dir, "group_%02d.fa" % group_id )
-            fetch_read(self.read_file, out_read_file, id_set)
-            cns = os.path.join( self.output_dir, "group_%02d_cns.fa" % group_id )
+    def finalize_groups(self, tasks, workers):
+        """
+        Run finalize_group on every task, in a pool of 'workers' processes
+        when there is more than one, yielding group numbers as they finish
+        """
+        if workers <= 1:
+            for task in tasks:
+                yield finalize_group( task )
+            return
+        pool = multiprocessing.Pool( workers )
+        try:
+            for group_id in pool.imap_unordered( finalize_group, tasks ):
+                yield group_id
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+
+    def read_count(self, read_ids):
+        """
+        Number of subreads behind a set of reads or collapsed ZMW units
+        """
+        return sum( self.read_weights.get(r, 1) for r in read_ids )
+
+    def partition_tree_leaves(self, store, root_consensus):
+        """
+        The groups of level2_partition, found without intermediate read
+        files: the reads stay in 'store' and each node of the partition
+        tree holds the positions of its reads there.  With more than one
+        core, nodes are processed by a TreePool sharing the cores between
+        tree nodes and their alignment threads.
+        """
+        root = PartitionNode( np.arange(len(store)), root_consensus, 0 )
+        if self.nproc > 1:
+            pool = TreePool( lambda node, threads: self.partition_node( store, node, threads ), self.nproc )
+            try:
+                level2_group = pool.run( root )
+            except:
+                pool.terminate()
+                raise
+            pool.close()
+            return level2_group
+        level2_group = []
+        stack = [ root ]
+        while stack:
+            node = stack.pop()
+            leaf, children = self.partition_node( store, node )
+            if leaf is not None:
+                level2_group.append( leaf )
+            # Depth first, children in order, as level2_partition recurses
+            stack.extend( reversed(children) )
+        return level2_group
 
-            with open(cns,"w") as f:
-                print >>f, ">group_%02d_cns" % group_id
-                print >>f, seq
+    def partition_node(self, store, node, nproc=None):
+        """
+        Refine the consensus of one partition tree node, starting from its
+        parent's, and split its reads.  Returns the (read ids, consensus,
+        coverage data, status) leaf when the node is not split, or its
+        child nodes.  Alignments use 'nproc' threads, by default all.
+        """
+        nproc = nproc or self.nproc
+        log.info("s: depth {0}, {1} reads".format(node.depth, len(node.indices)))
+        # blasr and the alignment graph read Fasta files, so the node is
+        # written to scratch files that every node reuses
+        read_file = self.scratch.slot( "node_reads.fa" )
+        store.write_indices( node.indices, read_file )
+        seed_file = self.scratch.slot( "node_seed.fa" )
+        write_fasta( seed_file, "tmp_cns", node.consensus )
+        tmp_cns = self.scratch.slot( "node_cns.fa" )
+
+        get_consensus( read_file,
+                       seed_file,
+                       tmp_cns,
+                       "tmp_cns",
+                       self.entropy,
+                       hp_correction = False,
+                       min_iteration = SEEDED_ITERATIONS,
+                       max_num_reads = 150,
+                       entropy_th = 0.65,
+                       min_cov = 8,
+                       max_cov = 200,
+                       nproc = nproc,
+                       mark_lower_case = False,
+                       use_read_id = False )
 
-            aln_g = construct_aln_graph_from_fasta(out_read_file, 
-                                                   cns, 
-                                                   max_num_reads = self.max_coverage,
-                                                   max_cov = self.max_coverage, 
-                                                   remove_in_del = False, 
-                                                   nproc = self.nproc, 
-                                                   use_read_id = False)
-            seq, c_data = aln_g.generate_consensus(min_cov=0, compute_qv_data= True)
-
-            with open(cns,"w") as f:
-                print >>f, ">%s_group_%02d_cns" % (self.prefix, group_id)
-                print >>f, seq
-                
-            score = c_data
+        aln_g = construct_aln_graph_from_fasta(read_file,
+                                                tmp_cns,
+                                                max_num_reads = self.max_coverage,
+                                                max_cov = self.max_coverage,
+                                                remove_in_del = True,
+                                                nproc = nproc,
+                                                use_read_id=True)
+        seq, c_data = aln_g.generate_consensus(min_cov=0)
+        read_ids = set( store.names_at( node.indices ) )
 
-            score = os.path.join( self.output_dir, "group_%02d.score" % group_id )
-            with open(score,"w") as f:
-                for i in range(len(seq)):
-                    print >>f, i, seq[i], " ".join([str(c) for c in c_data[i]]), 1.0*c_data[i][0]/(c_data[i][3]+1)
+        # Check for end conditions
+        if self.read_count(read_ids) < self.min_group:
+            log.info("group element < %d, not splitting" % self.min_group)
+            return ( read_ids, seq, c_data, "-" ), []
+        sites = read_site_matrix(aln_g, self.entropy, entropy_th = self.entropy)
+        if len(sites.read_ids) == 0:
+            log.info("not high entropy node cnd#1, not splitting")
+            return ( read_ids, seq, c_data, "+" ), []
+        if sites.matrix.shape[1] == 0:
+            log.info("not high entropy node cnd#2, not splitting")
+            return ( read_ids, seq, c_data, "+" ), []
 
-            print >> summary_f, "group_%02d" % group_id, len(id_set)
-            s += len(id_set)
-            group_id += 1
-        print >> summary_f, "total", s
-        summary_f.close()
+        read_groups = self.partition_reads(sites.read_ids, sites.matrix, 0)
+        if len(read_groups) == 1:
+            log.info("level 1 splitting fail, not splitting")
+            return ( read_ids, seq, c_data, "+" ), []
+        return None, [ PartitionNode( store.indices( rg[1] ), seq, node.depth+1 ) for rg in read_groups ]
 
-    def level2_partition(self, read_ids, read_file, ref_file):
+    def level2_partition(self, read_ids, read_file, ref_file, depth=0):
 
         level2_group = []
 
         log.info("s: {0}".format(os.path.basename(read_file)))
         ignore_indel = False
-        tmp_cns = os.path.join( self.output_dir, "tmp_cns.fa")
+        tmp_cns = self.scratch.slot( "tmp_cns.fa" )
 
         get_consensus( read_file, 
                        ref_file, 
@@ -382,27 +591,21 @@ class Clusense( object ):
         seq, c_data = aln_g.generate_consensus(min_cov=0)
 
         # Check for end conditions
-        if len(read_ids) < self.min_group:
+        if self.read_count(read_ids) < self.min_group:
             log.info("group element < %d, not splitting" % self.min_group)
             level2_group.append( ( read_ids, seq, c_data, "-" ) )
             return level2_group
-        rv, hen = read_node_vector(aln_g, self.entropy, entropy_th = self.entropy)
-        if len(rv) == 0:
+        sites = read_site_matrix(aln_g, self.entropy, entropy_th = self.entropy)
+        if len(sites.read_ids) == 0:
             log.info("not high entropy node cnd#1, not splitting")
             level2_group.append( ( read_ids, seq, c_data, "+" ) )
             return level2_group
-        if len(rv.values()[0]) == 0:
+        if sites.matrix.shape[1] == 0:
             log.info("not high entropy node cnd#2, not splitting")
             level2_group.append( ( read_ids, seq, c_data, "+" ) )
             return level2_group
 
-        aln_data = []
-        for r in rv:
-            aln_data.append( (r, "".join(rv[r])) )
-        aln_data.sort(key=lambda x: x[1][0])
-        aln_data.reverse()
-
-        read_groups = self.partition_reads(aln_data, 0)
+        read_groups = self.partition_reads(sites.read_ids, sites.matrix, 0)
         #print sum([len(rg[1]) for rg in read_groups]), [ ( rg[0], len(rg[1]) ) for rg in read_groups ]
 
         if len(read_groups) == 1:
@@ -412,37 +615,30 @@ class Clusense( object ):
 
         group_id = 0
         for rg in read_groups:
-            r_ids = set() 
-            rd = rg[1]
-            for r, d in rd:
-                r_ids.add( r )
-
-            f = FastaReader(read_file)
-            tmp_hash = hash( "%s_%d" % (read_file, group_id) )
-            read_out_file = os.path.join( self.output_dir, "tmp_reads_%d.fa"  % tmp_hash )
+            r_ids = set( rg[1] )
+
+            # Each subgroup is fully processed before its sibling is written,
+            # so one pair of files per recursion depth is enough
+            read_out_file = self.scratch.slot( "tmp_reads_%d.fa" % (depth+1) )
             fetch_read(read_file, read_out_file, r_ids)
 
-            tmp_cns = os.path.join( self.output_dir, "tmp_cns_%s.fa" % tmp_hash )
+            tmp_cns = self.scratch.slot( "tmp_cns_%d.fa" % (depth+1) )
             with open(tmp_cns,"w") as f:
                 print >>f, ">tmp_cns"
                 print >>f, seq
 
             group_id += 1
-            level2_group.extend( self.level2_partition(r_ids, read_out_file, tmp_cns, ) )
+            level2_group.extend( self.level2_partition(r_ids, read_out_file, tmp_cns, depth+1) )
         return level2_group
 
-    def partition_reads(self, read_vector, g_id):
+    def partition_reads(self, read_ids, m, g_id):
+        """
+        Recursively split reads on the sites of their read-by-site matrix,
+        returning (group id, read ids, matrix rows) for each final group
+        """
         log.info("partition group: {0}".format(g_id))
-        if len(read_vector) < self.min_group:
-            return (("%d" % g_id, read_vector), )
-        
-        smap = {"A":1,"C":1,"G":1,"T":1,"*":-1," ":0}
-        
-        m = np.zeros( (len(read_vector), len(read_vector[0][1])) )
-        i = 0
-        for ID, node in read_vector:
-            m[i] = [smap[c] for c in node]
-            i += 1
+        if self.read_count( read_ids ) < self.min_group:
+            return (("%d" % g_id, read_ids, m), )
 
         pos_candidates = []
         ce = col_entropy(m)
@@ -462,35 +658,31 @@ class Clusense( object ):
         #total_index.sort()
         log.info("number_of_candidate: {0}".format(len(total_index)))
 
-        partition_scores = []
-        for pos in pos_candidates:
-            partition_scores.append( ( (partition_score(m, pos, total_index), -ce[pos]), pos) )
+        scores = score_partitions(m, pos_candidates, total_index)
+        partition_scores = [ ( (scores[i], -ce[pos]), pos) for i, pos in enumerate(pos_candidates) ]
         partition_scores.sort()
        
         if len(partition_scores) == 0:
-            return (("%d" % g_id, read_vector, m), )
-        log.info(str(len(read_vector)) + " " + str(partition_scores[0]))
+            return (("%d" % g_id, read_ids, m), )
+        log.info(str(len(read_ids)) + " " + str(partition_scores[0]))
         log.info("------------------")
         if partition_scores[0][0][0] > 0:
-            return (("%d" % g_id, read_vector, m), )
+            return (("%d" % g_id, read_ids, m), )
         
         #rtn = ["groups_%d" % g_id]
         rtn = []
-        group1 = []
-        group2 = []
+        # Reads not covering the split site drop out
         split_pos = partition_scores[0][1]
-        for rid, vec in read_vector:
-            if vec[split_pos] == "*":
-                group1.append( (rid, vec) )
-            elif vec[split_pos] in ("A", "C", "G", "T"):
-                group2.append( (rid, vec) )
-        group1, group2 = regroup(group1, group2, total_index)
-
-        if len(group1) < self.min_group or len(group2) < self.min_group:
-            return (("%d" % g_id, read_vector, m), )
+        covered = np.flatnonzero( m[:, split_pos] != SITE_UNCOVERED )
+        labels = regroup(m[covered], m[covered, split_pos] == SITE_BASE, total_index, k = 2)
+        group1, group2 = covered[labels == 0], covered[labels == 1]
+
+        if self.read_count( read_ids[i] for i in group1 ) < self.min_group or \
+           self.read_count( read_ids[i] for i in group2 ) < self.min_group:
+            return (("%d" % g_id, read_ids, m), )
         else:
-            rtn.extend( self.partition_reads(group1, g_id * 2 + 1 ) )
-            rtn.extend( self.partition_reads(group2, g_id * 2 + 2 ) )
+            rtn.extend( self.partition_reads([ read_ids[i] for i in group1 ], m[group1], g_id * 2 + 1 ) )
+            rtn.extend( self.partition_reads([ read_ids[i] for i in group2 ], m[group2], g_id * 2 + 2 ) )
         return rtn
         
 if __name__ == "__main__":
@@ -529,6 +721,18 @@ if __name__ == "__main__":
     add("-e", "--entropy", 
         type=float,
         help=argparse.SUPPRESS)
+    add("--scratch_dir",
+        help="Directory for intermediate files (/dev/shm when available)")
+    add("--collapse_zmws",
+        default='none',
+        choices=ZMW_MODES,
+        help="Collapse the subreads of each ZMW into its best subread or their consensus (none)")
+    add("--partition_tree",
+        action='store_true',
+        help="Split groups in memory, seeding each subgroup's consensus from its parent's")
+    add("--compress_intermediates",
+        action='store_true',
+        help="Write the group_NN.fa read files BGZF compressed")
     add("--debug",
         action='store_true',
         help="Enable logging of Debug messages")
@@ -550,4 +754,8 @@ if __name__ == "__main__":
               args.nproc,
               args.prefix, 
               args.min_group,
-              args.max_coverage )
+              args.max_coverage,
+              args.scratch_dir,
+              args.compress_intermediates,
+              args.collapse_zmws,
+              args.partition_tree )
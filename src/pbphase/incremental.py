@@ -0,0 +1,175 @@
+import itertools
+
+import numpy as np
+
+from collections import namedtuple
+from math import log
+
+template_info = namedtuple("template_info", "sequence, numerator, denominator")
+
+BASES = "ACGTN"
+BASE_INDEX = dict( (b, i) for i, b in enumerate(BASES) )
+N_CODES = len(BASES)
+
+class ReadNodeIndex(object):
+    """
+    Shared node numbering for a fixed sample of alignments.
+
+    Every alignment tuple from get_aln_array is reduced once to the list of
+    graph nodes it passes through: one node per (backbone column, base) and
+    one per (backbone column, insertion offset, base).  Node ids for
+    aligned bases are column * 5 + base code; insertion nodes follow after
+    the 5 * len(backbone) base nodes.
+    """
+
+    def __init__(self, alns, backboneSeq):
+        self.backboneSeq = backboneSeq
+        self.length = len(backboneSeq)
+        self.backbone_codes = np.array([ BASE_INDEX.get(b, 4) for b in backboneSeq.upper() ], dtype=np.int64)
+        self.backbone_nodes = np.arange(self.length, dtype=np.int64) * N_CODES + self.backbone_codes
+        insertion_ids = {}
+        self.read_nodes = []
+        self.read_spans = []
+        for aln in alns:
+            nodes, span = self._project(aln, insertion_ids)
+            self.read_nodes.append( nodes )
+            self.read_spans.append( span )
+        n_insertions = len(insertion_ids)
+        self.n_nodes = self.length * N_CODES + n_insertions
+        self.insertion_pos = np.zeros( n_insertions, dtype=np.int64 )
+        self.insertion_rank = np.zeros( n_insertions, dtype=np.int64 )
+        self.insertion_base = np.zeros( n_insertions, dtype=np.int64 )
+        for (pos, rank, code), node in insertion_ids.iteritems():
+            i = node - self.length * N_CODES
+            self.insertion_pos[i] = pos
+            self.insertion_rank[i] = rank
+            self.insertion_base[i] = code
+
+    def _project(self, aln, insertion_ids):
+        (q_start, q_end, q_seq), (t_start, t_end, t_seq) = aln[0:2]
+        nodes = []
+        pos = t_start
+        rank = 0
+        for q_base, t_base in itertools.izip( q_seq, t_seq ):
+            if t_base == '-':
+                if q_base == '-':
+                    continue
+                key = (pos - 1, rank, BASE_INDEX.get(q_base.upper(), 4))
+                if key not in insertion_ids:
+                    insertion_ids[key] = self.length * N_CODES + len(insertion_ids)
+                nodes.append( insertion_ids[key] )
+                rank += 1
+                continue
+            rank = 0
+            if pos >= self.length:
+                break
+            if q_base != '-':
+                nodes.append( pos * N_CODES + BASE_INDEX.get(q_base.upper(), 4) )
+            pos += 1
+        return np.unique( np.array(nodes, dtype=np.int64) ), (t_start, min(pos, self.length))
+
+class IncrementalTemplate(object):
+    """
+    A live template for a changing group of reads from a ReadNodeIndex.
+
+    Adding or removing one read updates the node and column coverage in
+    O(alignment length); a consensus and both entropy measures are then
+    read off the counts without building a new alignment graph.  These
+    approximate make_template_from_alns rather than reproduce it: the
+    consensus is a majority vote, the entropy counts reads per node
+    instead of per in-edge, and no read limit is applied.
+    """
+
+    def __init__(self, node_index, members=()):
+        self.index = node_index
+        self.counts = np.zeros( node_index.n_nodes, dtype=np.int64 )
+        self.coverage = np.zeros( node_index.length, dtype=np.int64 )
+        self.members = set()
+        for i in members:
+            self.add(i)
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, i):
+        assert i not in self.members
+        self.members.add(i)
+        self.counts[self.index.read_nodes[i]] += 1
+        start, end = self.index.read_spans[i]
+        self.coverage[start:end] += 1
+
+    def remove(self, i):
+        self.members.remove(i)
+        self.counts[self.index.read_nodes[i]] -= 1
+        start, end = self.index.read_spans[i]
+        self.coverage[start:end] -= 1
+
+    def consensus(self):
+        """
+        Majority consensus: each covered column emits its most common base
+        unless most reads delete it, and an inserted base is emitted when
+        more than half of the reads covering the column carry it
+        """
+        idx = self.index
+        length = idx.length
+        base_counts = self.counts[:length * N_CODES].reshape( (length, N_CODES) )
+        best = np.argmax( base_counts, 1 )
+        best_count = base_counts[np.arange(length), best]
+        deleted = self.coverage - base_counts.sum(1)
+        codes = np.where( self.coverage == 0, idx.backbone_codes, best )
+        keep = (self.coverage == 0) | (best_count >= deleted)
+        columns = [ BASES[c] if k else '' for c, k in itertools.izip( codes.tolist(), keep.tolist() ) ]
+
+        ins_counts = self.counts[length * N_CODES:]
+        passing = np.nonzero( 2 * ins_counts > self.coverage[np.clip(idx.insertion_pos, 0, length - 1)] )[0]
+        if len(passing):
+            inserted = {}
+            for i in passing.tolist():
+                key = (int(idx.insertion_pos[i]), int(idx.insertion_rank[i]))
+                if key not in inserted or ins_counts[i] > inserted[key][0]:
+                    inserted[key] = (ins_counts[i], BASES[idx.insertion_base[i]])
+            prefix = []
+            for (pos, rank) in sorted(inserted):
+                if pos < 0:
+                    prefix.append( inserted[(pos, rank)][1] )
+                else:
+                    columns[pos] += inserted[(pos, rank)][1]
+            columns.insert( 0, ''.join(prefix) )
+        return ''.join(columns)
+
+    def entropy_terms(self, combo_entropy=True):
+        """
+        Approximate the (numerator, denominator) pair make_template_from_alns
+        computes from the alignment graph, using node read counts in place
+        of the in-edge counts
+        """
+        n_reads = len(self.members)
+        counts = self.counts
+        present = counts > 0
+        if n_reads <= 1:
+            ### special case of a set of one read, consider the backbone to be a read
+            present = present.copy()
+            present[self.index.backbone_nodes] = True
+        if combo_entropy:
+            denominator = int(np.sum( present ))
+            numerator = int(np.sum( present & (counts < n_reads) ))
+            return numerator, denominator
+        n = float(n_reads + 1)
+        covered = counts[present & (counts > 0)]
+        numerator = float(np.sum( -1 * (1 / n) * np.log( covered / n ) ))
+        denominator = (-1 * log(1 / n) * (1 / n) * float(self.index.length) * n)
+        return numerator, denominator
+
+    def template(self, combo_entropy=True):
+        numerator, denominator = self.entropy_terms( combo_entropy )
+        return template_info._make( [self.consensus(), numerator, denominator] )
+
+def gray_code_flips( n ):
+    """
+    Yield the index of the read that changes side at each step of a
+    reflected Gray code over the n-1 reads after read 0, which is pinned
+    to the first side.  Every bipartition is visited exactly once.
+    """
+    for step in xrange(1, 1 << (n - 1)):
+        bit = (step & -step).bit_length() - 1
+        yield bit + 1
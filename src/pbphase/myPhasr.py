@@ -43,6 +43,7 @@ import shutil
 import random
 import string
 import tempfile
+import threading
 
 from math import floor, log, ceil
 from collections import namedtuple
@@ -52,6 +53,17 @@ from pbtools.pbdagcon.aligngraph import *
 from pbtools.pbdagcon.utils import *
 
 from myPhasrUtils import *
+from aligner import align_pair, overlap_sequences
+from splitsearch import search_split, SPLIT_SEARCH_MODES
+from workers import FeaturePool, ProcessBudget, SubsetScheduler
+from cache import ConsensusCache, fasta_consensus_key
+from sampling import AdaptiveSampler, PriorityReservoir, default_wave_size
+from readstore import ReadStore
+from alntable import AlignmentTable
+from scratch import ScratchSpace
+from seqio import read_fasta, plain_fasta
+from blasrio import stream_blasr, blasr_lines, load_m5
+from zmw import group_zmws, build_unit, write_units, ZMW_MODES
 
 __p4revision__ = ""
 __p4change__ = ""
@@ -61,9 +73,15 @@ __version__ = "0.1.0"
 
 rmap = dict(zip("ACGTN-","TGCAN-"))
 fastar = namedtuple('fastar', 'name, sequence')
+FeatureResult = namedtuple('FeatureResult', 'name, metric, entropy, pctsimilarity, mismatch, insertion, deletion, aln_portion, flag, h1_con, h2_con, h1_reads, h2_reads')
+
+def rank_feature(feature):
+    ### features with the most balanced read groups are tried first
+    aln_sizes = sorted([len(feature.h1_reads), len(feature.h2_reads)])
+    return float(aln_sizes[1])/float(aln_sizes[0])
 
 class Feature(object):
-    def __init__(self, name, tmp_dir):
+    def __init__(self, name, tmp_dir, scratch = None):
 	self.name = name
 	self.metric = 0
 	self.pctsimilarity = 0
@@ -82,6 +100,7 @@ class Feature(object):
 	self.aln_portion = None
 	self.flag=0 ## feature is considered dead if flag = 1	
 	self.tmp_dir = tmp_dir
+	self.scratch = scratch
 
     def __str__(self):
 	output=[]	
@@ -94,21 +113,43 @@ class Feature(object):
 	if self.insertion:
 	    output.append("(MM: %s, ID: %s)" % (self.mismatch, (self.insertion+self.deletion) ) ) 
 	output.append("Len: ( %s, %s )" % (len(self.h1_con), len(self.h2_con) ) )
-	output.append("Size: ( %s, %s )" % (len(self.h1_alns), len(self.h2_alns) ) )
+	output.append("Size: ( %s, %s )" % (len(self.h1_reads), len(self.h2_reads) ) )
 	if self.flag:
 	    output.append("Flagged")
 	string = " ".join(output)
 	return string
 
+    def align_to_haplotypes(self, fasta_fn, seqs_fn, nproc = 1):
+	### assign every read to its closest haplotype; blasr's m5 output is loaded into
+	### columns straight from the pipe and split between h1 and h2 by target
+	hits = load_m5( blasr_lines(fasta_fn, seqs_fn, 5, "-bestn 1 -nproc %s" % nproc), strip_query_names = False, sequences = True )
+	self.h1_alns = get_aln_array( hits.rows("h1"), max_num_reads=9999)
+	self.h2_alns = get_aln_array( hits.rows("h2"), max_num_reads=9999)
+	self.update_read_names()
+
+    def update_read_names(self):
+	self.h1_reads = [ x[2] for x in self.h1_alns ]
+	self.h2_reads = [ x[2] for x in self.h2_alns ]
+
+    def to_result(self):
+	### compact, picklable summary of the feature for returning from a worker
+	return FeatureResult._make( [ self.name, self.metric, self.entropy, self.pctsimilarity,
+				      self.mismatch, self.insertion, self.deletion, self.aln_portion,
+				      self.flag, self.h1_con, self.h2_con, self.h1_reads, self.h2_reads ] )
+
+    @classmethod
+    def from_result(cls, result, tmp_dir, scratch = None):
+	feature = cls(result.name, tmp_dir, scratch)
+	for field in FeatureResult._fields:
+	    setattr(feature, field, getattr(result, field))
+	return feature
+
     def refine(self, fasta_fn, n_iter):
 	assert n_iter > 0
 	for i in xrange(n_iter):	
 	    if self.flag: continue
-	    seqs_fn = self.write_seqs(self.tmp_dir, split=False)
-	    tmp_fn = os.path.join( self.tmp_dir, (self.name+"_alignment.m5") )
-	    subprocess.check_output("blasr -bestn 1 -m 5 %s %s -out %s" % (fasta_fn, seqs_fn, tmp_fn), shell=True )
-	    self.h1_alns = get_aln_array( simple_align_hit_iterator(tmp_fn, "h1" ), max_num_reads=9999)	
-	    self.h2_alns = get_aln_array( simple_align_hit_iterator(tmp_fn, "h2" ), max_num_reads=9999)
+	    seqs_fn = self.write_seqs(None, split=False)
+	    self.align_to_haplotypes(fasta_fn, seqs_fn)
 	    new_h1_consensus = make_template_from_alns( self.h1_alns, self.h1_con, combo_entropy = False)
 	    new_h2_consensus = make_template_from_alns( self.h2_alns, self.h2_con, combo_entropy = False)
 	    self.h1_backbone = self.h1_con; self.h2_backbone = self.h2_con
@@ -118,48 +159,36 @@ class Feature(object):
 	    self.entropy = (new_h1_consensus.numerator + new_h2_consensus.numerator )/float(new_h1_consensus.denominator + new_h2_consensus.denominator)
 	    self.metric = (self.entropy*self.pctsimilarity)
 
-	    ### cleanup
-	    os.remove(tmp_fn)
-	    os.remove(seqs_fn)
+	    ### cleanup, scratch slots are reused instead
+	    if self.scratch is None:
+		os.remove(seqs_fn)
 	return 0
 
-    def finalize(self, fasta_fn, backbone, n_refinement):
+    def finalize(self, fasta_fn, backbone, n_refinement, consensus_fn = get_good_consensus, compress = False, nproc = 1):
 	assert os.path.isfile(fasta_fn)
 	if self.flag: return 0	
-	seqs_fn = self.write_seqs(self.tmp_dir, split=False)
-	tmp_fn = os.path.join( self.tmp_dir, (self.name+"_alignment.m5") )
-	subprocess.check_output("blasr -bestn 1 -m 5 %s %s -out %s" % (fasta_fn, seqs_fn, tmp_fn), shell=True )
-	self.h1_alns = get_aln_array( simple_align_hit_iterator(tmp_fn, "h1" ), max_num_reads=9999)
-	self.h2_alns = get_aln_array( simple_align_hit_iterator(tmp_fn, "h2" ), max_num_reads=9999)	
-
-	### write out the reads
-	reads_h1_fn = os.path.join( self.tmp_dir, (self.name+"_h1_reads.fasta") )
-	read_names = [ x[2].split("/")[0] for x in self.h1_alns]
-	f=FastaReader(fasta_fn)
-	with open( reads_h1_fn, "w") as of:
-	    for r in f:
-		if r.name in read_names: 
-			print >>of, ">"+r.name
-			print >>of, r.sequence
-	reads_h2_fn = os.path.join( self.tmp_dir, (self.name+"_h2_reads.fasta") )
-	read_names = [ x[2].split("/")[0] for x in self.h2_alns]
-        f=FastaReader(fasta_fn)
-        with open( reads_h2_fn, "w") as of:
-            for r in f:
-                if r.name in read_names:
-                        print >>of, ">"+r.name
-                        print >>of, r.sequence
+	seqs_fn = self.write_seqs(None, split=False)
+	self.align_to_haplotypes(fasta_fn, seqs_fn, nproc)
+
+	### write out the reads, BGZF compressed if asked to
+	suffix = ".fasta.gz" if compress else ".fasta"
+	store = ReadStore(fasta_fn)
+	reads_h1_fn = self.output_file("_h1_reads"+suffix)
+	store.write_subset( [ x[2].split("/")[0] for x in self.h1_alns], reads_h1_fn, compress )
+	reads_h2_fn = self.output_file("_h2_reads"+suffix)
+	store.write_subset( [ x[2].split("/")[0] for x in self.h2_alns], reads_h2_fn, compress )
+	store.close()
 
 
 	self.h1_backbone = backbone
-	self.h1_con = get_good_consensus(self.h1_alns, backbone, reads_h1_fn, min_iteration = n_refinement)
+	self.h1_con = consensus_fn(self.h1_alns, backbone, reads_h1_fn, min_iteration = n_refinement, nproc = nproc)
 	self.h2_backbone = backbone	
-	self.h2_con = get_good_consensus(self.h2_alns, backbone, reads_h2_fn, min_iteration = n_refinement)
+	self.h2_con = consensus_fn(self.h2_alns, backbone, reads_h2_fn, min_iteration = n_refinement, nproc = nproc)
 	self.evaluate_pct_id()
 
-	### cleanup
-	os.remove(tmp_fn)
-	os.remove(seqs_fn)
+	### cleanup, scratch slots are reused instead
+	if self.scratch is None:
+	    os.remove(seqs_fn)
 
 	### return filenames of the reads
 	return reads_h1_fn, reads_h2_fn
@@ -168,47 +197,48 @@ class Feature(object):
 	### by normalize i mean cut the sequences down only to the overlapping portion. This will prevent contig
 	### effects for larger sequences, when reads from the same side cluster instead of from the same allele
 	if self.flag: return 0
-        if self.h1_con == self.h2_con:
-            self.flag = 1
-            return 0
-	seq_fns = self.write_seqs(self.tmp_dir, split=True)
-	try:
-	    alignment = parse_blasr( subprocess.check_output("blasr -bestn 1 %s %s -m 5" % (seq_fns[0], seq_fns[1]), shell=True), mode=5)
-	    alignment = alignment[0]
-	    self.h1_con = alignment.qseq.replace('-', '')	
-	    self.h2_con = alignment.tseq.replace('-', '')
-	except:
-            self.flag=1
-	    for fn in seq_fns:
-		os.remove(fn)
+	if self.h1_con == self.h2_con:
+	    self.flag = 1
 	    return 0
-        for fn in seq_fns:
-            os.remove(fn)	
+	alignment = align_pair(self.h1_con, self.h2_con, mode='semiglobal')
+	if alignment is None:
+	    self.flag=1
+	    return 0
+	self.h1_con, self.h2_con = overlap_sequences(alignment)
 
     def evaluate_pct_id(self):
 	if self.flag: return 0
 	if self.h1_con == self.h2_con: 
 	    self.flag = 1
 	    return 0
-	seq_fns = self.write_seqs(self.tmp_dir, split=True)
-	try:
-	    alignment = parse_blasr( subprocess.check_output("blasr -bestn 1 %s %s -m 4" % (seq_fns[0], seq_fns[1]), shell=True), mode=4)
-	    self.pctsimilarity = float(alignment[0].pctsimilarity)
-	    alignment = parse_blasr( subprocess.check_output("blasr -bestn 1 %s %s -m 5" % (seq_fns[0], seq_fns[1]), shell=True), mode=5)
-	    alignment = alignment[0]
-	    ### the percentage of mismatches due to ins, del, mismatch etc
-	    self.mismatch = float(alignment.nmis)/len(alignment.matchvector)
-	    self.insertion = float(alignment.nins)/len(alignment.matchvector)
-	    self.deletion = float(alignment.ndel)/len(alignment.matchvector)
-	    ### how long is the alignment compared to how long it *could* be
-	    self.aln_portion = ( len(alignment.matchvector) / float(min([ len(self.h1_con), len(self.h2_con) ])) )
-	except:
+	alignment = align_pair(self.h1_con, self.h2_con, mode='semiglobal')
+	if alignment is None:
 	    self.flag=1
-	for fn in seq_fns:
-	    os.remove(fn)
+	    return 0
+	self.pctsimilarity = alignment.pctsimilarity
+	### the percentage of mismatches due to ins, del, mismatch etc
+	self.mismatch = alignment.mismatch
+	self.insertion = alignment.insertion
+	self.deletion = alignment.deletion
+	### how long is the alignment compared to how long it *could* be
+	self.aln_portion = ( alignment.aln_length / float(min([ len(self.h1_con), len(self.h2_con) ])) )
 	
+    def scratch_file(self, suffix):
+	### a scratch slot reused by this worker if a ScratchSpace was given, otherwise
+	### a file named after the feature in tmp_dir
+	if self.scratch is not None:
+	    return self.scratch.slot(suffix.lstrip("_"))
+	return os.path.join(self.tmp_dir, self.name+suffix)
+
+    def output_file(self, suffix):
+	### a file named after the feature, in the scratch space if one was given
+	if self.scratch is not None:
+	    return self.scratch.path(self.name+suffix)
+	return os.path.join(self.tmp_dir, self.name+suffix)
+
     def write_seqs(self, outdir, split = True):
-	assert os.path.isdir(outdir)
+	### with outdir None the unsplit sequences go to a scratch file
+	assert outdir is None or os.path.isdir(outdir)
 	if split:
 	    with open(os.path.join(outdir, (self.name+"_h1_con.fasta")), "w") as of:
 		print >>of, ">h1"
@@ -218,12 +248,16 @@ class Feature(object):
 		print >>of, self.h2_con
 	    return ( os.path.join(outdir, (self.name+"_h1_con.fasta") ), os.path.join(outdir, (self.name+"_h2_con.fasta") ) )
 	elif not split:
-	    with open(os.path.join(outdir, (self.name+"_h_con.fasta")), "w") as of:
+	    if outdir is None:
+		seqs_fn = self.scratch_file("_h_con.fasta")
+	    else:
+		seqs_fn = os.path.join(outdir, (self.name+"_h_con.fasta"))
+	    with open(seqs_fn, "w") as of:
 		print >>of, ">h1"
                 print >>of, self.h1_con
 		print >>of, ">h2"
                 print >>of, self.h2_con
-	    return os.path.join(outdir, (self.name+"_h_con.fasta"))
+	    return seqs_fn
 
 class Phasr(object):
     """
@@ -253,6 +287,40 @@ class Phasr(object):
 	add('--sample_number', type=int, default=6,
 	                    dest='sample_number', metavar='6',
 	                    help='The maximum number of reads used for consensus')
+	add('--adaptive_sampling', action='store_true', dest='adaptive_sampling',
+	                    help='Run feature samples in waves, stopping early once the ' + \
+	                    'best feature converges and running more (up to ' + \
+	                    '--max_sample_number) while features disagree.')
+	add('--sample_wave', type=int, default=None,
+	                    dest='sample_wave', metavar='2',
+	                    help='Number of samples per wave in adaptive mode. ' + \
+	                    'Defaults to a third of --sample_number, at most --max_num_proc; ' + \
+	                    'sampling can only stop early with waves well below --sample_number.')
+	add('--max_sample_number', type=int, default=None,
+	                    dest='max_sample_number', metavar='24',
+	                    help='Upper limit on samples in adaptive mode. ' + \
+	                    'Defaults to 4 x --sample_number.')
+	add('--split_search', default='exhaustive', choices=SPLIT_SEARCH_MODES,
+	                    dest='split_search',
+	                    help='Strategy for searching the splits of each read sample: ' + \
+	                    'exhaustive, every split ranked by approximate incremental templates ' + \
+	                    'with the best few scored exactly (gray), a best-first heuristic capped at ' + \
+	                    '--max_split_evaluations (bestfirst) or greedy with local swaps. ' + \
+	                    'Use bestfirst or greedy for large --sample_size.')
+	add('--max_split_evaluations', type=int, default=None,
+	                    dest='max_split_evaluations', metavar='64',
+	                    help='Maximum number of splits scored per sample. ' + \
+	                    'Unlimited for exhaustive search, 64 otherwise.')
+	add('--collapse_zmws', default='none', choices=ZMW_MODES,
+	                    dest='collapse_zmws',
+	                    help='Collapse the subreads of each ZMW (movie/zmw/start_end) ' + \
+	                    'into one unit before phasing: the subread closest to the ' + \
+	                    'median length (best) or their consensus (consensus). ' + \
+	                    'Cluster sizes still count subreads.')
+	add('--template_sample_size', type=int, default=None,
+	                    dest='template_sample_size', metavar='1000',
+	                    help='In de novo mode (no --ref_fn), only consider a random ' + \
+	                    'sample of this many reads as the template. All reads by default.')
 	add('--min_cluster_size', type=int, default=10, 
 	                    dest='min_cluster_size', metavar='10', 
 	                    help='The minimum number of reads needed to define a cluster.')
@@ -278,11 +346,29 @@ class Phasr(object):
 	add('--score_floor', type=float, default=0.0, 
 	                    dest = 'score_floor', metavar='0.0', 
 	                    help='Min percent id for construction of Max Divergent Features.')
+	add('--cache_dir', default=None, dest='cache_dir', metavar='DIR',
+	                    help='Directory of a persistent consensus cache, keyed by ' + \
+	                    'the reads, backbone and settings. May be shared by ' + \
+	                    'concurrent runs on one machine. Disabled by default.')
+	add('--cache_size', type=int, default=512, dest='cache_size', metavar='512',
+	                    help='Size cap of the consensus cache in megabytes.')
+	add('--scratch_dir', default=None, dest='scratch_dir', metavar='DIR',
+	                    help='Directory for intermediate files. Defaults to ' + \
+	                    '/dev/shm when available, otherwise the system temp directory.')
+	add('--scratch_quota', type=int, default=1024, dest='scratch_quota', metavar='1024',
+	                    help='Megabytes of intermediate files kept in the scratch ' + \
+	                    'directory before new ones are written to disk instead.')
+	add('--compress_intermediates', action='store_true', dest='compress_intermediates',
+	                    help='Write the read subsets of each split BGZF compressed. ' + \
+	                    'The input and reference may be plain, gzip or BGZF Fasta.')
 	add('--log', action='store_true', dest='log', 
 	                    help = 'Create log file.')
 	add('--max_input_reads', type=int, default=400, 
 	                    dest='max_input_reads', metavar='400', 
 	                    help='Maximum number of reads to use')
+	add('--seed', type=int, default=None, dest='seed', metavar='INT',
+	                    help='Seed for the random choice of input reads and of ' + \
+	                    'feature samples, for reproducible runs.')
 	add('--min_read_length', type=int, default=500, 
 	                    dest='min_read_length', metavar='500',
 	                    help = 'Minimum read size' )
@@ -290,7 +376,8 @@ class Phasr(object):
 	                    dest='max_num_proc', metavar='4',
 	                    help='Maximum number of subprocesses to spawn. ' + \
 	                    'Total processes will be this number + 1 for ' + \
-	                    'the parent process.')
+	                    'the parent process. Independent read subsets are ' + \
+	                    'phased concurrently within this budget.')
 	self.args = parser.parse_args()
         self.output_dir = os.path.dirname(self.args.output_fn)
 
@@ -320,6 +407,14 @@ class Phasr(object):
 	self.fasta_stack = [] ### list of fasta files to process
 	self.consensus_dictionary={}
 	self.hap_cons=[]
+	self.read_weights={} ### subreads behind each collapsed ZMW unit
+	self.lock = threading.Lock()
+	self.budget = ProcessBudget(self.args.max_num_proc)
+	self.pool = None
+	self.cache = None
+	if self.args.cache_dir is not None:
+	    self.cache = ConsensusCache(self.args.cache_dir, self.args.cache_size * 1024 * 1024)
+	    self.logger.info("Consensus cache is %s" % self.cache.cache_dir )
         ### catch signals
 	signal.signal(signal.SIGINT, self.signal_handler)	
 	### check arguments
@@ -330,130 +425,167 @@ class Phasr(object):
 	assert os.path.exists(os.path.dirname( self.args.output_fn ) )
 	if os.path.isfile(self.args.output_fn):
 	    self.logger.info("%s already exists, overwriting.." %  (self.args.output_fn) )	
-        self.tmp_dir = tempfile.mkdtemp()
+        self.scratch = ScratchSpace(self.args.scratch_dir, self.args.scratch_quota * 1024 * 1024)
+        self.tmp_dir = self.scratch.directory
         self.logger.info("Tmp Dir is %s" % self.tmp_dir )
+	if self.args.ref_fn is not None:
+	    ### blasr only reads plain Fasta
+	    self.ref_fn = plain_fasta(self.ref_fn, self.scratch.path("reference.fasta", os.path.getsize(self.ref_fn)))
+	if self.args.seed is not None:
+	    random.seed(self.args.seed)
         self.prepareInputFasta()
 
+    def filterReads(self, counts):
+	### yield the input reads that pass the full-pass and length filters
+	for record in read_fasta(self.args.fasta_fn):
+	    counts[0] += 1
+	    if self.args.fullpass and 'fp' not in record.name: continue
+	    if self.args.min_read_length and len(record.sequence) < self.args.min_read_length: continue
+	    counts[1] += 1
+	    yield record
+
     def prepareInputFasta(self):
-	### prepare input fasta
-	self.input_fn = os.path.join( self.tmp_dir, os.path.basename(self.args.fasta_fn) )
-	total_reads=0 
-	used_reads=0
-        f = FastaReader(self.args.fasta_fn) 
-        with open(self.input_fn, "w") as output:
-            for record in f:
-                total_reads+=1
-                if self.args.fullpass:
-                    if 'fp' not in record.name: continue
-                if self.args.min_read_length:
-                    if len(record.sequence) < self.args.min_read_length: continue
-                used_reads+=1
-                print >>output, '>' + record.name
-                print >>output, record.sequence
-	self.logger.info("%s/%s reads remain after filtering." % (used_reads, total_reads) )
-	### limit the number of reads used in the algorithm if specified
-	if used_reads > self.args.max_input_reads:
-	    f = FastaReader(self.input_fn)
-	    fp_input_reads=[]; non_fp_input_reads=[];
-	    for r in f:
-		if r.name.startswith('fp'):
-		    fp_input_reads.append(r)
-		else:
-		    non_fp_input_reads.append(r)
-	    if (len(non_fp_input_reads)+len(fp_input_reads)) > int(self.args.max_input_reads):
-		if len(fp_input_reads) < int(self.args.max_input_reads):
-		    non_fp_reads_size = (int(self.args.max_input_reads)-len(fp_input_reads))
-		    non_fp_input_reads = random.sample(non_fp_input_reads, non_fp_reads_size)
-		    fp_input_reads.extend(non_fp_input_reads)
-		    input_reads = fp_input_reads
-		else:
-		    input_reads = random.sample(fp_input_reads, int(self.args.max_input_reads))
-		with open(tmp_fn, "w") as of:
-		    for r in input_reads:
-			print >>of, ">"+r.name
-			print >>of, r.sequence
-	    os.remove(self.input_fn); shutil.move(tmp_fn, self.input_fn)
-	    self.logger.info("%s reads will be used." % (self.args.max_input_reads)  )
+	### prepare input fasta in one streaming pass: filter, group the subreads of each
+	### ZMW and keep a full-pass first reservoir sample of at most max_input_reads ZMWs;
+	### only the ZMWs kept are collapsed, so no consensus is built for the rest
+	input_name = os.path.basename(self.args.fasta_fn)
+	if input_name.endswith(".gz"):
+	    input_name = input_name[:-3]
+	self.input_fn = os.path.join( self.tmp_dir, input_name )
+	counts = [0, 0] ### total and filtered reads
+	groups = group_zmws(self.filterReads(counts), self.args.collapse_zmws)
+	reservoir = PriorityReservoir(self.args.max_input_reads, lambda group: group.name.startswith('fp'), self.args.seed)
+	reservoir.extend(groups)
+	self.logger.info("%s/%s reads remain after filtering." % (counts[1], counts[0]) )
+	if self.args.collapse_zmws != 'none':
+	    self.logger.info("%s ZMW units remain after collapsing subreads." % (len(reservoir)) )
+	### weights of the units kept, the number of subreads each stands for
+	self.read_weights = write_units((build_unit(group) for group in reservoir.sample()), self.input_fn)
+	if len(reservoir) > self.args.max_input_reads:
+	    self.logger.info("%s reads will be used." % (len(self.read_weights))  )
 	### initialize the stack with the input fasta file
-	self.fasta_stack.append((self.input_fn, 0))
+	self.fasta_stack.append((self.input_fn, 0, ()))
 	print self.fasta_stack
 
-    def signal_handler(signal, frame):
+    def signal_handler(self, signum, frame):
         self.logger.info("Recieved SIGINT.")
         self.cleanup()
         raise SystemExit
  
     ##TODO
     def cleanup(self):
-	shutil.rmtree(self.tmp_dir)
+	if getattr(self, 'pool', None) is not None:
+	    self.pool.terminate()
+	    self.pool = None
+	self.scratch.cleanup()
 
     def getVersion(self):
         return __version__
 
-    def generate_haplotype_consensus(self): 
+    def get_consensus(self, alns, backboneSeq, read_fn, min_iteration = 2, nproc = 1):
+	### consult the persistent cache, keyed by the reads themselves, before running
+	### the iterative consensus
+	compute = lambda: get_good_consensus(alns, backboneSeq, read_fn, min_iteration = min_iteration, nproc = nproc)
+	if self.cache is None:
+	    return compute()
+	key = fasta_consensus_key(read_fn, backboneSeq, min_iteration = min_iteration, version = __version__)
+	return self.cache.get_or_compute(key, compute)
+
+    def read_count(self, names):
+	### number of subreads behind a set of reads or collapsed ZMW units
+	return sum( self.read_weights.get(name, 1) for name in names )
+
+    def subset_random(self, path):
+	### each subset draws its random numbers from its own generator, seeded from --seed
+	### and its position in the recursion tree, so concurrent subsets cannot change
+	### each other's draws
+	if self.args.seed is None:
+	    return random.Random()
+	return random.Random( (self.args.seed, path) )
+
+    def add_haplotype(self, path, consensus, rng = random):
+	### haplotypes are keyed by their position in the recursion tree so the output order
+	### does not depend on which subsets happened to finish first
+	with self.lock:
+	    self.hap_cons.append( (path, fastar._make( [ make_rand_string(rng = rng), consensus ] )) )
+
+    def generate_haplotype_consensus(self, input_fn, rec_level, path=()): 
+	### process one subset of reads and return the child subsets to phase next
+	rng = self.subset_random(path)
 	    
 	### define filenames
-	tmp_fasta = os.path.join( self.tmp_dir, make_rand_string()+".fasta" )	
-	tmp_file = os.path.join( self.tmp_dir, make_rand_string())	
-
-	### get fasta and ref
-	try:
-	    input_fn, rec_level = self.fasta_stack.pop()
-	except:
-	    return 0
+	tmp_fasta = self.scratch.slot( "normalized.fasta" )
+	### blasr only reads plain Fasta, so compressed subsets are worked on from a plain copy
+	work_fn = input_fn
+	if input_fn.endswith(".gz"):
+	    work_fn = self.scratch.slot( "subset.fasta" )
 
 	self.logger.info("Now processing ( %s ) at level ( %s )." % (input_fn, rec_level) )
-	f = FastaReader(self.ref_fn)
+	f = read_fasta(self.ref_fn)
 	for r in f: backboneSeq = r.sequence; break
 
 	### normalize fasta and get alns
 
-	normalize_fasta(input_fn, self.ref_fn, tmp_fasta)
-	os.system("blasr %s %s -m 5 -out %s" % (tmp_fasta, self.ref_fn, tmp_file))
-	alns = get_aln_array( simple_align_hit_iterator(tmp_file), max_num_reads=9999)
-	shutil.move(tmp_fasta, input_fn)
-	os.remove(tmp_file)
+	with self.budget:
+	    normalize_fasta(input_fn, self.ref_fn, tmp_fasta)
+	    alns = get_aln_array( stream_blasr(tmp_fasta, self.ref_fn, 5, strip_query_names = False), max_num_reads=9999)
+	shutil.move(tmp_fasta, work_fn)
 
-	try:
+	with self.lock:
 	    ### see if we already made a consensus from this subset
-	    consensus = self.consensus_dictionary[os.path.abspath(input_fn)]
-	except KeyError:
+	    consensus = self.consensus_dictionary.get(os.path.abspath(input_fn))
+	if consensus is None:
 	    ### or make initial consensus using all reads from this subset
 	    self.logger.info("%s: Creating initial consensus" % (rec_level) )
-	    consensus = get_good_consensus(alns, backboneSeq, input_fn)
-	    self.consensus_dictionary[os.path.abspath(input_fn)] = consensus 
+	    ### the reads are realigned with every core of the budget that is free
+	    with self.budget.share(self.args.max_num_proc) as nproc:
+		consensus = self.get_consensus(alns, backboneSeq, work_fn, min_iteration = 2, nproc = nproc)
+	    with self.lock:
+		self.consensus_dictionary[os.path.abspath(input_fn)] = consensus 
 	init_seq_length = len(consensus)
 	self.logger.info("%s: Initial sequence is of length ( %s )" % (rec_level, init_seq_length) )
 
 	### initial conditions under which phasing will cease and the initial consensus will be returned
-	if len(alns) < self.args.min_cluster_size or rec_level >= self.args.max_recursion_level:
+	if self.read_count( x[2] for x in alns ) < self.args.min_cluster_size or rec_level >= self.args.max_recursion_level:
 	    self.logger.info("%s: Unable to further split this group. Will return initial consensus." % ( rec_level ) )
-	    self.hap_cons.append(fastar._make( [ make_rand_string(), consensus ] ))
+	    self.add_haplotype(path, consensus, rng)
 	    self.logger.info("%s: %s" % (rec_level, consensus))
-	    return 0
+	    return []
 
 	self.logger.info("%s: Phasing ( %s ) alns." % ( rec_level, len(alns) ) )
 
-	### call workers to come up with Max Divergent Features using different
-	### random samples of these alignments
-	### throw the multiprocess objects in a dict then run them
-	process_dict={}
-	manager = multiprocessing.Manager()
-	feature_list = manager.dict()
-
-	for k in xrange(self.args.sample_number):	
-	    while process_status(process_dict) >= self.args.max_num_proc:
-		pass
-	    process_dict[k] = multiprocessing.Process(target=create_feature, args=( alns, backboneSeq, feature_list, self.args.sample_size, init_seq_length, self.args.score_floor, self.tmp_dir, input_fn, self.args.n_refinement ))
-	    process_dict[k].start()
-	for item in process_dict.itervalues():
-            item.join()
-
-	feature_list = dict(feature_list)
-	def ranking_function(feature):
-	    aln_sizes = sorted([len(feature.h1_alns), len(feature.h2_alns)])
-	    return float(aln_sizes[1])/float(aln_sizes[0])
-	feature_ranking = sorted([ item for item in feature_list.itervalues() ], key = ranking_function )
+	### call the worker pool to come up with Max Divergent Features using different
+	### random samples of these alignments; the alignments go to the workers as a
+	### memory-mapped table, only its path is pickled into the context
+	table = AlignmentTable.from_alns( alns )
+	table = table.share( self.scratch.path( "subset%s.alns" % "".join( "_%d" % i for i in path ), 2 * len(table.query) ) )
+	context = self.pool.publish( alns=table, backboneSeq=backboneSeq, sample_size=self.args.sample_size,
+				     init_seq_length=init_seq_length, score_floor=self.args.score_floor,
+				     tmp_dir=self.tmp_dir, scratch=self.scratch, input_fn=work_fn, n_refinement=self.args.n_refinement,
+				     split_search=self.args.split_search,
+				     max_split_evaluations=self.args.max_split_evaluations )
+	if self.args.adaptive_sampling:
+	    ### run samples in waves until the best feature stops changing
+	    sampler = AdaptiveSampler( rank_feature, self.args.sample_number,
+				       self.args.sample_wave or default_wave_size(self.args.sample_number, self.args.max_num_proc),
+				       self.args.max_sample_number or 4*self.args.sample_number )
+	    results = []
+	    while True:
+		wave_size = sampler.next_wave()
+		if not wave_size: break
+		seeds = [ rng.randint(0, sys.maxint) for k in xrange(wave_size) ]
+		wave = self.pool.map_samples( context, seeds )
+		sampler.update( wave )
+		results.extend( wave )
+	    self.logger.info("%s: Ran ( %s ) feature samples." % (rec_level, sampler.samples) )
+	else:
+	    seeds = [ rng.randint(0, sys.maxint) for k in xrange(self.args.sample_number) ]
+	    results = self.pool.map_samples( context, seeds )
+	self.pool.release( context )
+	table.close(); os.remove( table.path )
+	feature_list = [ Feature.from_result(result, self.tmp_dir, self.scratch) for result in results if result is not None ]
+
+	feature_ranking = sorted( feature_list, key = rank_feature )
 	successful_features = []
 
 	unflagged_features=0
@@ -465,9 +597,9 @@ class Phasr(object):
 	### exit condition 
 	if not unflagged_features:
 	    self.logger.info("%s: Unable to further split this group. Will return initial consensus." % ( rec_level ) )
-	    self.hap_cons.append(fastar._make( [ make_rand_string(), consensus ] ))
+	    self.add_haplotype(path, consensus, rng)
 	    self.logger.info("%s: %s" % (rec_level, consensus))
-	    return 0 
+	    return [] 
 
 	### after iterating though the features and comparing their metrics, the one with the lowest metric is chosen
 	### we refine it further, and then impose a few conditions on it
@@ -478,17 +610,19 @@ class Phasr(object):
 		current_feature=feature_ranking.pop(0)
 	    except IndexError:
 		self.logger.info("%s: Unable to further split this group. Will return initial consensus." % ( rec_level ) )
-		self.hap_cons.append(fastar._make( [ make_rand_string(), consensus ] ))
+		self.add_haplotype(path, consensus, rng)
 		self.logger.info("%s: %s" % (rec_level, consensus))
-		return 0
+		return []
 	    if current_feature.flag: continue
-	    if len(current_feature.h1_alns) <= self.args.min_cluster_size or len(current_feature.h2_alns) <= self.args.min_cluster_size:
+	    if self.read_count(current_feature.h1_reads) <= self.args.min_cluster_size or self.read_count(current_feature.h2_reads) <= self.args.min_cluster_size:
 		continue
 	    self.logger.info("%s: Processing Feature: %s" % (rec_level, current_feature) )
 	    ### align all reads back to the feature and generate iterative dagcon consensus starting from backbone
-	    read_subset1_fn, read_subset2_fn = current_feature.finalize(input_fn, backboneSeq, self.args.n_refinement)
+	    with self.budget.share(self.args.max_num_proc) as nproc:
+		read_subset1_fn, read_subset2_fn = current_feature.finalize(work_fn, backboneSeq, self.args.n_refinement, consensus_fn = self.get_consensus,
+									    compress = self.args.compress_intermediates, nproc = nproc)
 	    ### sanity check the clustering results
-	    if len(current_feature.h1_alns) <= self.args.min_cluster_size or len(current_feature.h2_alns) <= self.args.min_cluster_size:
+	    if self.read_count(current_feature.h1_reads) <= self.args.min_cluster_size or self.read_count(current_feature.h2_reads) <= self.args.min_cluster_size:
 		self.logger.info("%s: Feature ( %s ) failed due to small cluster size <= ( %s )." % ( rec_level, current_feature.name, self.args.min_cluster_size) )
 		continue
 	    if current_feature.pctsimilarity >= self.args.min_cluster_divergence:
@@ -499,96 +633,72 @@ class Phasr(object):
 	    self.logger.info("%s: Sequence 1 of the successful feature is: %s" % ( rec_level, current_feature.h1_con ) )
 	    self.logger.info("%s: Sequence 2 of the successful feature is: %s" % ( rec_level, current_feature.h2_con ) )
 
-	    ### put the subgroups on the stack
-	    self.fasta_stack.insert(0, (read_subset1_fn, rec_level+1))
-	    self.fasta_stack.insert(0, (read_subset2_fn, rec_level+1))
 	    ### save generating consensus from the same group of reads more than once
-	    self.consensus_dictionary[os.path.abspath(read_subset1_fn)] = current_feature.h1_con
-	    self.consensus_dictionary[os.path.abspath(read_subset2_fn)] = current_feature.h2_con
-	    return 0
+	    with self.lock:
+		self.consensus_dictionary[os.path.abspath(read_subset1_fn)] = current_feature.h1_con
+		self.consensus_dictionary[os.path.abspath(read_subset2_fn)] = current_feature.h2_con
+	    ### hand the subgroups back to the scheduler
+	    return [ (read_subset1_fn, rec_level+1, path+(0,)), (read_subset2_fn, rec_level+1, path+(1,)) ]
 
     def run(self):
 	if self.args.ref_fn == None: ### if denovo mode is chosen a read is used as the template
 	    try:
-		ref=fastar._make(best_template_by_blasr(input_fasta_name))
+		ref=fastar._make(best_template_by_sketch(self.input_fn, sample_size = self.args.template_sample_size))
 	    except:
 		self.cleanup()
 		self.logger.info("De novo template selection failed. Exiting..")
 		return 0
 	    write_fasta(ref, os.path.join(self.tmp_dir, "btbb.fasta") )
 	    self.args.ref_fn = os.path.join(self.tmp_dir, "btbb.fasta")
-
-	while 1:
-	    self.generate_haplotype_consensus()
-	    if len(self.fasta_stack) == 0: break
+	    self.ref_fn = self.args.ref_fn
+
+	### one pool of feature workers serves every level of the recursion, and sibling
+	### subsets are phased concurrently; both draw on the same --max_num_proc budget
+	self.pool = FeaturePool(create_feature, self.args.max_num_proc, self.tmp_dir, budget = self.budget)
+	scheduler = SubsetScheduler(self.generate_haplotype_consensus, self.args.max_num_proc)
+	scheduler.run(self.fasta_stack)
+	self.fasta_stack = []
+	self.pool.close()
+	self.pool = None
+	### breadth-first order of the recursion tree, as the sequential stack produced
+	self.hap_cons = [ seq for path, seq in sorted(self.hap_cons, key = lambda x: (len(x[0]), x[0])) ]
 	if len(self.hap_cons) > 0: write_fasta( self.hap_cons, self.args.output_fn)
 	self.logger.info("( %s ) sequences output to ( %s )" % ( len(self.hap_cons), self.args.output_fn ) )
 	seq_to_read_fn = dict([[v,k] for k,v in self.consensus_dictionary.items()]) ##TODO: hash sequence 
 	for seq in self.hap_cons:
 	    read_fn = seq_to_read_fn[seq.sequence]
-	    shutil.copyfile(read_fn, os.path.join(os.path.dirname(self.args.output_fn), seq.name+".fasta"))	
+	    ### read subsets may be BGZF compressed with --compress_intermediates, the
+	    ### reads of each haplotype are always written out as plain Fasta
+	    out_fn = os.path.join(os.path.dirname(self.args.output_fn), seq.name+".fasta")
+	    if plain_fasta(read_fn, out_fn) == read_fn:
+		shutil.copyfile(read_fn, out_fn)
 
 	self.logger.info("Process complete")
 	self.cleanup()
 
-def create_feature(alns, backboneSeq, feature_list, sample_size, init_seq_length, score_floor, tmp_dir, input_fn, n_refinement):
-    while 1: ### give a collision-impossible name to this feature
-	rands=make_rand_string() 
-	temp1_fn =os.path.join(tmp_dir, rands+"_h1.fasta")
-	temp2_fn = os.path.join(tmp_dir, rands+"_h2.fasta")
-	if rands not in feature_list: break
-    reads=random.sample(alns, sample_size)
-    worstscore = float(10000000000.0) ### aim to minimize this number
-    output = None
-    bestentropy = float(999) ### aim to minimize this number
-    worstidentity=float(100)
-    ### begin iterating through all possible groupings of this subset of reads
-    for i in range(1,int((floor(len(reads)/2))+1)):
-	for combo in itertools.combinations(reads, i):
-	    icombo = list(set(reads).difference(combo))
-	    ### get the two consensus templates
-	    templates = []
-	    for subset in [combo, icombo]:
-		template = make_template_from_alns(subset, backboneSeq, max_num_reads = 10)
-		templates.append(template)
-	    try:
-		entropy = sum([ (lambda x: x.numerator)(x) for x in templates ])/float(sum([ (lambda x: x.denominator)(x) for x in templates ]))
-	    except:
-		entropy = 1
-	    ### we need to write the consensus sequences to file in order to run blasr, and get percent ID
-	    ### TODO: find away around doing this, its slow!
-	    with open(temp1_fn, "w") as of1:
-		print >>of1, ">h1"
-		print >>of1, templates[0].sequence
-	    with open(temp2_fn, "w") as of2:
-		print >>of2, ">h2"
-		print >>of2, templates[1].sequence 
-	    ### get percent ID 
-	    try:
-		blasr_output = parse_blasr(subprocess.check_output("blasr -bestn 1 -m 4 %s %s" % ( temp1_fn, temp2_fn), shell=True), 4)
-		score = float(blasr_output[0].pctsimilarity)
-	    except:
-		continue
-	    ### set a lower bound on similarity, we dont want to return garbage
-	    if score <= score_floor:
-		continue
-	    ### calculate our metric (percent ID * entropy), if the metric is lower than any previous combination
-	    ### write it to memory
-	    if (score * entropy) < worstscore:
-		output = combo
-		worstscore = (score * entropy)
-		bestentropy = entropy
-		worstidentity = score
-		best_template_pair = templates
+def create_feature(alns, backboneSeq, sample_size, init_seq_length, score_floor, tmp_dir, input_fn, n_refinement, split_search = 'exhaustive', max_split_evaluations = None, seed = None, scratch = None):
+    ### give a collision-impossible name to this feature
+    rands = "%s_%s" % (make_rand_string(), seed if seed is not None else os.getpid())
+    ### alignments may also come as the plain list get_aln_array returns
+    if not isinstance(alns, AlignmentTable):
+	alns = AlignmentTable.from_alns(alns)
+    reads=list( alns.subset( random.sample(xrange(len(alns)), sample_size) ) )
+    ### search the possible groupings of this subset of reads for the one minimizing (percent ID * entropy)
+    best_split = search_split(reads, backboneSeq, score_floor, mode = split_search, max_evaluations = max_split_evaluations)
     ### return the feature to the process manager
-    if output == None:
-	return 0
-    ioutput = list(set(reads).difference(output))
-    created_feature = Feature(rands, tmp_dir)
+    if best_split == None:
+	return None
+    output = [ reads[i] for i in best_split.h1 ]
+    worstscore = best_split.metric
+    bestentropy = best_split.entropy
+    best_template_pair = best_split.templates
+    ioutput = [ reads[i] for i in best_split.h2 ]
+    created_feature = Feature(rands, tmp_dir, scratch)
     created_feature.metric = worstscore; created_feature.entropy = bestentropy
     created_feature.h1_con = best_template_pair[0].sequence; created_feature.h2_con = best_template_pair[1].sequence 
     created_feature.h1_alns = output
     created_feature.h2_alns = ioutput
+    created_feature.update_read_names()
     created_feature.h2_backbone = backboneSeq
     created_feature.h1_backbone = backboneSeq
     created_feature.evaluate_pct_id()
@@ -596,11 +706,8 @@ def create_feature(alns, backboneSeq, feature_list, sample_size, init_seq_length
     ### now align all reads to feature and refine 
     created_feature.refine( input_fn, n_refinement )
     created_feature.normalize()
-	
-    feature_list[rands] = created_feature 
 
-    ### cleanup
-    os.remove(temp1_fn); os.remove(temp2_fn)
+    return created_feature.to_result()
 
 if __name__ == '__main__':    
     sys.exit(Phasr().run())
@@ -41,6 +41,9 @@ import signal
 import shutil
 import random
 import string
+import time
+
+import numpy as np
 
 from math import floor, log, ceil
 from collections import namedtuple
@@ -49,6 +52,12 @@ from pbcore.io.FastaIO import FastaReader
 from pbtools.pbdagcon.aligngraph import *
 from pbtools.pbdagcon.utils import *
 
+from readstore import ReadStore
+from seqio import read_fasta
+from aligner import align_pair, estimate_diagonal
+from sketch import TemplateSelector, kmer_set, reverse_complement
+from blasrio import iter_blasr, parse_blasr
+
 __p4revision__ = ""
 __p4change__ = ""
 revNum = int(1)
@@ -57,6 +66,7 @@ __version__ = "0.1.0"
 
 rmap = dict(zip("ACGTN-","TGCAN-"))
 fastar = namedtuple('fastar', 'name, sequence')
+logger = logging.getLogger()
 
 def write_fasta(fasta_obj, outfile, mode = "w"):
     if isinstance(fasta_obj, list):
@@ -78,7 +88,7 @@ def write_fasta(fasta_obj, outfile, mode = "w"):
 
 def fasta_size(fasta):
     try:
-        f = FastaReader(fasta)
+        f = read_fasta(fasta)
         count=0
         for r in f:
             count+=1
@@ -87,17 +97,12 @@ def fasta_size(fasta):
         return None
 
 def extract_sequence(fasta, names):
-    f = FastaReader(fasta)
-    if isinstance(names, str):
-        for r in f:
-            if r.name == names:
-                return r
-    elif isinstance(names, list):
-        output=[]
-        for r in f:
-            if r.name in names:
-                output.append(r)
-        return output
+    with ReadStore(fasta) as store:
+        if isinstance(names, str):
+            if names in store:
+                return fastar._make( [ names, store.sequence(names) ] )
+        elif isinstance(names, list):
+            return [ fastar._make(r) for r in store.records(names) ]
 
 def process_status(process_dict):
         alive_processes=0
@@ -106,36 +111,13 @@ def process_status(process_dict):
                 alive_processes+=1
         return alive_processes
 
-def parse_blasr(output, mode, strip_query_names = True):
-    parsed_output=[]
-    if mode == 1:
-        entry = namedtuple('entry', 'qname, tname, qstrand, tstrand, score, pctsimilarity, tstart, tend, tlength, qstart, qend, qlength, ncells')
-    if mode == 4:
-        entry = namedtuple('entry', 'qname, tname, score, pctsimilarity, qstrand, qstart, qend, qseqlength, tstrand, tstart, tend, tseqlength, mapqv, ncells, clusterScore, probscore, numSigClusters')
-    if mode == 5:
-        entry = namedtuple('entry', 'qname, qlength, z1, qalength, qstrand, tname, tlength, z2, talength, tstrand, score, nmatch, nmis, nins, ndel, zscore, qseq, matchvector, tseq')
-
-    output = output.strip().split("\n")
-    output = [ x.split() for x in output ]
-    if strip_query_names:
-	new_output=[]
-	for line in output:
-	    line[0] = line[0].split("/")[0]
-	    new_output.append(line)
-	output = new_output
-
-    for line in output:
-	alignment = entry._make(line)
-        parsed_output.append(alignment)
-    return parsed_output
-
-def make_rand_string(minlength=6,maxlength=8):
-    length=random.randint(minlength,maxlength)
+def make_rand_string(minlength=6,maxlength=8,rng=random):
+    length=rng.randint(minlength,maxlength)
     letters=string.ascii_letters+string.digits # alphanumeric, upper and lowercase
-    return ''.join([random.choice(letters) for _ in range(length)])
+    return ''.join([rng.choice(letters) for _ in range(length)])
 
 def best_template_by_blasr(fasta_fn, len_threshold = 300, min_number_reads = 1, rank_reads = False):
-    f = FastaReader(fasta_fn)
+    f = read_fasta(fasta_fn)
     read_dict = {}
     for r in f:
         r_id = r.name.split("/")[0]
@@ -146,19 +128,15 @@ def best_template_by_blasr(fasta_fn, len_threshold = 300, min_number_reads = 1,
         return None
 
     scores = {}
-    with open(fasta_fn + ".saln") as f:
-        for l in f:
-            l = l.strip().split()
-            l = l[:9]
-            r1, r2 = l[:2]
-            r1 = r1.split("/")[0]
-            r2 = r2.split("/")[0]
-            if r1 == r2:
-                continue
-            if int(l[7]) - int(l[6]) < len_threshold : continue
-            scores.setdefault(r1,[])
-            scores[r1].append(int(l[4]))
-            #scores[r1].append(-float(l[5]))
+    for hit in iter_blasr(fasta_fn + ".saln", 1):
+        r1 = hit.qname
+        r2 = hit.tname.split("/")[0]
+        if r1 == r2:
+            continue
+        if hit.tend - hit.tstart < len_threshold : continue
+        scores.setdefault(r1,[])
+        scores[r1].append(hit.score)
+        #scores[r1].append(-hit.pctsimilarity)
     score_array = []
     for r, s in scores.items():
         score_array.append( (np.mean(s), r) )
@@ -174,6 +152,21 @@ def best_template_by_blasr(fasta_fn, len_threshold = 300, min_number_reads = 1,
     else:
         return r_id, read_dict[r_id]
 
+def best_template_by_sketch(fasta_fn, len_threshold = 300, min_number_reads = 1, rank_reads = False,
+			    sample_size = None, seed = 0):
+    ### same results as best_template_by_blasr, but reads are ranked from MinHash sketches
+    ### against a random pool and only the top few are verified by alignment
+    with ReadStore(fasta_fn) as store:
+	records = [ (name.split("/")[0], seq) for name, seq in store.records() ]
+    selector = TemplateSelector(records, len_threshold = len_threshold, sample_size = sample_size, seed = seed)
+    ranking = selector.rank()
+    if rank_reads:
+	return [ (-x.score, x.name) for x in ranking ]
+    if not ranking or (min_number_reads != None and len(ranking) < min_number_reads):
+	raise AlignGraphUtilError("not enough number of reads in best_template_by_sketch")
+    read_dict = dict(records)
+    return ranking[0].name, read_dict[ranking[0].name]
+
 def construct_aln_graph_from_aln_array(alns, 
 			backboneSeq,
 			max_num_reads = None,
@@ -197,38 +190,227 @@ def construct_aln_graph_from_aln_array(alns,
 	    break	
     return g
 
+class StrandClassifier(object):
+    """
+    Decide the strand of a read relative to a reference from the k-mers it
+    shares with each strand of the reference.  A read is called when one
+    strand has at least min_hits shared k-mers and min_ratio times as many
+    as the other; otherwise it is ambiguous and is oriented by aligning
+    both strands to the reference.
+    """
+
+    def __init__(self, references, k = 12, min_hits = 3, min_ratio = 2.0):
+	self.references = [ seq.upper() for seq in references ]
+	self.k = k
+	self.min_hits = min_hits
+	self.min_ratio = min_ratio
+	self.forward = set()
+	self.reverse = set()
+	for seq in self.references:
+	    self.forward.update( kmer_set(seq, k) )
+	    self.reverse.update( kmer_set(reverse_complement(seq), k) )
+	self.ambiguous = 0
+
+    def strand(self, seq):
+	### return "+" or "-" for a read, seq must be upper case
+	kmers = kmer_set(seq, self.k)
+	fwd = len(kmers & self.forward)
+	rev = len(kmers & self.reverse)
+	if fwd >= self.min_hits and fwd >= self.min_ratio * rev:
+	    return "+"
+	if rev >= self.min_hits and rev >= self.min_ratio * fwd:
+	    return "-"
+	self.ambiguous += 1
+	return self.strand_by_alignment(seq)
+
+    def strand_by_alignment(self, seq):
+	best_score, best_strand = None, "+"
+	rc = reverse_complement(seq)
+	for strand, query in [("+", seq), ("-", rc)]:
+	    for ref in self.references:
+		alignment = align_pair(query, ref, mode='semiglobal', diagonal=estimate_diagonal(query, ref))
+		if alignment is not None and (best_score is None or alignment.score > best_score):
+		    best_score, best_strand = alignment.score, strand
+	return best_strand
+
 def normalize_fasta(fasta_file, ref_file, out_file):
-    f = FastaReader(fasta_file)
+    ### write the reads upper case and on the reference strand in a single pass
+    classifier = StrandClassifier( [ r.sequence for r in read_fasta(ref_file) ] )
+    n_reads = 0; n_reversed = 0
     with open(out_file, "w") as of:
-        for r in f:
-            r_id = "%s" %  r.name
-            print >>of, ">"+r_id
-            seq = r.sequence.upper()
-            print >>of, seq 
-
-    output = subprocess.check_output("blasr -bestn 1 -m 1 %s %s" % ( out_file, ref_file ), shell=True)
-    direction = {}
-    output = output.strip().split("\n")
-    for l in output:
-        l = l.strip().split()
-        rId = l[0].split("/")[0]
-        if l[2] != l[3]:
-            direction[rId] = "-"
-        else:
-            direction[rId] = "+"
+	for r in read_fasta(fasta_file):
+	    seq = r.sequence.upper()
+	    if classifier.strand(seq) == "-":
+		seq = reverse_complement(seq)
+		n_reversed += 1
+	    n_reads += 1
+	    print >>of, ">"+r.name
+	    print >>of, seq
+    logger.debug("Normalized %s reads, %s reversed, %s oriented by alignment" % (n_reads, n_reversed, classifier.ambiguous))
 
-    f = FastaReader(out_file)
-    outData = []
-    for r in f:
-        r_id = "%s" % r.name
-        outData.append(">"+r_id)
-        seq = r.sequence.upper()
-        if direction != None:
-            if direction.get(r_id, "+") != "+":
-                seq = "".join([rmap[c] for c in seq[::-1]])
-        outData.append(seq)
-    with open(out_file,"w") as of:
-        print >>of, "\n".join(outData)
+ConsensusStep = namedtuple('ConsensusStep', 'stage, n_aligned, length, realigned, seconds')
+
+### reads aligned by the realignment workers, set in each worker when the pool forks
+_realign_reads = []
+
+def _set_realign_reads(reads):
+    global _realign_reads
+    _realign_reads = reads
+
+def align_read(seq, backboneSeq, strand = None, min_pct_id = 60.0):
+    ### best alignment of a read to a backbone and the strand it came from, keeping the
+    ### better strand like -bestn 1; the reverse complement is only tried when the forward
+    ### strand aligns poorly, and a read whose strand is already known ('+' or '-') is
+    ### aligned on that strand alone
+    best = None
+    if strand != '-':
+	best = align_pair(seq, backboneSeq, mode='semiglobal', diagonal=estimate_diagonal(seq, backboneSeq))
+	if strand == '+' or (best is not None and best.pctsimilarity >= min_pct_id):
+	    return best, '+'
+    rc = reverse_complement(seq)
+    alignment = align_pair(rc, backboneSeq, mode='semiglobal', diagonal=estimate_diagonal(rc, backboneSeq))
+    if alignment is not None and (best is None or alignment.score > best.score):
+	return alignment, '-'
+    return best, '+'
+
+def align_chunk(reads, backboneSeq, indices, strands):
+    ### align the reads at 'indices' to a backbone, returning for each read its index,
+    ### strand and alignment in the form get_aln_array produces from blasr output
+    results = []
+    for i, strand in zip(indices, strands):
+	name, seq = reads[i]
+	best, strand = align_read(seq, backboneSeq, strand)
+	aln = None
+	if best is not None:
+	    aln = ((best.qstart, best.qend, best.qseq), (best.tstart, best.tend, best.tseq), name)
+	results.append( (i, strand, aln) )
+    return results
+
+def _realign_chunk(task):
+    backboneSeq, indices, strands = task
+    return align_chunk(_realign_reads, backboneSeq, indices, strands)
+
+class ConsensusRefiner(object):
+    """
+    Iterative consensus refinement with the reads kept in memory.  Each
+    step realigns the reads to the current consensus with the in-process
+    aligner, rebuilds the alignment graph and derives the next consensus.
+    With nproc above one the reads are split across a pool of worker
+    processes, forked once with the reads in memory, so only the backbone
+    and the alignments pass between processes.  The strand each read
+    aligned on is remembered, so later steps align one strand only, and
+    the alignments are reused whenever a step leaves the consensus
+    unchanged.  Every graph build is recorded in 'telemetry' as a
+    ConsensusStep.
+    """
+
+    def __init__(self, reads, max_num_reads = 1000, min_cov = 0, entropy_th = 0.65, nproc = 1):
+	self.reads = [ (name, seq.upper()) for name, seq in reads ]
+	self.max_num_reads = max_num_reads
+	self.min_cov = min_cov
+	self.entropy_th = entropy_th
+	self.nproc = max(1, min(nproc, len(self.reads)))
+	self.telemetry = []
+	self._strands = [None] * len(self.reads)
+	self._backbone = None
+	self._alns = None
+	self._pool = None
+
+    def align_reads(self, backboneSeq, indices):
+	### align the reads at 'indices' in order, in the worker pool when there is more
+	### than one process, and remember the strand of each
+	strands = [ self._strands[i] for i in indices ]
+	if self.nproc == 1 or len(indices) < 2 * self.nproc:
+	    chunks = [ align_chunk(self.reads, backboneSeq, indices, strands) ]
+	else:
+	    if self._pool is None:
+		self._pool = multiprocessing.Pool( self.nproc, _set_realign_reads, (self.reads,) )
+	    ### a few chunks per process even out reads of different lengths
+	    step = int(ceil(len(indices) / float(4 * self.nproc)))
+	    tasks = [ (backboneSeq, indices[i:i+step], strands[i:i+step]) for i in range(0, len(indices), step) ]
+	    chunks = self._pool.map( _realign_chunk, tasks )
+	alns = []
+	for i, strand, aln in itertools.chain.from_iterable(chunks):
+	    if aln is None: continue
+	    self._strands[i] = strand
+	    alns.append(aln)
+	return alns
+
+    def realign(self, backboneSeq):
+	### align the reads to a new backbone in file order until max_num_reads of them
+	### have aligned, like get_aln_array on blasr output
+	alns = []
+	start = 0
+	while len(alns) < self.max_num_reads and start < len(self.reads):
+	    stop = min(len(self.reads), start + self.max_num_reads - len(alns))
+	    alns.extend( self.align_reads(backboneSeq, range(start, stop)) )
+	    start = stop
+	return alns
+
+    def graph(self, stage, backboneSeq, alns = None):
+	start = time.time()
+	realigned = False
+	if alns is None:
+	    if backboneSeq != self._backbone:
+		self._alns = self.realign(backboneSeq)
+		self._backbone = backboneSeq
+		realigned = True
+	    alns = self._alns
+	g = construct_aln_graph_from_aln_array(alns, backboneSeq, max_num_reads = self.max_num_reads, remove_in_del = False)
+	return g, (stage, len(alns), realigned, start)
+
+    def record(self, info, s):
+	stage, n_aligned, realigned, start = info
+	self.telemetry.append( ConsensusStep._make([stage, n_aligned, len(s), realigned, time.time() - start]) )
+
+    def refine(self, alns, backboneSeq, hp_correction = True, min_iteration = 2):
+	### the consensus from the supplied alignments is refined twice: min_iteration-2
+	### plain rounds, an optional homopolymer correction and a final round that marks
+	### low confidence bases in lower case
+	g, info = self.graph('initial', backboneSeq, alns)
+	s,c = g.generate_consensus(min_cov = self.min_cov)
+	self.record(info, s)
+	for j in range(2):
+	    for i in range(min_iteration-2):
+		g, info = self.graph('refine', s.upper())
+		s,c = g.generate_consensus(min_cov = self.min_cov)
+		self.record(info, s)
+	    if hp_correction:
+		g, info = self.graph('hp_correction', s.upper())
+		s = detect_missing(g, entropy_th = self.entropy_th)
+		self.record(info, s)
+	    g, info = self.graph('final', s.upper())
+	    s,c = g.generate_consensus(min_cov = self.min_cov)
+	    s = mark_lower_case_base(g, entropy_th = self.entropy_th)
+	    self.record(info, s)
+	return s
+
+    def close(self, terminate = False):
+	if self._pool is None: return
+	if terminate:
+	    self._pool.terminate()
+	else:
+	    self._pool.close()
+	self._pool.join()
+	self._pool = None
+
+def refine_consensus(reads, alns, backboneSeq,
+                  hp_correction = True,
+                  min_iteration = 2,
+                  max_num_reads = 1000,
+                  entropy_th = 0.65,
+		  min_cov = 0,
+		  nproc = 1):
+    ### in-memory consensus refinement, returns the consensus and the per-step telemetry
+    refiner = ConsensusRefiner(reads, max_num_reads = max_num_reads, min_cov = min_cov, entropy_th = entropy_th,
+			       nproc = nproc)
+    try:
+	s = refiner.refine(alns, backboneSeq, hp_correction = hp_correction, min_iteration = min_iteration)
+    except:
+	refiner.close(terminate = True)
+	raise
+    refiner.close()
+    return s, refiner.telemetry
 
 def get_good_consensus(alns, backboneSeq, read_fn,
                   hp_correction = True,
@@ -236,38 +418,56 @@ def get_good_consensus(alns, backboneSeq, read_fn,
                   max_num_reads = 1000,
                   entropy_th = 0.65,
 		  min_cov = 0,
-		  consensus_seq_name = 'consensus'):
-    while 1:
-	tmp_fn = os.path.join( os.path.dirname(read_fn), (make_rand_string()+"_con.fasta") )
-	if not os.path.isfile(tmp_fn) : break
-    g = construct_aln_graph_from_aln_array(alns, backboneSeq, max_num_reads = max_num_reads, remove_in_del = False)
-    s,c = g.generate_consensus(min_cov = min_cov)
-    output = [ fastar._make([ consensus_seq_name,  s.upper()] ) ]
-
-    assert os.path.isdir(os.path.dirname(tmp_fn))
-    write_fasta( output, tmp_fn )	
-
-    for j in range(2):
-	for i in range(min_iteration-2):
-	    g = constructe_aln_graph_from_fasta(read_fn, tmp_fn, max_num_reads = max_num_reads, remove_in_del = False)
-	    s,c = g.generate_consensus(min_cov = min_cov)
-	    output = [ fastar._make([consensus_seq_name,  s.upper()]) ]
-	    write_fasta( output, tmp_fn)	
-
-	if hp_correction:
-	    g = constructe_aln_graph_from_fasta(read_fn, tmp_fn, max_num_reads = max_num_reads, remove_in_del = False)
-	    s = detect_missing(g, entropy_th = entropy_th)
-	    output = [ fastar._make([consensus_seq_name,  s.upper()]) ]
-	    write_fasta( output, tmp_fn)
-
-	g = constructe_aln_graph_from_fasta(read_fn, tmp_fn, max_num_reads = max_num_reads, remove_in_del = False)
-	s,c = g.generate_consensus(min_cov = min_cov)
-	s = mark_lower_case_base(g, entropy_th = entropy_th)
-	output = [ fastar._make([consensus_seq_name,  s.upper()]) ]
-	write_fasta( output, tmp_fn)
-    os.remove(tmp_fn)
+		  consensus_seq_name = 'consensus',
+		  nproc = 1):
+    with ReadStore(read_fn) as store:
+	reads = list(store.records())
+    s, telemetry = refine_consensus(reads, alns, backboneSeq, hp_correction = hp_correction,
+				    min_iteration = min_iteration, max_num_reads = max_num_reads,
+				    entropy_th = entropy_th, min_cov = min_cov, nproc = nproc)
+    for step in telemetry:
+	logger.debug("%s: %s" % (consensus_seq_name, step))
     return s
 
+def graph_node_arrays(nodes):
+    ### export, once per graph, the per-node read info counts and the total count of
+    ### reads entering each node through its in-edges
+    n_nodes = len(nodes)
+    info_counts = np.fromiter( (len(n.info) for n in nodes), dtype=np.int64, count=n_nodes )
+    edge_counts = [ int(item.count) for n in nodes for item in n._in_edges ]
+    edge_owner = np.repeat( np.arange(n_nodes), [ len(n._in_edges) for n in nodes ] )
+    in_coverage = np.bincount( edge_owner, weights=edge_counts, minlength=n_nodes ).astype(np.int64)
+    return info_counts, in_coverage
+
+def combo_entropy_terms(info_counts, in_coverage, n_reads):
+    ### proportion of nodes in the graph which do not have 100% of the reads in the set
+    ### passing through them
+    if n_reads > 1: ### special case of a set of one read, consider the backbone to be a read
+	used = info_counts > 0
+    else:
+	used = np.ones( len(info_counts), dtype=bool )
+    denominator = int(np.sum(used))
+    numerator = int(np.sum(used & (in_coverage < n_reads)))
+    return numerator, denominator
+
+def cross_entropy_terms(info_counts, in_coverage, n_reads, seq_length):
+    ### for each node 1/cluster_size * -log( cov/max_cov), summed in node order with the
+    ### per-coverage terms looked up from a table so the result matches the scalar loop
+    if n_reads > 1: ### special case of a set of one read, consider the backbone to be a read
+	used = (info_counts > 0) & (in_coverage != 0)
+    else:
+	used = in_coverage != 0
+    q = (float(1/float(n_reads+1)))
+    coverage = in_coverage[used]
+    numerator = 0
+    if len(coverage):
+	table = np.zeros( int(coverage.max())+1 )
+	for k in np.unique(coverage).tolist():
+	    table[k] = (-1*(q*log(float(k/float(n_reads+1)))))
+	numerator = sum( table[coverage].tolist() )
+    denominator=(-1 * log(1/float(n_reads+1)) * (1/float(n_reads+1)) * float(seq_length) * float(n_reads+1))
+    return numerator, denominator
+
 def make_template_from_alns(aln_array, backboneSeq, 
                   hp_correction = True,
                   min_iteration = 1, 
@@ -279,36 +479,18 @@ def make_template_from_alns(aln_array, backboneSeq,
     g = construct_aln_graph_from_aln_array(aln_array, backboneSeq, max_num_reads = max_num_reads)
     seq_length=len(backboneSeq)
     s,c = g.generate_consensus(min_cov = 0)
-    nodes = sorted_nodes(g)
-    denominator=0; numerator=0
+    info_counts, in_coverage = graph_node_arrays(sorted_nodes(g))
     if combo_entropy:
 	### if we have a small number of reads we will calculate entropy
 	### as the proportion of nodes in the graph which have 100% of the reads in the set
 	### passing through them
-	for n in nodes:
-	    if len(aln_array) > 1: ### special case of a set of one read, consider the backbone to be a read
-		if len(n.info) == 0:
-		    continue
-	    edge_list=[]
-	    denominator+=1
-	    for item in n._in_edges: edge_list.append(int(item.count))
-	    if sum(edge_list) < len(aln_array): numerator+=1
+	numerator, denominator = combo_entropy_terms(info_counts, in_coverage, len(aln_array))
     elif not combo_entropy:
 	### if we are claculating entropy for a larger group of reads we do it differently
 	### since it is likely that 0 nodes will have 100% of all reads going through them
 	### the main idea here is to get a statistical estimate of the cross entropy
 	### that will be relatively independent of cluster size
 	### thus for each node we caclulate 1/cluster_size * -log( cov/max_cov)
-	for n in nodes:
-	    edge_list=[]
-	    if len(aln_array) > 1: ### special case of a set of one read, consider the backbone to be a read
-		if len(n.info) == 0:
-		    continue
-	    for item in n._in_edges: edge_list.append(int(item.count))
-	    if sum(edge_list) == 0: continue
-	    p = log(float(sum(edge_list)/float(len(aln_array)+1)))
-	    q = (float(1/float(len(aln_array)+1)))
-	    numerator+=(-1*(q*p))
-	denominator=(-1 * log(1/float(len(aln_array)+1)) * (1/float(len(aln_array)+1)) * float(seq_length) * float(len(aln_array)+1))
+	numerator, denominator = cross_entropy_terms(info_counts, in_coverage, len(aln_array), seq_length)
     output = template_info._make( [s, numerator, denominator])
     return output
@@ -0,0 +1,253 @@
+import os
+import mmap
+import logging
+import tempfile
+
+from cStringIO import StringIO
+from contextlib import closing
+
+import numpy as np
+
+from seqio import compression, open_fasta, open_output, BgzfReader, DECOMPRESS_THREADS
+
+log = logging.getLogger()
+
+INDEX_SUFFIX = '.rsi'
+INDEX_MAGIC = '#readstore-v1'
+
+class ReadStore(object):
+    """
+    Random access to the records of a Fasta file.
+
+    The first time a file is opened its records are scanned once into a
+    sidecar index (<fasta>.rsi) of name, byte offset and byte length; later
+    opens only read the index, which is rebuilt whenever the Fasta changes.
+    The Fasta itself is memory-mapped, so lookups by name are a dictionary
+    access and records can be copied out as slices of the map.
+
+    Compressed Fasta files are read too.  The index of a BGZF file holds
+    offsets into the uncompressed stream, which a BgzfReader maps to the
+    blocks to inflate; a plain gzip file cannot be read at random and is
+    inflated into memory once.
+    """
+
+    def __init__(self, fasta_fn, index_fn=None, threads=DECOMPRESS_THREADS):
+        self.fasta_fn = os.path.abspath( fasta_fn )
+        self.index_fn = index_fn or (self.fasta_fn + INDEX_SUFFIX)
+        self.threads = threads
+        self._stamp = self._file_stamp()
+        self.compression = compression( self.fasta_fn ) if self._stamp[0] > 0 else None
+        self._handle = None
+        if self.compression == 'bgzf':
+            self._map = BgzfReader( self.fasta_fn, threads )
+        elif self.compression == 'gzip':
+            log.debug("%s is not BGZF compressed, reading it into memory" % self.fasta_fn)
+            with open_fasta( self.fasta_fn ) as handle:
+                self._map = handle.read()
+        elif self._stamp[0] > 0:
+            self._handle = open( self.fasta_fn, 'rb' )
+            self._map = mmap.mmap( self._handle.fileno(), 0, access=mmap.ACCESS_READ )
+        else:
+            self._map = ''
+        if not self._load_index():
+            self._build_index()
+            self._write_index()
+        self._lookup = {}
+        for i, name in enumerate(self._names):
+            self._lookup.setdefault( name, i )
+
+    def _file_stamp(self):
+        stat = os.stat( self.fasta_fn )
+        return (stat.st_size, repr(stat.st_mtime), stat.st_ino)
+
+    def _stamp_line(self):
+        return '%s\t%s\t%s\t%s' % ((INDEX_MAGIC,) + self._stamp)
+
+    def _load_index(self):
+        try:
+            with open( self.index_fn ) as handle:
+                if handle.readline().rstrip('\n') != self._stamp_line():
+                    return False
+                names, offsets, lengths = [], [], []
+                for line in handle:
+                    name, offset, length = line.rstrip('\n').rsplit('\t', 2)
+                    names.append( name )
+                    offsets.append( int(offset) )
+                    lengths.append( int(length) )
+        except (IOError, OSError, ValueError):
+            return False
+        self._names = names
+        self._offsets = np.array( offsets, dtype=np.int64 )
+        self._lengths = np.array( lengths, dtype=np.int64 )
+        return True
+
+    def _build_index(self):
+        names, offsets = [], []
+        position = 0
+        if self.compression == 'gzip':
+            lines = StringIO( self._map )
+        elif self.compression == 'bgzf':
+            lines = iter( self._map )
+        else:
+            lines = open( self.fasta_fn, 'rb' )
+        with closing( lines ):
+            for line in lines:
+                if line.startswith('>'):
+                    names.append( line[1:].rstrip('\r\n') )
+                    offsets.append( position )
+                position += len(line)
+        self._names = names
+        self._offsets = np.array( offsets, dtype=np.int64 )
+        self._lengths = np.diff( np.append( self._offsets, position ) )
+
+    def _write_index(self):
+        """
+        Save the index next to the Fasta, if that directory is writable
+        """
+        directory = os.path.dirname( self.index_fn )
+        try:
+            handle, tmp_fn = tempfile.mkstemp( dir=directory, suffix='.tmp' )
+        except (IOError, OSError):
+            log.debug("Unable to write a read index for %s" % self.fasta_fn)
+            return
+        with os.fdopen( handle, 'w' ) as output:
+            print >>output, self._stamp_line()
+            for name, offset, length in zip( self._names, self._offsets.tolist(), self._lengths.tolist() ):
+                print >>output, "%s\t%d\t%d" % (name, offset, length)
+        os.rename( tmp_fn, self.index_fn )
+
+    def close(self):
+        if self._map and self.compression != 'gzip':
+            self._map.close()
+        if self._handle is not None:
+            self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._lookup
+
+    def names(self):
+        return list(self._names)
+
+    def _indices(self, names):
+        """
+        Positions of the requested records, in file order
+        """
+        if isinstance(names, basestring):
+            names = [names]
+        lookup = self._lookup
+        return sorted( set( lookup[n] for n in names if n in lookup ) )
+
+    def indices(self, names):
+        """
+        Positions of the named records, in file order, as an index array
+        """
+        return np.array( self._indices( names ), dtype=np.int64 )
+
+    def names_at(self, indices):
+        return [ self._names[i] for i in indices ]
+
+    def record_view(self, i):
+        """
+        Zero-copy view of the raw bytes of the i-th record (a copy for
+        BGZF input)
+        """
+        if self.compression == 'bgzf':
+            return self._map.read( int(self._offsets[i]), int(self._lengths[i]) )
+        return buffer( self._map, int(self._offsets[i]), int(self._lengths[i]) )
+
+    def sequence(self, name):
+        """
+        Return the sequence of one record, or None if it is absent
+        """
+        i = self._lookup.get( name )
+        if i is None:
+            return None
+        lines = str( self.record_view(i) ).split('\n')
+        return ''.join( line.rstrip('\r') for line in lines[1:] )
+
+    def records(self, names=None):
+        """
+        Yield (name, sequence) for the requested records in file order
+        """
+        indices = xrange(len(self)) if names is None else self._indices( names )
+        for i in indices:
+            name = self._names[i]
+            yield name, self.sequence( name )
+
+    def subset_views(self, names):
+        """
+        Zero-copy views of the raw records for a subset of names
+        """
+        return [ self.record_view(i) for i in self._indices( names ) ]
+
+    def subset_buffer(self, names):
+        """
+        The raw records for a subset of names as a single string
+        """
+        return self._terminate( ''.join( str(view) for view in self.subset_views( names ) ) )
+
+    def write_subset(self, names, out_fn, compress=None):
+        """
+        Write the records for a subset of names to a new Fasta file,
+        BGZF compressed if 'compress' is set (or, by default, if out_fn
+        ends in .gz), returning the number of records written
+        """
+        return self.write_indices( self._indices( names ), out_fn, compress )
+
+    def write_indices(self, indices, out_fn, compress=None):
+        """
+        Write the records at the given positions to a new Fasta file, as
+        write_subset does for names
+        """
+        n = 0
+        with open_output( out_fn, compress ) as output:
+            for i in indices:
+                view = self.record_view( int(i) )
+                output.write( view )
+                ### only the last record of a file can lack its newline
+                if view[-1:] != '\n':
+                    output.write('\n')
+                n += 1
+        return n
+
+    def demultiplex(self, groups, outputs, compress=None):
+        """
+        Write several subsets in a single pass over the file: the records
+        named in groups[i] go to every file listed in outputs[i].  Returns
+        the number of records written for each group.
+        """
+        destinations = {}
+        for group, names in enumerate( groups ):
+            for i in self._indices( names ):
+                destinations.setdefault( i, [] ).append( group )
+        handles = [ [ open_output( fn, compress ) for fn in fns ] for fns in outputs ]
+        counts = [0] * len(groups)
+        try:
+            for i in sorted( destinations ):
+                view = self.record_view( i )
+                for group in destinations[i]:
+                    for handle in handles[group]:
+                        handle.write( view )
+                        if view[-1:] != '\n':
+                            handle.write('\n')
+                    counts[group] += 1
+        finally:
+            for group_handles in handles:
+                for handle in group_handles:
+                    handle.close()
+        return counts
+
+    @staticmethod
+    def _terminate( data ):
+        if data and not data.endswith('\n'):
+            data += '\n'
+        return data
@@ -0,0 +1,173 @@
+import random
+import logging
+
+log = logging.getLogger()
+
+# Convergence criterion for adaptive sampling: the best feature of two
+# consecutive waves must assign at least AGREEMENT of the reads the same
+# way and differ in metric by at most TOLERANCE (relative), PATIENCE times
+# in a row
+AGREEMENT = 0.95
+TOLERANCE = 0.02
+PATIENCE = 1
+# Fraction of a wave's usable features that must agree with the best one
+# before the sample budget stops growing
+CONSENSUS_FRACTION = 0.5
+# Waves without a usable feature only count as stable once this fraction
+# of sample_number has been drawn, so a couple of unlucky samples cannot
+# end sampling of a heterozygous subset
+EMPTY_WAVE_MIN_FRACTION = 0.5
+# By default the sample target is covered in this many waves, so that
+# convergence has a chance to stop sampling before the target is reached
+WAVES = 3
+
+def default_wave_size( sample_number, nproc ):
+    """
+    Samples per wave when none is given: a WAVES-th of the target, but no
+    more than there are processes to run them
+    """
+    return max( 1, min( nproc, sample_number // WAVES ) )
+
+def partition_agreement( a, b ):
+    """
+    Fraction of reads that two features place on the same side, taking the
+    better of the two ways of matching their sides up
+    """
+    a1, a2 = set(a.h1_reads), set(a.h2_reads)
+    b1, b2 = set(b.h1_reads), set(b.h2_reads)
+    reads = a1 | a2 | b1 | b2
+    if not reads:
+        return 0.0
+    same = len(a1 & b1) + len(a2 & b2)
+    swapped = len(a1 & b2) + len(a2 & b1)
+    return max(same, swapped) / float(len(reads))
+
+class AdaptiveSampler(object):
+    """
+    Decide how many feature samples to run for one subset, in waves.
+
+    Sampling stops early once the best feature (first by 'rank') has been
+    stable for PATIENCE consecutive waves: its partition agrees with the
+    previous best on at least AGREEMENT of the reads, its metric moved by
+    no more than TOLERANCE, and at least CONSENSUS_FRACTION of the wave's
+    usable features agree with it.  A wave without any usable feature, as
+    on a homozygous subset, counts as stable too once at least
+    EMPTY_WAVE_MIN_FRACTION of sample_number samples have been drawn.  When too few agree, the
+    target sample count is raised by one wave instead, up to max_samples.
+    Early stopping needs at least two waves below the target, so the wave
+    size should be well under sample_number (see default_wave_size).
+    """
+
+    def __init__(self, rank, sample_number, wave_size, max_samples,
+                       agreement=AGREEMENT,
+                       tolerance=TOLERANCE,
+                       patience=PATIENCE):
+        self.rank = rank
+        self.wave_size = max(1, wave_size)
+        self.sample_number = sample_number
+        self.target = max(sample_number, self.wave_size)
+        self.max_samples = max(max_samples, self.target)
+        self.agreement = agreement
+        self.tolerance = tolerance
+        self.patience = patience
+        self.samples = 0
+        self.features = []
+        self.best = None
+        self.stable_waves = 0
+        self.converged = False
+
+    def next_wave(self):
+        """
+        Return the number of samples to run in the next wave, 0 when done
+        """
+        if self.converged or self.samples >= self.target:
+            return 0
+        return min(self.wave_size, self.target - self.samples)
+
+    def update(self, results):
+        """
+        Record the results of a wave, where failed samples are None
+        """
+        self.samples += len(results)
+        usable = [ r for r in results if r is not None and not r.flag and r.h1_reads and r.h2_reads ]
+        self.features.extend( usable )
+        if not usable:
+            # Nothing new to compare, the best feature (if any) stands
+            if self.samples >= EMPTY_WAVE_MIN_FRACTION * self.sample_number:
+                self.stable_waves += 1
+                self.check_converged()
+            return
+        best = sorted( self.features, key=self.rank )[0]
+        if self.best is not None:
+            agree = partition_agreement( best, self.best )
+            drift = abs(best.metric - self.best.metric) / max(abs(self.best.metric), 1e-9)
+            if agree >= self.agreement and drift <= self.tolerance:
+                self.stable_waves += 1
+            else:
+                self.stable_waves = 0
+        self.best = best
+        agreeing = sum( 1 for r in usable if partition_agreement(r, best) >= self.agreement )
+        if agreeing < CONSENSUS_FRACTION * len(usable):
+            # The wave is split between competing partitions, keep going
+            self.stable_waves = 0
+            if self.target < self.max_samples:
+                self.target = min(self.max_samples, self.target + self.wave_size)
+                log.info("Features disagree, raising the sample target to %s" % self.target)
+            return
+        self.check_converged()
+
+    def check_converged(self):
+        if self.stable_waves >= self.patience:
+            self.converged = True
+            log.info("Feature sampling converged after %s samples" % self.samples)
+
+class PriorityReservoir(object):
+    """
+    Uniform random sample of at most 'size' items from a stream of unknown
+    length, preferring priority items (full-pass reads): the sample is all
+    priority items when there are fewer than 'size' of them, topped up
+    with a uniform sample of the rest, or else a uniform sample of the
+    priority items alone.
+
+    Each class is kept in its own reservoir (Algorithm R) of 'size' items,
+    so memory does not depend on the length of the stream.
+    """
+
+    def __init__(self, size, is_priority, seed=None):
+        self.size = size
+        self.is_priority = is_priority
+        self.rng = random.Random( seed )
+        self.reservoirs = { True: [], False: [] }
+        self.seen = { True: 0, False: 0 }
+
+    def add(self, item):
+        priority = bool( self.is_priority(item) )
+        reservoir = self.reservoirs[priority]
+        self.seen[priority] += 1
+        ### items are kept with their position in the stream, to output them in order
+        entry = (self.seen[True] + self.seen[False], item)
+        if len(reservoir) < self.size:
+            reservoir.append( entry )
+        else:
+            j = self.rng.randint( 0, self.seen[priority] - 1 )
+            if j < self.size:
+                reservoir[j] = entry
+
+    def extend(self, items):
+        for item in items:
+            self.add( item )
+        return self
+
+    def __len__(self):
+        return sum( self.seen.values() )
+
+    def sample(self):
+        """
+        The sampled items, in stream order
+        """
+        chosen = self.reservoirs[True][:self.size]
+        room = self.size - len(chosen)
+        rest = self.reservoirs[False]
+        if room < len(rest):
+            rest = self.rng.sample( rest, room )
+        return [ item for position, item in sorted( chosen + rest ) ]
@@ -0,0 +1,123 @@
+import os
+import errno
+import atexit
+import shutil
+import logging
+import tempfile
+import threading
+
+log = logging.getLogger()
+
+# Preferred location of scratch files, and the default cap on how much of
+# it one run may use before new files go to disk instead
+SHARED_MEMORY = '/dev/shm'
+SCRATCH_QUOTA = 1024 * 1024 * 1024
+
+def _usable( directory ):
+    return directory is not None and os.path.isdir( directory ) and os.access( directory, os.W_OK | os.X_OK )
+
+class ScratchSpace(object):
+    """
+    A private scratch directory for the intermediate files of one run.
+
+    The directory is created on tmpfs (/dev/shm) when available, or in
+    'root' when given.  Files handed out after the directory holds
+    'quota' bytes go to a second directory on disk instead.  The bytes held
+    are the sizes of the files in the directory, written by any process,
+    checked each time a file is handed out; callers that know how large a
+    file will be can pass it as a size hint.  slot() names a file that is
+    reused by each worker process and thread, so tight loops overwrite the
+    same file rather than creating and deleting new ones.  A slot is
+    checked against the quota every time it is handed out and moves to
+    disk, with its current contents, once the fast directory is full.
+
+    Everything is removed by cleanup(), which is also registered to run at
+    exit of the process that created the space.  The object pickles, so
+    worker processes can be handed the same space; both directories are
+    created up front by the owner so every process uses the same ones.
+    """
+
+    def __init__(self, root=None, quota=SCRATCH_QUOTA, disk_root=None, prefix='phasr_'):
+        if root is None and _usable( SHARED_MEMORY ):
+            root = SHARED_MEMORY
+        self.quota = quota
+        self.prefix = prefix
+        self.directory = tempfile.mkdtemp( prefix=prefix, dir=root )
+        self.disk_root = disk_root
+        self.disk_directory = tempfile.mkdtemp( prefix=prefix, dir=disk_root )
+        self.owner = os.getpid()
+        self._slots = {}
+        self._spilled = False
+        atexit.register( self.cleanup )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_slots'] = {}
+        state['_spilled'] = False
+        return state
+
+    def usage(self):
+        """
+        Bytes currently held in the fast scratch directory
+        """
+        total = 0
+        for entry in os.listdir( self.directory ):
+            try:
+                total += os.path.getsize( os.path.join(self.directory, entry) )
+            except OSError:
+                pass
+        return total
+
+    def _full(self, size_hint, replaced=None):
+        ### would a file of 'size_hint' bytes exceed the quota; a file about to
+        ### be overwritten is expected to come back at least as large
+        if self.quota is None:
+            return False
+        held = self.usage()
+        if replaced is not None and os.path.isfile( replaced ):
+            size = os.path.getsize( replaced )
+            held -= size
+            size_hint = max( size_hint, size )
+        return held + size_hint > self.quota
+
+    def _disk(self):
+        if not self._spilled:
+            self._spilled = True
+            log.info("Scratch quota reached, new files go to %s" % self.disk_directory)
+        return self.disk_directory
+
+    def path(self, name, size_hint=0):
+        """
+        Path for a new scratch file, on disk if the quota would be exceeded
+        """
+        if self._full( size_hint ):
+            return os.path.join( self._disk(), name )
+        return os.path.join( self.directory, name )
+
+    def slot(self, name, size_hint=0):
+        """
+        Path of a scratch file reused by the calling process and thread
+        """
+        key = (os.getpid(), threading.current_thread().ident, name)
+        slot = self._slots.get( key )
+        if slot is None:
+            slot = self.path( "slot_%d_%x_%s" % (key[0], key[1], name), size_hint )
+        elif os.path.dirname( slot ) == self.directory and self._full( size_hint, slot ):
+            spilled = os.path.join( self._disk(), os.path.basename(slot) )
+            if os.path.isfile( slot ):
+                shutil.move( slot, spilled )
+            slot = spilled
+        self._slots[key] = slot
+        return slot
+
+    def cleanup(self):
+        if os.getpid() != self.owner:
+            return
+        for directory in [self.directory, self.disk_directory]:
+            if directory is None:
+                continue
+            try:
+                shutil.rmtree( directory )
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
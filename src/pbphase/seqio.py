@@ -0,0 +1,311 @@
+import os
+import mmap
+import gzip
+import zlib
+import shutil
+import struct
+import logging
+
+import numpy as np
+
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger()
+
+GZIP_MAGIC = '\x1f\x8b'
+BGZF_HEADER = struct.Struct('<4BI2BH')
+BGZF_SUBFIELD = struct.Struct('<2BHH')
+BGZF_FOOTER = struct.Struct('<iI')
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# Threads used to inflate or deflate BGZF blocks, and blocks kept inflated
+DECOMPRESS_THREADS = 4
+BLOCK_CACHE_SIZE = 16
+
+FastaEntry = namedtuple('FastaEntry', 'name, sequence')
+
+def _bgzf_block_size( data, offset ):
+    """
+    Total size of the BGZF block at 'offset', or None if none starts there
+    """
+    if len(data) < offset + BGZF_HEADER.size:
+        return None
+    id1, id2, cm, flg, mtime, xfl, os_, xlen = BGZF_HEADER.unpack_from( data, offset )
+    if (id1, id2, cm) != (0x1f, 0x8b, 8) or not flg & 4:
+        return None
+    position = offset + BGZF_HEADER.size
+    end = position + xlen
+    while position + BGZF_SUBFIELD.size <= end:
+        si1, si2, slen, bsize = BGZF_SUBFIELD.unpack_from( data, position )
+        if (si1, si2, slen) == (66, 67, 2):
+            return bsize + 1
+        position += 4 + slen
+    return None
+
+def compression( fn ):
+    """
+    Return 'bgzf', 'gzip' or None for an uncompressed file
+    """
+    with open( fn, 'rb' ) as handle:
+        header = handle.read( 64 )
+    if not header.startswith( GZIP_MAGIC ):
+        return None
+    if _bgzf_block_size( header, 0 ) is not None:
+        return 'bgzf'
+    return 'gzip'
+
+def _inflate_raw( data ):
+    return zlib.decompress( data, -15 )
+
+def _deflate_block( data ):
+    """
+    One complete BGZF block holding 'data'
+    """
+    compressor = zlib.compressobj( 6, zlib.DEFLATED, -15 )
+    cdata = compressor.compress( data ) + compressor.flush()
+    header = BGZF_HEADER.pack( 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6 ) + BGZF_SUBFIELD.pack( 66, 67, 2, len(cdata) + 25 )
+    return header + cdata + BGZF_FOOTER.pack( zlib.crc32(data), len(data) )
+
+class _Threads(object):
+    """
+    A thread pool created on first use in each process, since the threads
+    of a pool do not survive a fork
+    """
+
+    def __init__(self, threads):
+        self.threads = threads
+        self._pool = None
+        self._pid = None
+
+    def map(self, function, items):
+        if self.threads <= 1 or len(items) <= 1:
+            return map( function, items )
+        if self._pid != os.getpid():
+            self._pool = ThreadPool( self.threads )
+            self._pid = os.getpid()
+        return self._pool.map( function, items )
+
+    def close(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.terminate()
+        self._pool = None
+
+class BgzfReader(object):
+    """
+    Random access to the uncompressed contents of a BGZF file.
+
+    The block headers are scanned once from a memory map of the file to
+    build a table of compressed offsets and uncompressed starts, so a
+    byte range of the uncompressed stream maps to a run of blocks.  Runs
+    of blocks are inflated in parallel (zlib releases the GIL), and the
+    most recently used blocks are kept so neighbouring records are only
+    inflated once.
+    """
+
+    def __init__(self, fn, threads=DECOMPRESS_THREADS, cache_size=BLOCK_CACHE_SIZE):
+        self.fn = fn
+        self._handle = open( fn, 'rb' )
+        size = os.fstat( self._handle.fileno() ).st_size
+        self._data = mmap.mmap( self._handle.fileno(), 0, access=mmap.ACCESS_READ ) if size else ''
+        offsets, sizes, lengths = [], [], []
+        position = 0
+        while position < size:
+            block_size = _bgzf_block_size( self._data, position )
+            if block_size is None:
+                raise ValueError( "%s is not a BGZF file (bad block at byte %s)" % (fn, position) )
+            offsets.append( position )
+            sizes.append( block_size )
+            lengths.append( BGZF_FOOTER.unpack_from( self._data, position + block_size - 8 )[1] )
+            position += block_size
+        self.block_offsets = np.array( offsets, dtype=np.int64 )
+        self.block_sizes = np.array( sizes, dtype=np.int64 )
+        self.block_starts = np.concatenate( [ [0], np.cumsum( np.array(lengths, dtype=np.int64) ) ] )
+        self._threads = _Threads( threads )
+        self._cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return int(self.block_starts[-1])
+
+    def _inflate(self, i):
+        start = int(self.block_offsets[i])
+        end = start + int(self.block_sizes[i])
+        xlen = struct.unpack_from( '<H', self._data, start + 10 )[0]
+        return _inflate_raw( self._data[start + 12 + xlen:end - 8] )
+
+    def blocks(self, first, last):
+        """
+        The inflated contents of blocks first to last - 1
+        """
+        missing = [ i for i in xrange(first, last) if i not in self._cache ]
+        inflated = dict( zip( missing, self._threads.map( self._inflate, missing ) ) )
+        output = []
+        for i in xrange(first, last):
+            if i in inflated:
+                data = inflated[i]
+            else:
+                data = self._cache.pop( i )
+            self._cache[i] = data
+            output.append( data )
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem( last=False )
+        return output
+
+    def read(self, start, length):
+        """
+        'length' bytes of the uncompressed stream from 'start'
+        """
+        end = min( start + length, len(self) )
+        if end <= start:
+            return ''
+        first = int(np.searchsorted( self.block_starts, start, side='right' )) - 1
+        last = int(np.searchsorted( self.block_starts, end, side='left' ))
+        data = ''.join( self.blocks( first, last ) )
+        offset = start - int(self.block_starts[first])
+        return data[offset:offset + end - start]
+
+    def chunks(self):
+        """
+        Yield the uncompressed stream in order, inflating a batch of blocks
+        per thread at a time
+        """
+        n = len(self.block_offsets)
+        batch = max( 8 * self._threads.threads, 1 )
+        for first in xrange(0, n, batch):
+            for data in self._threads.map( self._inflate, range(first, min(first + batch, n)) ):
+                yield data
+
+    def __iter__(self):
+        ### lines of the uncompressed stream
+        remainder = ''
+        for data in self.chunks():
+            lines = (remainder + data).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if remainder:
+            yield remainder
+
+    def close(self):
+        self._threads.close()
+        self._cache.clear()
+        if self._data:
+            self._data.close()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class BgzfWriter(object):
+    """
+    File-like object writing BGZF, which gzip and zcat read like any other
+    gzip file but which ReadStore can also index for random access.
+    Blocks are deflated in parallel batches.
+    """
+
+    def __init__(self, fn, threads=DECOMPRESS_THREADS):
+        self.fn = fn
+        self._handle = open( fn, 'wb' )
+        self._threads = _Threads( threads )
+        self._buffer = []
+        self._buffered = 0
+        self.softspace = 0
+
+    def write(self, data):
+        self._buffer.append( str(data) )
+        self._buffered += len(data)
+        if self._buffered >= BGZF_BLOCK_SIZE * max( self._threads.threads, 1 ):
+            self._flush( final=False )
+
+    def _flush(self, final):
+        data = ''.join( self._buffer )
+        n_blocks = len(data) // BGZF_BLOCK_SIZE
+        if final and len(data) % BGZF_BLOCK_SIZE:
+            n_blocks += 1
+        blocks = [ data[i*BGZF_BLOCK_SIZE:(i+1)*BGZF_BLOCK_SIZE] for i in xrange(n_blocks) ]
+        for block in self._threads.map( _deflate_block, blocks ):
+            self._handle.write( block )
+        rest = data[n_blocks*BGZF_BLOCK_SIZE:]
+        self._buffer = [rest] if rest else []
+        self._buffered = len(rest)
+
+    def close(self):
+        if self._handle.closed:
+            return
+        self._flush( final=True )
+        self._handle.write( BGZF_EOF )
+        self._handle.close()
+        self._threads.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_fasta( fn, threads=DECOMPRESS_THREADS ):
+    """
+    Open a plain, gzip or BGZF file for iterating over its lines
+    """
+    kind = compression( fn )
+    if kind == 'bgzf':
+        return BgzfReader( fn, threads )
+    if kind == 'gzip':
+        return gzip.open( fn, 'rb' )
+    return open( fn, 'rb' )
+
+def open_output( fn, compress=None ):
+    """
+    Open a file for writing, as BGZF when 'compress' is set or, if it is
+    None, when the name ends in .gz
+    """
+    if compress is None:
+        compress = fn.endswith('.gz')
+    if compress:
+        return BgzfWriter( fn )
+    return open( fn, 'wb' )
+
+def read_fasta( fn ):
+    """
+    Yield FastaEntry(name, sequence) for each record of a plain or
+    compressed Fasta file
+    """
+    name, lines = None, []
+    handle = open_fasta( fn )
+    try:
+        for line in handle:
+            if line.startswith('>'):
+                if name is not None:
+                    yield FastaEntry( name, ''.join(lines) )
+                name, lines = line[1:].rstrip('\r\n'), []
+            elif name is not None:
+                lines.append( line.strip() )
+        if name is not None:
+            yield FastaEntry( name, ''.join(lines) )
+    finally:
+        handle.close()
+
+def plain_fasta( fn, out_fn ):
+    """
+    Return 'fn' if it is uncompressed, or decompress it to 'out_fn' for
+    tools such as blasr that only read plain Fasta
+    """
+    if compression( fn ) is None:
+        return fn
+    log.info("Decompressing %s to %s" % (fn, out_fn))
+    handle = open_fasta( fn )
+    try:
+        with open( out_fn, 'wb' ) as output:
+            if isinstance(handle, BgzfReader):
+                for data in handle.chunks():
+                    output.write( data )
+            else:
+                shutil.copyfileobj( handle, output )
+    finally:
+        handle.close()
+    return out_fn
@@ -0,0 +1,203 @@
+import heapq
+import random
+import string
+
+import numpy as np
+
+from collections import namedtuple
+
+from aligner import align_pair, estimate_diagonal
+
+# Defaults for de novo template selection
+KMER_SIZE = 12
+SKETCH_SIZE = 128
+POOL_SIZE = 200
+N_VERIFY = 5
+VERIFY_POOL_SIZE = 10
+
+COMPLEMENT = string.maketrans("ACGTNacgtn-", "TGCANtgcan-")
+
+TemplateScore = namedtuple('TemplateScore', 'score, name, identity, length')
+
+def reverse_complement( seq ):
+    return seq.translate( COMPLEMENT )[::-1]
+
+def kmer_set( seq, k ):
+    return set( seq[i:i+k] for i in xrange(len(seq)-k+1) )
+
+def minhash_sketch( seq, k=KMER_SIZE, size=SKETCH_SIZE ):
+    """
+    Bottom-s MinHash sketch of the canonical k-mers of a sequence, as a
+    sorted int64 array, so that reads from either strand are comparable
+    """
+    seq = seq.upper()
+    rc = reverse_complement( seq )
+    n = len(seq) - k + 1
+    if n <= 0:
+        return np.zeros( 0, dtype=np.int64 )
+    hashes = set( hash( min(seq[i:i+k], rc[n-1-i:n-1-i+k]) ) for i in xrange(n) )
+    return np.array( heapq.nsmallest( size, hashes ), dtype=np.int64 )
+
+def identity_from_jaccard( shared, union, k=KMER_SIZE ):
+    """
+    Identity estimated with the Mash distance, -1/k * ln(2j / (1 + j))
+    for Jaccard index j = shared / union; 0 where nothing is shared
+    """
+    shared = np.asarray( shared, dtype=float )
+    jaccard = shared / np.maximum( union, 1 )
+    with np.errstate( divide='ignore' ):
+        identity = 1.0 + np.log( 2 * jaccard / (1 + jaccard) ) / k
+    return np.where( shared > 0, np.maximum( identity, 0.0 ), 0.0 )
+
+def mash_identity( a, b, k=KMER_SIZE ):
+    """
+    Identity between two sequences estimated from their sketches, counting
+    hashes up to the smaller of the two sketch maxima
+    """
+    if not len(a) or not len(b):
+        return 0.0
+    limit = min( a[-1], b[-1] )
+    a, b = a[a <= limit], b[b <= limit]
+    shared = len( np.intersect1d( a, b ) )
+    return float( identity_from_jaccard( shared, len(a) + len(b) - shared, k ) )
+
+class SketchPool(object):
+    """
+    The sketches of a set of reads laid out for comparing one sketch
+    against all of them at once: a boolean read-by-hash incidence matrix
+    over the pool's hash vocabulary, and the sketches padded into rows
+    """
+
+    def __init__(self, sketches, k=KMER_SIZE):
+        self.k = k
+        self.size = len(sketches)
+        self.vocabulary = np.unique( np.concatenate( [ np.zeros(0, dtype=np.int64) ] + list(sketches) ) )
+        width = max( [ len(x) for x in sketches ] + [1] )
+        self.padded = np.empty( (self.size, width), dtype=np.int64 )
+        self.padded.fill( np.iinfo(np.int64).max )
+        self.maxima = np.empty( self.size, dtype=np.int64 )
+        self.maxima.fill( np.iinfo(np.int64).min )
+        self.incidence = np.zeros( (self.size, len(self.vocabulary)), dtype=bool )
+        for row, sketch in enumerate( sketches ):
+            if not len(sketch):
+                continue
+            self.padded[row, :len(sketch)] = sketch
+            self.maxima[row] = sketch[-1]
+            self.incidence[row, np.searchsorted(self.vocabulary, sketch)] = True
+
+    def identities(self, sketch):
+        """
+        Estimated identity of one sketch to every read in the pool
+        """
+        if not len(sketch) or not self.size:
+            return np.zeros( self.size )
+        position = np.minimum( np.searchsorted(self.vocabulary, sketch), len(self.vocabulary) - 1 )
+        present = self.vocabulary[position] == sketch
+        hits = np.zeros( (self.size, len(sketch)), dtype=np.int32 )
+        hits[:, present] = self.incidence[:, position[present]]
+        shared_upto = np.cumsum( hits, axis=1 )
+        ### only hashes up to the smaller sketch maximum of each pair are counted
+        limit = np.minimum( sketch[-1], self.maxima )
+        n_query = np.searchsorted( sketch, limit, side='right' )
+        shared = np.where( n_query > 0, shared_upto[np.arange(self.size), np.maximum(n_query - 1, 0)], 0 )
+        n_pool = np.sum( self.padded <= limit[:, None], axis=1 )
+        return identity_from_jaccard( shared, n_query + n_pool - shared, self.k )
+
+class TemplateSelector(object):
+    """
+    Rank reads as de novo templates without an all-vs-all alignment.
+
+    Every read is sketched once.  Candidates (optionally a random sample
+    of the reads) are scored against a random pool of POOL_SIZE reads by
+    the mean of estimated identity times overlap length, which like the
+    blasr score grows with both read length and similarity to the rest.
+    Only the N_VERIFY best candidates are then aligned, against a smaller
+    pool, to pick the template.
+    """
+
+    def __init__(self, records, len_threshold=300,
+                       sample_size=None,
+                       pool_size=POOL_SIZE,
+                       n_verify=N_VERIFY,
+                       verify_pool_size=VERIFY_POOL_SIZE,
+                       k=KMER_SIZE,
+                       sketch_size=SKETCH_SIZE,
+                       seed=0):
+        self.rng = random.Random( seed )
+        self.k = k
+        self.sketch_size = sketch_size
+        self.n_verify = n_verify
+        self.verify_pool_size = verify_pool_size
+        self.reads = [ (name, seq) for name, seq in records if len(seq) >= len_threshold ]
+        self.candidates = range( len(self.reads) )
+        if sample_size and sample_size < len(self.candidates):
+            self.candidates = sorted( self.rng.sample( self.candidates, sample_size ) )
+        self.pool = range( len(self.reads) )
+        if pool_size and pool_size < len(self.pool):
+            self.pool = sorted( self.rng.sample( self.pool, pool_size ) )
+        self._sketches = {}
+
+    def __len__(self):
+        return len(self.reads)
+
+    def sketch(self, i):
+        if i not in self._sketches:
+            self._sketches[i] = minhash_sketch( self.reads[i][1], self.k, self.sketch_size )
+        return self._sketches[i]
+
+    def estimates(self):
+        """
+        TemplateScores of the candidates from their mean estimated identity
+        and overlap to the pool
+        """
+        pool = SketchPool( [ self.sketch(j) for j in self.pool ], self.k )
+        pool_lengths = np.array( [ len(self.reads[j][1]) for j in self.pool ], dtype=float )
+        pool_index = dict( (j, row) for row, j in enumerate(self.pool) )
+        output = []
+        for i in self.candidates:
+            length = len(self.reads[i][1])
+            identities = pool.identities( self.sketch(i) )
+            overlaps = identities * np.minimum( length, pool_lengths )
+            use = np.ones( len(self.pool), dtype=bool )
+            if i in pool_index:
+                use[pool_index[i]] = False
+            if not use.any():
+                output.append( (TemplateScore._make([ 0.0, self.reads[i][0], 0.0, length ]), i) )
+                continue
+            output.append( (TemplateScore._make([ float(overlaps[use].mean()), self.reads[i][0],
+                                                  float(identities[use].mean()), length ]), i) )
+        return output
+
+    def verify(self, i, pool):
+        """
+        Mean alignment score of read i to a set of reads, each aligned on
+        the strand sharing more k-mers with read i
+        """
+        template = self.reads[i][1].upper()
+        template_kmers = kmer_set( template, self.k )
+        scores = []
+        for j in pool:
+            if j == i:
+                continue
+            query = self.reads[j][1].upper()
+            rc = reverse_complement( query )
+            if len( kmer_set(rc, self.k) & template_kmers ) > len( kmer_set(query, self.k) & template_kmers ):
+                query = rc
+            alignment = align_pair( query, template, mode='semiglobal',
+                                    diagonal=estimate_diagonal(query, template) )
+            scores.append( alignment.score if alignment is not None else 0 )
+        return sum(scores) / float(len(scores)) if scores else 0.0
+
+    def rank(self):
+        """
+        Return TemplateScores for every candidate, best first; the top
+        N_VERIFY are re-scored by alignment and placed ahead of the rest
+        """
+        estimates = sorted( self.estimates(), key=lambda x: -x[0].score )
+        top, rest = estimates[:self.n_verify], estimates[self.n_verify:]
+        pool = self.pool[:]
+        if len(pool) > self.verify_pool_size:
+            pool = self.rng.sample( pool, self.verify_pool_size )
+        verified = [ (estimate._replace( score=self.verify(i, pool) ), i) for estimate, i in top ]
+        verified.sort( key=lambda x: -x[0].score )
+        return [ estimate for estimate, i in verified + rest ]
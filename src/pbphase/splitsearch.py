@@ -0,0 +1,298 @@
+import heapq
+import itertools
+
+import numpy as np
+
+from collections import namedtuple
+
+from myPhasrUtils import make_template_from_alns
+from aligner import align_pair
+from incremental import ReadNodeIndex, IncrementalTemplate, gray_code_flips
+
+SPLIT_SEARCH_MODES = ('exhaustive', 'gray', 'bestfirst', 'greedy')
+MAX_EVALUATIONS = 64
+MAX_OPEN_NODES = 20000
+# Splits ranked best by the incremental templates that Gray-code search
+# scores again exactly
+GRAY_RESCORE = 4
+
+# Per-column codes used for the read profiles
+NOT_COVERED = 0
+DELETION = 5
+BASE_CODES = dict( zip("ACGTN", [1, 2, 3, 4, 4]) )
+
+SplitCandidate = namedtuple('SplitCandidate', 'metric, entropy, pctsimilarity, h1, h2, templates')
+
+def aln_backbone_profile( aln, backbone_length ):
+    """
+    Project an alignment tuple from get_aln_array onto backbone columns,
+    returning an int8 vector of base codes (0 where the read is absent)
+    """
+    profile = np.zeros( backbone_length, dtype=np.int8 )
+    (q_start, q_end, q_seq), (t_start, t_end, t_seq) = aln[0:2]
+    pos = t_start
+    for q_base, t_base in itertools.izip( q_seq, t_seq ):
+        if t_base == '-':
+            continue
+        if pos >= backbone_length:
+            break
+        if q_base == '-':
+            profile[pos] = DELETION
+        else:
+            profile[pos] = BASE_CODES.get( q_base.upper(), 4 )
+        pos += 1
+    return profile
+
+def disagreement( profiles ):
+    """
+    Count the backbone columns where the reads in a group disagree, a
+    cheap stand-in for the combo-entropy numerator that can only grow as
+    reads are added to the group.
+    """
+    if len(profiles) < 2:
+        return 0
+    highest = profiles.max(0)
+    lowest = np.where( profiles == NOT_COVERED, DELETION + 1, profiles ).min(0)
+    return int(np.sum( (highest > NOT_COVERED) & (lowest != highest) ))
+
+class SplitEvaluator(object):
+    """
+    Scores bipartitions of a sample of alignments with the Phasr feature
+    metric: combined template entropy * percent identity of the templates
+    """
+
+    def __init__(self, reads, backboneSeq, score_floor, max_num_reads=10):
+        self.reads = list(reads)
+        self.backboneSeq = backboneSeq
+        self.score_floor = score_floor
+        self.max_num_reads = max_num_reads
+        self.evaluations = 0
+        self._profiles = None
+
+    @property
+    def profiles(self):
+        if self._profiles is None:
+            length = len(self.backboneSeq)
+            self._profiles = np.array([ aln_backbone_profile(aln, length) for aln in self.reads ])
+        return self._profiles
+
+    def evaluate(self, h1, h2):
+        """
+        Build the two consensus templates for a split given as index lists
+        and return a SplitCandidate, or None if the split is rejected
+        """
+        combo = [ self.reads[i] for i in h1 ]
+        icombo = [ self.reads[i] for i in h2 ]
+        templates = []
+        for subset in [combo, icombo]:
+            template = make_template_from_alns(subset, self.backboneSeq, max_num_reads = self.max_num_reads)
+            templates.append(template)
+        return self.score_templates(h1, h2, templates)
+
+    def score_templates(self, h1, h2, templates):
+        """
+        Score a split whose two consensus templates are already built
+        """
+        self.evaluations += 1
+        try:
+            entropy = sum([ x.numerator for x in templates ])/float(sum([ x.denominator for x in templates ]))
+        except ZeroDivisionError:
+            entropy = 1
+        alignment = align_pair(templates[0].sequence, templates[1].sequence, mode='semiglobal')
+        if alignment is None:
+            return None
+        score = alignment.pctsimilarity
+        ### set a lower bound on similarity, we dont want to return garbage
+        if score <= self.score_floor:
+            return None
+        return SplitCandidate._make([ score * entropy, entropy, score, list(h1), list(h2), templates ])
+
+def _better( candidate, best ):
+    if candidate is None:
+        return False
+    return best is None or candidate.metric < best.metric
+
+def exhaustive_split_search( evaluator, max_evaluations=None ):
+    """
+    Evaluate every bipartition of the sample once.  The smaller side is
+    always h1, and for even-sized halves read 0 is pinned to h1 so a split
+    and its complement are never both evaluated.
+    """
+    n = len(evaluator.reads)
+    indices = range(n)
+    best = None
+    for i in range(1, n/2 + 1):
+        for combo in itertools.combinations(indices, i):
+            if 2*i == n and combo[0] != 0:
+                continue
+            if max_evaluations and evaluator.evaluations >= max_evaluations:
+                return best
+            h2 = [ x for x in indices if x not in combo ]
+            candidate = evaluator.evaluate( list(combo), h2 )
+            if _better( candidate, best ):
+                best = candidate
+    return best
+
+def gray_code_split_search( evaluator, max_evaluations=None ):
+    """
+    Visit every bipartition once, in an order where consecutive splits
+    differ by one read, and rank them with IncrementalTemplates: each step
+    moves one read between the two templates instead of building two new
+    alignment graphs.
+
+    The incremental templates only approximate make_template_from_alns:
+    their consensus is a majority vote rather than the AlnGraph consensus,
+    their entropy counts reads per node rather than per in-edge, and they
+    use every read instead of the first max_num_reads.  So the ranking is
+    a proxy for the exhaustive metric.  The GRAY_RESCORE best splits by
+    the proxy are scored again exactly, and the best of those is returned
+    with its real metric and templates; it is the exhaustive optimum
+    whenever the proxy ranks that split among its top GRAY_RESCORE.
+    """
+    n = len(evaluator.reads)
+    if n < 2:
+        return None
+    node_index = ReadNodeIndex( evaluator.reads, evaluator.backboneSeq )
+    sides = [ IncrementalTemplate(node_index, range(n)), IncrementalTemplate(node_index) ]
+    counter = itertools.count()
+    # The proxy's best splits so far, worst first
+    shortlist = []
+    for flip in gray_code_flips( n ):
+        if max_evaluations and evaluator.evaluations >= max_evaluations:
+            break
+        if flip in sides[0].members:
+            sides[0].remove(flip); sides[1].add(flip)
+        else:
+            sides[1].remove(flip); sides[0].add(flip)
+        if not len(sides[1]):
+            continue
+        small, large = sides if len(sides[0]) <= len(sides[1]) else sides[::-1]
+        candidate = evaluator.score_templates( sorted(small.members), sorted(large.members),
+                                               [small.template(), large.template()] )
+        if candidate is None:
+            continue
+        heapq.heappush( shortlist, (-candidate.metric, next(counter), candidate) )
+        if len(shortlist) > GRAY_RESCORE:
+            heapq.heappop( shortlist )
+    best = None
+    for metric, _, candidate in sorted( shortlist, reverse=True ):
+        exact = evaluator.evaluate( candidate.h1, candidate.h2 )
+        if _better( exact, best ):
+            best = exact
+    return best
+
+def best_first_split_search( evaluator, max_evaluations=MAX_EVALUATIONS ):
+    """
+    Best-first search over read assignments, a heuristic.
+
+    Partial splits are expanded in order of disagreement(h1) +
+    disagreement(h2), which can only grow as reads are assigned, so the
+    splits whose groups are most internally consistent are completed and
+    scored exactly first.  Nothing is pruned: the disagreement count does
+    not bound the metric (the templates also hold insertion nodes and are
+    built from at most max_num_reads reads), so the search simply stops
+    after max_evaluations exact scorings.  Beyond MAX_OPEN_NODES open
+    nodes the least promising half is dropped.
+    """
+    n = len(evaluator.reads)
+    if n < 2:
+        return None
+    profiles = evaluator.profiles
+
+    counter = itertools.count()
+    # Read 0 is pinned to h1 to remove complement symmetry
+    heap = [ (0, next(counter), (0,), ()) ]
+    best = None
+    while heap:
+        priority, _, h1, h2 = heapq.heappop(heap)
+        assigned = len(h1) + len(h2)
+        if assigned == n:
+            if not h2:
+                continue
+            if max_evaluations and evaluator.evaluations >= max_evaluations:
+                break
+            if len(h1) > len(h2):
+                h1, h2 = h2, h1
+            candidate = evaluator.evaluate( list(h1), list(h2) )
+            if _better( candidate, best ):
+                best = candidate
+            continue
+        for side in (h1 + (assigned,), h2), (h1, h2 + (assigned,)):
+            dis = disagreement( profiles[list(side[0])] ) + disagreement( profiles[list(side[1])] )
+            heapq.heappush( heap, (dis, next(counter), side[0], side[1]) )
+        if len(heap) > MAX_OPEN_NODES:
+            heap = heapq.nsmallest( MAX_OPEN_NODES / 2, heap )
+            heapq.heapify( heap )
+    return best
+
+def greedy_split_search( evaluator, max_evaluations=MAX_EVALUATIONS ):
+    """
+    Seed a split by greedily assigning each read to the side whose
+    disagreement grows least, then improve it by single-read moves between
+    the sides until no move lowers the metric or the budget runs out
+    """
+    n = len(evaluator.reads)
+    if n < 2:
+        return None
+    profiles = evaluator.profiles
+    # Seed the two sides with the most dissimilar pair of reads
+    covered = profiles > NOT_COVERED
+    shared = np.dot( covered.astype(np.int32), covered.T.astype(np.int32) )
+    differ = np.zeros( (n, n), dtype=np.int32 )
+    for i in range(n):
+        differ[i] = np.sum( covered[i] & covered & (profiles[i] != profiles), 1 )
+    ratio = differ / np.maximum( shared, 1 ).astype(float)
+    first, second = np.unravel_index( np.argmax(ratio), ratio.shape )
+    if first == second:
+        first, second = 0, 1
+    h1, h2 = [int(first)], [int(second)]
+    for i in range(n):
+        if i in (first, second):
+            continue
+        cost1 = disagreement( profiles[h1 + [i]] ) - disagreement( profiles[h1] )
+        cost2 = disagreement( profiles[h2 + [i]] ) - disagreement( profiles[h2] )
+        if cost1 <= cost2:
+            h1.append(i)
+        else:
+            h2.append(i)
+
+    best = evaluator.evaluate( sorted(h1), sorted(h2) )
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n):
+            if max_evaluations and evaluator.evaluations >= max_evaluations:
+                return best
+            if i in h1:
+                if len(h1) == 1: continue
+                new_h1 = [ x for x in h1 if x != i ]; new_h2 = sorted(h2 + [i])
+            else:
+                if len(h2) == 1: continue
+                new_h1 = sorted(h1 + [i]); new_h2 = [ x for x in h2 if x != i ]
+            candidate = evaluator.evaluate( new_h1, new_h2 )
+            if _better( candidate, best ):
+                best = candidate
+                h1, h2 = new_h1, new_h2
+                improved = True
+    if best is not None and len(best.h1) > len(best.h2):
+        best = best._replace( h1=best.h2, h2=best.h1, templates=best.templates[::-1] )
+    return best
+
+SPLIT_SEARCH_ENGINES = {'exhaustive': exhaustive_split_search,
+                        'gray': gray_code_split_search,
+                        'bestfirst': best_first_split_search,
+                        'greedy': greedy_split_search}
+
+def search_split( reads, backboneSeq, score_floor, mode='exhaustive', max_evaluations=None ):
+    """
+    Find the bipartition of 'reads' minimizing entropy * percent identity
+    using the named search engine
+    """
+    try:
+        engine = SPLIT_SEARCH_ENGINES[mode]
+    except KeyError:
+        raise ValueError('Unknown split search mode "%s"' % mode)
+    evaluator = SplitEvaluator( reads, backboneSeq, score_floor )
+    if max_evaluations is None and mode in ('bestfirst', 'greedy'):
+        max_evaluations = MAX_EVALUATIONS
+    return engine( evaluator, max_evaluations=max_evaluations )
@@ -2,17 +2,18 @@ import os
 
 from pbcore.io.FastaIO import FastaReader, FastaWriter, FastaRecord
 
+from readstore import ReadStore
+
 def count_fasta( fasta_file ):
     """
     Count the number of records in a Fasta
     """
-    return len(list(FastaReader(fasta_file)))
+    with ReadStore( fasta_file ) as store:
+        return len(store)
 
 def read_fasta_names( fasta_file ):
-    ids = set()
-    for record in FastaReader( fasta_file ):
-        ids.add( record.name )
-    return ids
+    with ReadStore( fasta_file ) as store:
+        return set( store.names() )
 
 def write_fasta( filename, seq_name, sequence ):
     """
@@ -0,0 +1,429 @@
+import os
+import sys
+import Queue
+import signal
+import logging
+import random
+import threading
+import traceback
+import contextlib
+import cPickle as pickle
+import multiprocessing
+
+from collections import OrderedDict
+
+log = logging.getLogger()
+
+# Number of queued tasks allowed per worker before submission blocks
+QUEUE_DEPTH = 2
+# Contexts each worker keeps loaded, for sibling subsets sampled at once
+CONTEXT_CACHE_SIZE = 4
+# Seconds between checks that the workers are still alive while waiting
+POLL_INTERVAL = 1.0
+
+def _load_context( path ):
+    with open(path, 'rb') as handle:
+        return pickle.load(handle)
+
+def _worker_loop( target, task_queue, result_queue, current ):
+    """
+    Main loop of a pool worker: pull (context, context id, index, seed)
+    tasks until the None sentinel arrives, run the target and send back its
+    compact result.  The task being run is recorded in the shared 'current'
+    pair, so the parent knows what was lost if this worker dies.  The most
+    recently used contexts stay loaded until they are released.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    contexts = OrderedDict()
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        context_path, context_id, index, seed = task
+        current[1] = index
+        current[0] = context_id
+        try:
+            # release() removes the file, which retires the context here too
+            for path in [ p for p in contexts if p != context_path and not os.path.isfile(p) ]:
+                del contexts[path]
+            if context_path in contexts:
+                contexts[context_path] = contexts.pop( context_path )
+            else:
+                contexts[context_path] = _load_context( context_path )
+                while len(contexts) > CONTEXT_CACHE_SIZE:
+                    contexts.popitem( last=False )
+            random.seed( seed )
+            result = target( seed=seed, **contexts[context_path] )
+            result_queue.put( (context_path, index, result, None) )
+        except Exception:
+            result_queue.put( (context_path, index, None, traceback.format_exc()) )
+        current[0] = -1
+
+class ProcessBudget(object):
+    """
+    A counting semaphore shared by everything in the parent process that
+    keeps a CPU busy: pool tasks in flight and subprocesses run directly
+    """
+
+    def __init__(self, nproc):
+        self.nproc = max(1, nproc)
+        self._semaphore = threading.BoundedSemaphore( self.nproc )
+
+    def acquire(self, blocking=True):
+        return self._semaphore.acquire( blocking )
+
+    def release(self):
+        self._semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @contextlib.contextmanager
+    def share(self, most):
+        """
+        Hold one token, waiting for it, plus as many more of up to 'most'
+        in all as are free right now; yields the number held, for a
+        subprocess that can use that many threads
+        """
+        self.acquire()
+        held = 1
+        while held < most and self.acquire( False ):
+            held += 1
+        try:
+            yield held
+        finally:
+            for i in range(held):
+                self.release()
+
+class FeaturePool(object):
+    """
+    A fixed set of worker processes, created once per run, that evaluate
+    random samples against a shared context.
+
+    The context (alignments, backbone and settings for one subset) is
+    written once by publish() and loaded once per worker; after that each
+    task is only a seed.  Workers keep the CONTEXT_CACHE_SIZE most recently
+    used contexts loaded until they are released, so sibling subsets
+    sampled at the same time do not keep evicting each other.  Values that
+    pickle by reference, such as a shared AlignmentTable, are mapped by the
+    workers rather than copied.  Submission blocks while the task queue is
+    full and collection blocks on the result queue, so nothing spins.
+
+    Several threads may call map_samples at once; a collector thread routes
+    each result back to the caller that owns its context, and every task in
+    flight holds one token of the shared ProcessBudget.
+
+    A worker that dies (killed for memory, or crashed in native code) is
+    replaced.  Each worker records the task it is running in shared
+    memory, so the one sample it was running fails instead of being waited
+    for forever, and its budget token is returned; everything else keeps
+    its token until its result arrives.
+    """
+
+    def __init__(self, target, nproc, tmp_dir, budget=None):
+        self.nproc = max(1, nproc)
+        self.tmp_dir = tmp_dir
+        self.budget = budget
+        self._target = target
+        self._task_queue = multiprocessing.Queue( QUEUE_DEPTH * self.nproc )
+        self._result_queue = multiprocessing.Queue()
+        self._contexts = 0
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._context_ids = {}
+        # (context id, index) of the task each worker is running, -1 if idle
+        self._current = [ multiprocessing.Array('l', [-1, -1], lock=False) for i in range(self.nproc) ]
+        self._lost = set()
+        self._workers = [ self._start_worker(i) for i in range(self.nproc) ]
+        self._collector = threading.Thread( target=self._collect, name='FeatureCollector' )
+        self._collector.daemon = True
+        self._collector.start()
+
+    def _start_worker(self, i):
+        worker = multiprocessing.Process( target=_worker_loop,
+                                          name='FeatureWorker-%d' % (i+1),
+                                          args=(self._target, self._task_queue, self._result_queue, self._current[i]) )
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def _check_workers(self):
+        """
+        Replace any worker that has exited, recording the task it was
+        running as lost
+        """
+        with self._lock:
+            for i, worker in enumerate( self._workers ):
+                if not worker.is_alive():
+                    log.info("%s exited with code %s, starting a replacement" % (worker.name, worker.exitcode))
+                    context_id, index = self._current[i]
+                    if context_id >= 0:
+                        self._lost.add( (context_id, index) )
+                    self._current[i][0] = -1
+                    self._workers[i] = self._start_worker(i)
+
+    def _take_lost(self, context_id):
+        ### the indices of this context's tasks that died with their worker
+        with self._lock:
+            lost = set( index for cid, index in self._lost if cid == context_id )
+            self._lost.difference_update( (context_id, index) for index in lost )
+        return lost
+
+    def _submit(self, task):
+        while True:
+            try:
+                self._task_queue.put( task, True, POLL_INTERVAL )
+                return
+            except Queue.Full:
+                # the queue only stays full if nobody is left to drain it
+                self._check_workers()
+
+    def _collect(self):
+        while True:
+            message = self._result_queue.get()
+            if message is None:
+                break
+            with self._lock:
+                route = self._routes.get( message[0] )
+            if route is not None:
+                route.put( message )
+
+    def publish(self, **context):
+        """
+        Store the keyword arguments shared by all samples of one subset and
+        return the handle tasks refer to it by
+        """
+        with self._lock:
+            self._contexts += 1
+            path = os.path.join( self.tmp_dir, "context_%d.pkl" % self._contexts )
+            self._context_ids[path] = self._contexts
+        with open(path, 'wb') as handle:
+            pickle.dump( context, handle, pickle.HIGHEST_PROTOCOL )
+        return path
+
+    def release(self, context):
+        with self._lock:
+            self._context_ids.pop( context, None )
+        if os.path.isfile(context):
+            os.remove(context)
+
+    def map_samples(self, context, seeds):
+        """
+        Run one task per seed against a published context and return the
+        results in seed order, with None for samples that failed
+        """
+        seeds = list(seeds)
+        results = [None] * len(seeds)
+        route = Queue.Queue()
+        with self._lock:
+            self._routes[context] = route
+            context_id = self._context_ids[context]
+        submitted = 0
+        received = 0
+        in_flight = set()
+        try:
+            while received < len(seeds):
+                # Keep the queue topped up; only wait for a budget token when
+                # nothing of ours is in flight, otherwise drain results first
+                while submitted < len(seeds) and submitted - received < QUEUE_DEPTH * self.nproc:
+                    if self.budget is not None and not self.budget.acquire( submitted == received ):
+                        break
+                    self._submit( (context, context_id, submitted, seeds[submitted]) )
+                    in_flight.add( submitted )
+                    submitted += 1
+                try:
+                    context_path, index, result, error = route.get( True, POLL_INTERVAL )
+                except Queue.Empty:
+                    self._check_workers()
+                    # Samples whose worker died will never report back
+                    for index in self._take_lost( context_id ) & in_flight:
+                        log.info("Sample %s failed: its worker exited" % index)
+                        in_flight.discard( index )
+                        received += 1
+                        if self.budget is not None:
+                            self.budget.release()
+                    continue
+                if index not in in_flight:
+                    continue
+                in_flight.discard( index )
+                received += 1
+                if self.budget is not None:
+                    self.budget.release()
+                if error is not None:
+                    log.info("Sample %s failed:\n%s" % (index, error))
+                    continue
+                results[index] = result
+        finally:
+            with self._lock:
+                del self._routes[context]
+        return results
+
+    def close(self):
+        for worker in self._workers:
+            self._task_queue.put( None )
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._result_queue.put( None )
+        self._collector.join()
+
+    def terminate(self):
+        for worker in self._workers:
+            worker.terminate()
+        self._workers = []
+
+class SubsetScheduler(object):
+    """
+    Process a tree of independent tasks with a fixed number of threads.
+
+    The handler is called with the fields of one task and returns the list
+    of child tasks it produced, which become available to any idle thread
+    straight away.  Sibling subsets are therefore processed concurrently.
+    """
+
+    def __init__(self, handler, nthreads):
+        self.handler = handler
+        self.nthreads = max(1, nthreads)
+        self._queue = Queue.Queue()
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._error = None
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            try:
+                children = self.handler( *task ) or []
+            except Exception:
+                children = []
+                with self._condition:
+                    if self._error is None:
+                        self._error = sys.exc_info()
+            with self._condition:
+                if self._error is None:
+                    for child in children:
+                        self._pending += 1
+                        self._queue.put( child )
+                self._pending -= 1
+                if self._pending == 0 or self._error is not None:
+                    self._condition.notify_all()
+
+    def run(self, tasks):
+        threads = []
+        with self._condition:
+            for task in tasks:
+                self._pending += 1
+                self._queue.put( task )
+        for i in range(self.nthreads):
+            thread = threading.Thread( target=self._worker, name='Subset-%d' % (i+1) )
+            thread.daemon = True
+            thread.start()
+            threads.append( thread )
+        with self._condition:
+            while self._pending > 0 and self._error is None:
+                # A timeout keeps the wait interruptible by signals
+                self._condition.wait( 1.0 )
+        for thread in threads:
+            self._queue.put( None )
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+def _tree_worker_loop( handler, task_queue, result_queue ):
+    """
+    Main loop of a tree pool worker: run (path, task, threads) tasks until
+    the None sentinel arrives and send back the result and child tasks
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        message = task_queue.get()
+        if message is None:
+            break
+        path, task, threads = message
+        try:
+            result, children = handler( task, threads )
+            result_queue.put( (path, result, list(children), None) )
+        except Exception:
+            result_queue.put( (path, None, [], traceback.format_exc()) )
+
+class TreePool(object):
+    """
+    Process a tree of tasks in worker processes, sharing a budget of cores.
+
+    The handler is called in a worker with one task and the number of
+    threads it may use, and returns (result, child tasks).  Children are
+    queued as soon as their parent returns and idle workers take whichever
+    task is next, so a worker never waits while another branch of the tree
+    has work.  Every task in flight holds a share of the 'nproc' cores,
+    split evenly among the tasks that can start, so a lone task (the root)
+    gets all of them and the shares shrink as the tree widens.
+
+    Each task is identified by its path from the root, and run() returns
+    the results ordered by path: the depth-first order of a sequential
+    recursion, whatever order the tasks finished in.
+    """
+
+    def __init__(self, handler, nproc, nworkers=None):
+        self.nproc = max(1, nproc)
+        self.nworkers = max(1, min(nworkers or self.nproc, self.nproc))
+        self._task_queue = multiprocessing.Queue()
+        self._result_queue = multiprocessing.Queue()
+        self._workers = []
+        for i in range(self.nworkers):
+            worker = multiprocessing.Process( target=_tree_worker_loop,
+                                              name='TreeWorker-%d' % (i+1),
+                                              args=(handler, self._task_queue, self._result_queue) )
+            worker.daemon = True
+            worker.start()
+            self._workers.append( worker )
+
+    def _next_result(self):
+        while True:
+            try:
+                # A timeout keeps the wait interruptible by signals
+                return self._result_queue.get( True, 1.0 )
+            except Queue.Empty:
+                if not all( worker.is_alive() for worker in self._workers ):
+                    raise RuntimeError( "A tree pool worker exited unexpectedly" )
+
+    def run(self, root):
+        ready = [ ((), root) ]
+        running = {}
+        results = []
+        while ready or running:
+            free = self.nproc - sum( running.values() )
+            while ready and len(running) < self.nworkers and free > 0:
+                share = max( 1, free // min( len(ready), self.nworkers - len(running) ) )
+                path, task = ready.pop()
+                self._task_queue.put( (path, task, share) )
+                running[path] = share
+                free -= share
+            path, result, children, error = self._next_result()
+            del running[path]
+            if error is not None:
+                raise RuntimeError( "Tree task %s failed:\n%s" % (path, error) )
+            if result is not None:
+                results.append( (path, result) )
+            # Pushed in reverse so the first child is taken next
+            ready.extend( reversed( [ (path + (i,), child) for i, child in enumerate(children) ] ) )
+        results.sort( key=lambda x: x[0] )
+        return [ result for path, result in results ]
+
+    def close(self):
+        for worker in self._workers:
+            self._task_queue.put( None )
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def terminate(self):
+        for worker in self._workers:
+            worker.terminate()
+        self._workers = []
@@ -0,0 +1,185 @@
+import logging
+
+import numpy as np
+
+from collections import namedtuple
+
+from aligner import align_pair, estimate_diagonal
+from sketch import kmer_set, reverse_complement
+
+log = logging.getLogger()
+
+ZMW_MODES = ['none', 'best', 'consensus']
+# Fewest subreads a ZMW needs before a consensus is worth building
+MIN_PASSES = 3
+KMER_SIZE = 12
+
+ZmwUnit = namedtuple('ZmwUnit', 'name, sequence, weight')
+# A ZMW before collapsing: the subreads its unit is built from, and the
+# number of subreads it stands for
+ZmwGroup = namedtuple('ZmwGroup', 'name, subreads, weight')
+
+BASES = 'ACGT-'
+BASE_INDEX = dict( (b, i) for i, b in enumerate(BASES) )
+
+def zmw_key( name ):
+    """
+    'movie/zmw' for a subread named movie/zmw/start_end, or None for a
+    name that does not identify a ZMW
+    """
+    parts = name.split("/")
+    if len(parts) < 3 or not parts[1].isdigit():
+        return None
+    return "/".join( parts[:2] )
+
+def unit_name( key ):
+    ### the rest of the pipeline drops everything after a "/" in read names
+    return key.replace( "/", "_" )
+
+def group_subreads( records ):
+    """
+    Group (name, sequence) records by ZMW as they stream past, yielding
+    (unit name, subreads) when each ZMW ends, so only one ZMW is held at a
+    time.  Subread files list the subreads of a ZMW together; a ZMW that
+    turns up again later becomes a second unit with a numbered name.
+    Records whose name identifies no ZMW form groups of their own.
+    """
+    seen = {}
+    name, key, subreads = None, None, []
+    for record_name, seq in records:
+        record_key = zmw_key( record_name )
+        if subreads and (record_key is None or record_key != key):
+            yield name, subreads
+            subreads = []
+        if not subreads:
+            key = record_key
+            if key is None:
+                name = record_name
+            else:
+                name = unit_name( key )
+                seen[key] = seen.get( key, 0 ) + 1
+                if seen[key] > 1:
+                    log.warning("Subreads of ZMW %s are not contiguous" % key)
+                    name = "%s_%d" % (name, seen[key])
+        subreads.append( seq )
+    if subreads:
+        yield name, subreads
+
+def best_subread( subreads ):
+    """
+    The subread closest to the median length of its ZMW; shorter ones are
+    usually the partial first and last passes and longer ones are often
+    adapter read-through
+    """
+    lengths = np.array( [ len(s) for s in subreads ] )
+    median = np.median( lengths )
+    return subreads[ int(np.argmin( np.abs(lengths - median) )) ]
+
+def zmw_consensus( subreads, template=None, k=KMER_SIZE ):
+    """
+    Majority-vote consensus of the subreads of one ZMW.
+
+    Every subread is put on the strand of the template (consecutive passes
+    alternate strands) and aligned to it; each template position then takes
+    the most common base or deletion, and an insertion after it is kept
+    when more than half of the subreads covering it carry the same one.
+    """
+    if template is None:
+        template = best_subread( subreads )
+    template = template.upper()
+    n = len(template)
+    counts = np.zeros( (n, len(BASES)), dtype=np.int32 )
+    for i, b in enumerate( template ):
+        if b in BASE_INDEX:
+            counts[i, BASE_INDEX[b]] += 1
+    coverage = np.ones( n, dtype=np.int32 )
+    insertions = [ {} for i in xrange(n) ]
+    template_kmers = kmer_set( template, k )
+    used_template = False
+    for seq in subreads:
+        seq = seq.upper()
+        if seq == template and not used_template:
+            used_template = True
+            continue
+        rc = reverse_complement( seq )
+        if len( kmer_set(rc, k) & template_kmers ) > len( kmer_set(seq, k) & template_kmers ):
+            seq = rc
+        alignment = align_pair( seq, template, mode='semiglobal', diagonal=estimate_diagonal(seq, template) )
+        if alignment is None:
+            continue
+        position = alignment.tstart - 1
+        inserted = []
+        for qb, tb in zip( alignment.qseq, alignment.tseq ):
+            if tb == '-':
+                inserted.append( qb )
+                continue
+            if inserted and position >= 0:
+                run = ''.join( inserted )
+                insertions[position][run] = insertions[position].get( run, 0 ) + 1
+            inserted = []
+            position += 1
+            if qb in BASE_INDEX:
+                counts[position, BASE_INDEX[qb]] += 1
+        coverage[alignment.tstart:alignment.tend] += 1
+    consensus = []
+    calls = counts.argmax( axis=1 )
+    for i in xrange(n):
+        if not counts[i].any():
+            consensus.append( template[i] )
+        elif calls[i] != BASE_INDEX['-']:
+            consensus.append( BASES[calls[i]] )
+        if insertions[i]:
+            run, votes = max( insertions[i].iteritems(), key=lambda x: x[1] )
+            if 2 * votes > coverage[i]:
+                consensus.append( run )
+    return ''.join( consensus )
+
+def group_zmws( records, mode='best', min_passes=MIN_PASSES ):
+    """
+    Yield one ZmwGroup per ZMW from (name, sequence) subread records,
+    keeping only what build_unit() needs: all the subreads of a ZMW that
+    will get a consensus ('consensus' mode, at least min_passes subreads)
+    and the most representative subread of any other
+    """
+    if mode not in ZMW_MODES:
+        raise ValueError( 'Unknown ZMW collapsing mode "%s"' % mode )
+    if mode == 'none':
+        for name, seq in records:
+            yield ZmwGroup( name, [seq], 1 )
+        return
+    for name, subreads in group_subreads( records ):
+        if mode == 'consensus' and len(subreads) >= min_passes:
+            yield ZmwGroup( name, subreads, len(subreads) )
+        else:
+            yield ZmwGroup( name, [best_subread( subreads )], len(subreads) )
+
+def build_unit( group ):
+    """
+    The ZmwUnit of a ZmwGroup, building the consensus of its subreads if
+    it kept more than one
+    """
+    if len(group.subreads) == 1:
+        return ZmwUnit( group.name, group.subreads[0], group.weight )
+    return ZmwUnit( group.name, zmw_consensus( group.subreads, best_subread( group.subreads ) ), group.weight )
+
+def collapse_zmws( records, mode='best', min_passes=MIN_PASSES ):
+    """
+    Yield one ZmwUnit per ZMW from (name, sequence) subread records: its
+    most representative subread ('best') or the consensus of its subreads
+    ('consensus', for ZMWs with at least min_passes of them), weighted by
+    the number of subreads it stands for
+    """
+    for group in group_zmws( records, mode, min_passes ):
+        yield build_unit( group )
+
+def write_units( units, out_fn ):
+    """
+    Write ZmwUnits to a Fasta file and return their weights by name
+    """
+    weights = {}
+    with open( out_fn, 'w' ) as output:
+        for unit in units:
+            print >>output, ">" + unit.name
+            print >>output, unit.sequence
+            weights[unit.name] = weights.get( unit.name, 0 ) + unit.weight
+    return weights